@@ -0,0 +1,183 @@
+import asyncio
+import collections
+import functools
+import logging
+import threading
+import time
+from asyncio.subprocess import PIPE
+
+from mockssh.commands import decode_command
+
+__all__ = [
+    "AsyncioEngine",
+]
+
+
+class AsyncioEngine(object):
+    """Serves a `mockssh.server.Server` from a single asyncio event loop.
+
+    Accepted connections, exec channels and the pipes of the commands they
+    run are all multiplexed on one loop thread. Each connection still gets
+    the thread paramiko's `Transport` runs its protocol in.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, server):
+        self.server = server
+        self.loop = None
+        self._main = None
+        self._thread = None
+
+    def start(self) -> None:
+        self.server._socket.setblocking(False)
+        self.loop = loop = asyncio.new_event_loop()
+        self._main = loop.create_task(self._serve(self.server._socket))
+        self._thread = t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def stop(self) -> None:
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._main.cancel)
+        except RuntimeError:
+            # The loop is closed already.
+            pass
+        thread.join()
+
+    def exec_command(self, channel, command) -> None:
+        """Runs `command` on `channel`. Safe to call from any thread."""
+        asyncio.run_coroutine_threadsafe(self._exec(channel, command),
+                                         self.loop)
+
+    def _run(self):
+        loop = self.loop
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._main)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self.log.error("Event loop failed", exc_info=True)
+        finally:
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks,
+                                                   return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+
+    async def _serve(self, sock):
+        while True:
+            self.log.debug("Waiting for incoming connections ...")
+            conn, addr = await self.loop.sock_accept(sock)
+            self.log.debug("... got connection %s from %s", conn, addr)
+            conn.setblocking(True)
+            try:
+                # Channels are taken off the transport as they are requested,
+                # by `Handler.accept_channels`.
+                handler = self.server.handler_cls(self.server, (conn, addr))
+                handler.transport.start_server(event=threading.Event(),
+                                               server=handler)
+            except Exception:
+                self.log.error("Error setting up connection from %s", addr,
+                               exc_info=True)
+                conn.close()
+
+    async def _exec(self, channel, command):
+        metrics = self.server.metrics
+        name = decode_command(command)
+        try:
+            started = time.perf_counter()
+            emulated = self.server.emulated_command(command)
+            if emulated is not None:
+                status = await self.loop.run_in_executor(None, emulated,
+                                                         channel)
+                metrics.record("exec", name,
+                               {"runtime": time.perf_counter() - started},
+                               emulated=1)
+                channel.send_exit_status(status)
+                return
+            self.log.debug("Executing %s", command)
+            p = await asyncio.create_subprocess_shell(command, stdin=PIPE,
+                                                      stdout=PIPE,
+                                                      stderr=PIPE)
+            spawned = time.perf_counter()
+            counts = collections.Counter()
+            stdin = self.loop.create_task(
+                self._relay_input(channel, p.stdin, counts))
+            try:
+                await asyncio.gather(
+                    self._relay_output(p.stdout, channel, counts, "stdout"),
+                    self._relay_output(p.stderr, channel, counts, "stderr"))
+                await p.wait()
+            finally:
+                stdin.cancel()
+                if p.returncode is None:
+                    p.kill()
+                    await p.wait()
+            metrics.record("exec", name,
+                           {"spawn": spawned - started,
+                            "runtime": time.perf_counter() - spawned},
+                           stdin_bytes=counts["stdin"],
+                           stdout_bytes=counts["stdout"],
+                           stderr_bytes=counts["stderr"])
+            channel.send_exit_status(p.returncode)
+        except Exception:
+            self.log.error("Error handling client (channel: %s)", channel,
+                           exc_info=True)
+        finally:
+            try:
+                channel.close()
+            except EOFError:
+                self.log.debug("Tried to close already closed channel")
+
+    async def _relay_input(self, channel, stdin, counts):
+        readable = asyncio.Event()
+        fd = channel.fileno()
+        size = self.server.buffer_size or 1024
+        try:
+            while True:
+                self.loop.add_reader(fd, readable.set)
+                await readable.wait()
+                self.loop.remove_reader(fd)
+                readable.clear()
+                if channel.recv_ready():
+                    data = channel.recv(size)
+                    counts["stdin"] += len(data)
+                    stdin.write(data)
+                    await stdin.drain()
+                elif channel.eof_received or channel.closed:
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.loop.remove_reader(fd)
+            stdin.close()
+
+    async def _relay_output(self, stream, channel, counts, name):
+        stderr = name == "stderr"
+        if self.server.buffer_size is None:
+            read = stream.readline
+        else:
+            read = functools.partial(stream.read, self.server.buffer_size)
+        send = channel.send_stderr if stderr else channel.send
+        sendall = channel.sendall_stderr if stderr else channel.sendall
+        while True:
+            data = await read()
+            if not data:
+                return
+            counts[name] += len(data)
+            while data and channel.send_ready():
+                sent = send(data)
+                if not sent:
+                    return
+                data = data[sent:]
+            if data:
+                # The channel window is exhausted. Wait for the client to
+                # open it on a worker thread rather than blocking the loop.
+                await self.loop.run_in_executor(None, sendall, data)
@@ -0,0 +1,11 @@
+"""Benchmarks of connection, exec and SFTP performance.
+
+Run ``python -m mockssh.benchmarks --help`` for the command line.
+"""
+
+from mockssh.benchmarks.scenarios import SCENARIOS, run_scenario
+
+__all__ = [
+    "SCENARIOS",
+    "run_scenario",
+]
@@ -0,0 +1,148 @@
+"""Runs mockssh benchmarks, and prints their results as JSON.
+
+Results of each scenario are the medians of all its runs. Given the JSON
+output of an earlier run with `--baseline`, the ratio of each result to
+its baseline value is reported as well.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+
+import paramiko
+
+from mockssh.benchmarks.scenarios import SCENARIOS, run_scenario
+from typing import List, Optional
+
+
+def parse_value(text):
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m mockssh.benchmarks",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help="scenarios to run (default: all of them)")
+    parser.add_argument("--list", action="store_true",
+                        help="list scenarios and their parameters")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs of each scenario (default: %(default)s)")
+    parser.add_argument("--engine", choices=["threading", "asyncio"],
+                        default="threading", help="server engine")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="server worker processes (default: %(default)s)")
+    parser.add_argument("--sftp-workers", type=int, default=0,
+                        help="threads handling the requests of each SFTP "
+                             "session (default: one at a time)")
+    parser.add_argument("--set", action="append", default=[],
+                        metavar="NAME=VALUE",
+                        help="scenario parameter, for those which have it")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="JSON results of an earlier run to compare to")
+    parser.add_argument("--output", metavar="FILE",
+                        help="file to write results to (default: stdout)")
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario {}".format(name))
+    params = {}
+    for setting in args.set:
+        name, sep, value = setting.partition("=")
+        if not sep:
+            parser.error("expected NAME=VALUE, got {}".format(setting))
+        params[name] = parse_value(value)
+    args.params = params
+    return args
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "paramiko": paramiko.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run(name, repeat, server_options, settings):
+    spec = SCENARIOS[name]
+    params = {k: v for k, v in settings.items() if k in spec.defaults}
+    runs = [run_scenario(name, server_options, **params)
+            for _ in range(repeat)]
+    # Runs may lack some results: latencies when no connection succeeded,
+    # for instance.
+    keys = dict.fromkeys(key for r in runs for key in r)
+    median = {key: statistics.median([r[key] for r in runs if key in r])
+              for key in keys}
+    return {
+        "params": dict(spec.defaults, **params),
+        "server": server_options,
+        "runs": runs,
+        "median": median,
+    }
+
+
+def compare(results, baseline):
+    comparison = {}
+    for name, result in results.items():
+        before = baseline.get("results", {}).get(name)
+        if before is None:
+            continue
+        comparison[name] = {
+            key: value / before["median"][key]
+            for key, value in result["median"].items()
+            if before["median"].get(key)
+        }
+    return comparison
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if args.list:
+        for spec in SCENARIOS.values():
+            params = " ".join("{}={}".format(k, v)
+                              for k, v in spec.defaults.items())
+            print("{}: {}\n    {}".format(spec.name, params,
+                                          " ".join(spec.description.split())))
+        return 0
+
+    logging.basicConfig(level=logging.WARNING)
+    report = {
+        "started": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "environment": environment(),
+        "results": {},
+    }
+    server_options = {"engine": args.engine, "processes": args.processes,
+                      "sftp_workers": args.sftp_workers}
+    for name in args.scenarios or list(SCENARIOS):
+        report["results"][name] = run(name, args.repeat, server_options,
+                                      args.params)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["comparison"] = compare(report["results"], json.load(f))
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,343 @@
+import contextlib
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from mockssh.metrics import Histogram
+from mockssh.server import Server
+from typing import Callable, Dict, Optional
+
+__all__ = [
+    "SCENARIOS",
+    "Scenario",
+    "run_scenario",
+]
+
+
+SAMPLE_USER_KEY = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                               "sample-user-key")
+
+UID = "sample-user"
+
+MB = 1024 * 1024
+
+
+class Scenario(object):
+    """A benchmark, with the default values of its parameters.
+
+    `func` is called with a running `Server`, a scratch directory and the
+    parameters, and returns a flat dict of numeric results. The server is
+    built with `server_options`, unless overridden.
+    """
+
+    def __init__(self, name: str, func: Callable, defaults: Dict,
+                 server_options: Optional[Dict] = None) -> None:
+        self.name = name
+        self.func = func
+        self.defaults = defaults
+        self.server_options = server_options or {}
+        self.description = (func.__doc__ or "").strip()
+
+
+SCENARIOS = {}
+
+
+def scenario(name, server_options=None, **defaults):
+    def register(func):
+        SCENARIOS[name] = Scenario(name, func, defaults, server_options)
+        return func
+
+    return register
+
+
+def run_scenario(name: str, server_options: Optional[Dict] = None,
+                 **params) -> Dict:
+    """Runs benchmark `name` against a fresh `Server`.
+
+    `server_options` are passed to the server, and `params` override the
+    defaults of the scenario.
+    """
+    spec = SCENARIOS[name]
+    unknown = set(params) - set(spec.defaults)
+    if unknown:
+        raise ValueError("Unknown parameters for {}: {}".format(
+            name, ", ".join(sorted(unknown))))
+    params = dict(spec.defaults, **params)
+    server_options = dict(spec.server_options, **(server_options or {}))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with Server({UID: SAMPLE_USER_KEY}, **server_options) as s:
+            return spec.func(s, tmp_dir, **params)
+
+
+def _latencies(prefix, histogram):
+    return {
+        prefix + "_mean": histogram.total / histogram.count,
+        prefix + "_p50": histogram.percentile(50),
+        prefix + "_p90": histogram.percentile(90),
+        prefix + "_p99": histogram.percentile(99),
+        prefix + "_max": histogram.max,
+    }
+
+
+def _in_parallel(concurrency, func):
+    errors = []
+
+    def run(i):
+        try:
+            func(i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+
+def _write_file(path, size):
+    chunk = os.urandom(MB)
+    with open(path, "wb") as f:
+        for offset in range(0, size, MB):
+            f.write(chunk[:size - offset])
+
+
+@contextlib.contextmanager
+def _echo_server():
+    """Runs a TCP server sending back whatever it receives, on a thread."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(8)
+
+    def echo(conn):
+        with conn:
+            while True:
+                data = conn.recv(MB)
+                if not data:
+                    return
+                conn.sendall(data)
+
+    def run():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        yield listener.getsockname()
+    finally:
+        listener.close()
+
+
+@scenario("connect", count=50)
+def connect(server, tmp_dir, count):
+    """Connects and authenticates `count` times in a row."""
+    histogram = Histogram()
+    started = time.perf_counter()
+    for _ in range(count):
+        t = time.perf_counter()
+        server.client(UID).close()
+        histogram.add(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+    result = {"connections_per_s": count / elapsed}
+    result.update(_latencies("latency", histogram))
+    return result
+
+
+@scenario("connection_storm", connections=500)
+def connection_storm(server, tmp_dir, connections):
+    """Opens `connections` connections at once, and keeps them open until
+    all are authenticated or failed."""
+    histogram = Histogram()
+    lock = threading.Lock()
+    barrier = threading.Barrier(connections)
+    done = threading.Barrier(connections)
+    failures = []
+
+    def run(i):
+        barrier.wait()
+        t = time.perf_counter()
+        client = None
+        try:
+            client = server.client(UID)
+            with lock:
+                histogram.add(time.perf_counter() - t)
+        except Exception:
+            with lock:
+                failures.append(i)
+        done.wait()
+        if client is not None:
+            client.close()
+
+    started = time.perf_counter()
+    _in_parallel(connections, run)
+    elapsed = time.perf_counter() - started
+    result = {
+        "connections_per_s": (connections - len(failures)) / elapsed,
+        "failures": len(failures),
+    }
+    if histogram.count:
+        result.update(_latencies("latency", histogram))
+    return result
+
+
+def _exec(server, concurrency, commands, command):
+    histogram = Histogram()
+    lock = threading.Lock()
+    received = []
+
+    def run(i):
+        n = commands // concurrency + (i < commands % concurrency)
+        with server.client(UID) as c:
+            for _ in range(n):
+                t = time.perf_counter()
+                _, stdout, _ = c.exec_command(command)
+                size = len(stdout.read())
+                stdout.channel.recv_exit_status()
+                with lock:
+                    histogram.add(time.perf_counter() - t)
+                    received.append(size)
+
+    started = time.perf_counter()
+    _in_parallel(concurrency, run)
+    elapsed = time.perf_counter() - started
+    result = {
+        "commands_per_s": commands / elapsed,
+        "mb_per_s": sum(received) / MB / elapsed,
+    }
+    result.update(_latencies("latency", histogram))
+    return result
+
+
+@scenario("exec_small", concurrency=8, commands=200)
+def exec_small(server, tmp_dir, concurrency, commands):
+    """Runs `commands` short-lived commands printing one line each, over
+    `concurrency` connections."""
+    return _exec(server, concurrency, commands, "echo hello")
+
+
+@scenario("exec_large", concurrency=4, commands=8, size_mb=16)
+def exec_large(server, tmp_dir, concurrency, commands, size_mb):
+    """Runs `commands` commands printing `size_mb` MiB each, over
+    `concurrency` connections."""
+    command = "head -c {} /dev/zero".format(size_mb * MB)
+    return _exec(server, concurrency, commands, command)
+
+
+@scenario("forward", server_options={"forwarding": True}, concurrency=1,
+          size_mb=64)
+def forward(server, tmp_dir, concurrency, size_mb):
+    """Sends `size_mb` MiB through each of `concurrency` tunnels at once.
+
+    Tunnels are forwarded to a local echo server, and the data is read back
+    as it is sent.
+    """
+    chunk = os.urandom(MB)
+    with _echo_server() as destination, server.client(UID) as c:
+        transport = c.get_transport()
+
+        def run(i):
+            channel = transport.open_channel("direct-tcpip", destination,
+                                             ("127.0.0.1", 0))
+
+            def send():
+                for _ in range(size_mb):
+                    channel.sendall(chunk)
+                channel.shutdown_write()
+
+            sender = threading.Thread(target=send)
+            sender.start()
+            received = 0
+            while True:
+                data = channel.recv(MB)
+                if not data:
+                    break
+                received += len(data)
+            sender.join()
+            channel.close()
+            if received != size_mb * MB:
+                raise AssertionError("Received {} bytes".format(received))
+
+        started = time.perf_counter()
+        _in_parallel(concurrency, run)
+        elapsed = time.perf_counter() - started
+    return {"mb_per_s": concurrency * size_mb / elapsed}
+
+
+@scenario("sftp_put", size_mb=64)
+def sftp_put(server, tmp_dir, size_mb):
+    """Uploads a file of `size_mb` MiB."""
+    source = os.path.join(tmp_dir, "source")
+    _write_file(source, size_mb * MB)
+    with server.client(UID) as c:
+        sftp = c.open_sftp()
+        started = time.perf_counter()
+        sftp.put(source, os.path.join(tmp_dir, "target"))
+        elapsed = time.perf_counter() - started
+    return {"mb_per_s": size_mb / elapsed}
+
+
+@scenario("sftp_get", size_mb=64)
+def sftp_get(server, tmp_dir, size_mb):
+    """Downloads a file of `size_mb` MiB."""
+    source = os.path.join(tmp_dir, "source")
+    _write_file(source, size_mb * MB)
+    with server.client(UID) as c:
+        sftp = c.open_sftp()
+        started = time.perf_counter()
+        sftp.get(source, os.path.join(tmp_dir, "target"))
+        elapsed = time.perf_counter() - started
+    return {"mb_per_s": size_mb / elapsed}
+
+
+@scenario("sftp_parallel_get", files=8, size_mb=8)
+def sftp_parallel_get(server, tmp_dir, files, size_mb):
+    """Downloads `files` files of `size_mb` MiB at once, in one session.
+
+    Reads of all files are pipelined by a single client thread, as
+    paramiko's client does not support concurrent readers.
+    """
+    sources = [os.path.join(tmp_dir, "source-{}".format(i))
+               for i in range(files)]
+    for path in sources:
+        _write_file(path, size_mb * MB)
+    with server.client(UID) as c:
+        sftp = c.open_sftp()
+        started = time.perf_counter()
+        opened = [sftp.open(path) for path in sources]
+        for f in opened:
+            f.prefetch(size_mb * MB)
+        received = 0
+        for f in opened:
+            with f:
+                received += len(f.read())
+        elapsed = time.perf_counter() - started
+    if received != files * size_mb * MB:
+        raise AssertionError("Received {} bytes".format(received))
+    return {"mb_per_s": files * size_mb / elapsed}
+
+
+@scenario("sftp_listdir", files=20000)
+def sftp_listdir(server, tmp_dir, files):
+    """Lists a directory of `files` entries, with their attributes."""
+    folder = os.path.join(tmp_dir, "folder")
+    os.mkdir(folder)
+    for i in range(files):
+        open(os.path.join(folder, "file-{:06d}".format(i)), "wb").close()
+    with server.client(UID) as c:
+        sftp = c.open_sftp()
+        started = time.perf_counter()
+        listed = len(sftp.listdir_attr(folder))
+        elapsed = time.perf_counter() - started
+    if listed != files:
+        raise AssertionError("Listed {} entries out of {}".format(listed,
+                                                                 files))
+    return {"entries_per_s": files / elapsed, "seconds": elapsed}
@@ -0,0 +1,89 @@
+import collections
+import logging
+import threading
+import time
+
+import paramiko
+
+__all__ = [
+    "ClientPool",
+    "PooledClient",
+]
+
+
+class PooledClient(paramiko.SSHClient):
+    """An `SSHClient` running on a transport borrowed from a `ClientPool`.
+
+    Closing the client closes the channels still open on the transport,
+    as closing an `SSHClient` would, then hands the transport back to the
+    pool instead of closing it.
+    """
+
+    def __init__(self, pool, uid, transport, created):
+        super(PooledClient, self).__init__()
+        self._pool = pool
+        self._uid = uid
+        self._transport = transport
+        self._created = created
+
+    def close(self):
+        transport, self._transport = self._transport, None
+        if transport is not None:
+            # paramiko has no public way of listing a transport's channels.
+            # Those left open would still take data, and window space, once
+            # the transport is lent out again.
+            for channel in transport._channels.values():
+                channel.close()
+            self._pool.release(self._uid, transport, self._created)
+
+
+class ClientPool(object):
+    """Keeps authenticated transports to a `Server` warm, per user.
+
+    At most `max_idle` idle transports are kept for each user, and none is
+    reused once it is older than `max_lifetime` seconds.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, server, max_idle: int = 4,
+                 max_lifetime: float = 60.0) -> None:
+        self.server = server
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self._lock = threading.Lock()
+        self._idle = collections.defaultdict(collections.deque)
+
+    def acquire(self, uid: str) -> PooledClient:
+        with self._lock:
+            idle = self._idle[uid]
+            while idle:
+                transport, created = idle.pop()
+                if self._reusable(transport, created):
+                    self.log.debug("Reusing %s for user '%s'", transport, uid)
+                    return PooledClient(self, uid, transport, created)
+                transport.close()
+        created = time.monotonic()
+        transport = self.server.client(uid).get_transport()
+        return PooledClient(self, uid, transport, created)
+
+    def release(self, uid: str, transport: paramiko.Transport,
+                created: float) -> None:
+        with self._lock:
+            idle = self._idle[uid]
+            if len(idle) < self.max_idle and self._reusable(transport, created):
+                idle.append((transport, created))
+                return
+        transport.close()
+
+    def close(self) -> None:
+        """Closes all idle transports."""
+        with self._lock:
+            for idle in self._idle.values():
+                while idle:
+                    transport, _ = idle.pop()
+                    transport.close()
+
+    def _reusable(self, transport, created):
+        return (transport.is_active() and
+                time.monotonic() - created < self.max_lifetime)
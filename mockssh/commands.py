@@ -0,0 +1,139 @@
+import functools
+import logging
+import time
+
+from typing import Callable, Optional, Pattern, Union
+
+__all__ = [
+    "Command",
+    "CommandRegistry",
+    "decode_command",
+    "respond",
+]
+
+
+class Command(object):
+    """An emulated command invocation.
+
+    `stdin`, `stdout` and `stderr` are binary file objects on the channel the
+    command was requested on. When the command was registered with a regular
+    expression, `match` holds the match for `command`.
+    """
+
+    def __init__(self, channel, command, match=None):
+        self.channel = channel
+        self.command = command
+        self.match = match
+        self.stdin = channel.makefile("rb")
+        self.stdout = channel.makefile("wb")
+        self.stderr = channel.makefile_stderr("wb")
+
+
+def decode_command(command: Union[str, bytes]) -> str:
+    """Returns the command line a client requested, as text."""
+    if isinstance(command, bytes):
+        return command.decode("utf-8", "surrogateescape")
+    return command
+
+
+def _encode(data):
+    if isinstance(data, str):
+        return data.encode("utf-8")
+    return data
+
+
+def respond(stdout: Union[str, bytes] = b"", stderr: Union[str, bytes] = b"",
+            status: int = 0, delay: float = 0.0) -> Callable:
+    """Returns an emulated command producing a canned response."""
+    stdout = _encode(stdout)
+    stderr = _encode(stderr)
+
+    def func(command):
+        if delay:
+            time.sleep(delay)
+        command.stdout.write(stdout)
+        command.stderr.write(stderr)
+        return status
+
+    return func
+
+
+class CommandRegistry(object):
+    """Commands a `Server` emulates in-process instead of running a shell.
+
+    Commands are matched by exact string first, then against the registered
+    regular expressions, in registration order. Hooks added with `add_hook`
+    are told of each change before it is made.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self) -> None:
+        self._exact = {}
+        self._patterns = []
+        self._hooks = []
+
+    def add_hook(self, hook: Callable) -> None:
+        """Calls `hook(method, args)` before each change to the registry.
+
+        `method` names the method making the change, called with `args`.
+        Raising from the hook prevents the change.
+        """
+        self._hooks = self._hooks + [hook]
+
+    def remove_hook(self, hook: Callable) -> None:
+        self._hooks = [h for h in self._hooks if h != hook]
+
+    def _changing(self, method, *args):
+        for hook in self._hooks:
+            hook(method, args)
+
+    def register(self, command: Union[str, Pattern],
+                 func: Optional[Callable] = None,
+                 stdout: Union[str, bytes] = b"",
+                 stderr: Union[str, bytes] = b"",
+                 status: int = 0, delay: float = 0.0) -> None:
+        """Emulates `command`, an exact command line or compiled regex.
+
+        `func` is called with a `Command` and returns the exit status (`None`
+        meaning 0). Without `func` the command writes `stdout` and `stderr`
+        and exits with `status`, after sleeping `delay` seconds.
+        """
+        self._changing("register", command, func, stdout, stderr, status,
+                       delay)
+        if func is None:
+            func = respond(stdout, stderr, status, delay)
+        if isinstance(command, str):
+            self._exact[command] = func
+        else:
+            self._patterns.append((command, func))
+
+    def clear(self) -> None:
+        self._changing("clear")
+        self._exact.clear()
+        del self._patterns[:]
+
+    def lookup(self, command: Union[str, bytes]) -> Optional[Callable]:
+        """Returns a function running `command` on a channel, if emulated.
+
+        The function takes the channel and returns the exit status.
+        """
+        command = decode_command(command)
+        func = self._exact.get(command)
+        if func is not None:
+            return functools.partial(self._run, func, command, None)
+        for pattern, func in self._patterns:
+            match = pattern.fullmatch(command)
+            if match is not None:
+                return functools.partial(self._run, func, command, match)
+        return None
+
+    def _run(self, func, command, match, channel):
+        self.log.debug("Emulating %s", command)
+        c = Command(channel, command, match)
+        try:
+            status = func(c)
+        finally:
+            c.stdout.flush()
+            c.stderr.flush()
+        return 0 if status is None else status
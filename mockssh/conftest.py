@@ -6,11 +6,13 @@ import tempfile
 from pytest import fixture
 
 from mockssh import Server
+from mockssh.fleet import ServerFleet
 import mockssh.server
 from paramiko.sftp_client import SFTPClient
 from typing import Iterator
 
 __all__ = [
+    "fleet",
     "server",
 ]
 
@@ -32,6 +34,16 @@ def server() -> Iterator[mockssh.server.Server]:
         yield s
 
 
+@fixture(scope="function")
+def fleet(request) -> Iterator[ServerFleet]:
+    users = {
+        "sample-user": SAMPLE_USER_KEY,
+    }
+    size = getattr(request, "param", 8)
+    with ServerFleet(users, size) as f:
+        yield f
+
+
 @fixture
 def sftp_client(server: mockssh.server.Server) -> Iterator[SFTPClient]:
     uid = tuple(server.users)[0]
@@ -0,0 +1,1018 @@
+import collections
+import errno
+import itertools
+import os
+import posixpath
+import stat
+import threading
+import time
+
+from typing import Iterator, List, Optional, Tuple
+
+__all__ = [
+    "Filesystem",
+    "LocalFilesystem",
+    "MemoryFilesystem",
+    "OverlayFilesystem",
+    "RootedFilesystem",
+    "copy_range",
+]
+
+
+_ACCMODE = getattr(os, "O_ACCMODE", os.O_RDONLY | os.O_WRONLY | os.O_RDWR)
+
+
+def _error(code, path=None):
+    return OSError(code, os.strerror(code), path)
+
+
+class Filesystem(object):
+    """The file operations the SFTP subsystem is served from.
+
+    Paths are the ones sent by SFTP clients. Methods report failures by
+    raising `OSError` with a meaningful `errno`, like their `os` namesakes.
+    `open` returns a file object with `pread`, `pwrite`, `stat` and `close`
+    methods, and `scandir` an iterator of `(name, stat_result)` pairs
+    describing entries as `lstat` would. `process_shared` tells whether
+    changes are seen by other processes, as those to the host's files are.
+    """
+
+    process_shared = False
+
+    def normalize(self, path: str) -> str:
+        """Returns `path` made absolute, without `.` and `..` components.
+
+        Relative paths are taken from the root: filesystems have no other
+        working directory, unless they say otherwise.
+        """
+        return "/" + posixpath.normpath("/" + path).lstrip("/")
+
+    def open(self, path: str, flags: int, mode: int = 0o777):
+        raise _error(errno.ENOSYS, path)
+
+    def stat(self, path: str) -> os.stat_result:
+        raise _error(errno.ENOSYS, path)
+
+    def lstat(self, path: str) -> os.stat_result:
+        raise _error(errno.ENOSYS, path)
+
+    def symlink(self, target: str, path: str) -> None:
+        raise _error(errno.ENOSYS, path)
+
+    def readlink(self, path: str) -> str:
+        raise _error(errno.ENOSYS, path)
+
+    def remove(self, path: str) -> None:
+        raise _error(errno.ENOSYS, path)
+
+    def mkdir(self, path: str, mode: int = 0o777) -> None:
+        raise _error(errno.ENOSYS, path)
+
+    def rmdir(self, path: str) -> None:
+        raise _error(errno.ENOSYS, path)
+
+    def chmod(self, path: str, mode: int) -> None:
+        raise _error(errno.ENOSYS, path)
+
+    def chown(self, path: str, uid: int, gid: int) -> None:
+        raise _error(errno.ENOSYS, path)
+
+    def utime(self, path: str, times: Tuple[float, float]) -> None:
+        raise _error(errno.ENOSYS, path)
+
+    def rename(self, src: str, dst: str) -> None:
+        raise _error(errno.ENOSYS, src)
+
+    def scandir(self, path: str) -> Iterator[Tuple[str, os.stat_result]]:
+        raise _error(errno.ENOSYS, path)
+
+    def statvfs(self, path: str) -> os.statvfs_result:
+        raise _error(errno.ENOSYS, path)
+
+
+# Bytes copied per call by `copy_range`.
+COPY_SIZE = 1024 * 1024
+
+
+def copy_range(src, src_offset: int, dst, dst_offset: int,
+               length: Optional[int] = None) -> int:
+    """Copies `length` bytes of file object `src` to `dst`.
+
+    Copies up to the end of `src` if `length` is `None`. Data is copied
+    within the kernel when both files are local. Returns the number of
+    bytes copied.
+    """
+    copied = 0
+    if (hasattr(os, "copy_file_range") and
+            hasattr(src, "fileno") and hasattr(dst, "fileno")):
+        try:
+            while length is None or copied < length:
+                size = COPY_SIZE if length is None else \
+                    min(COPY_SIZE, length - copied)
+                done = os.copy_file_range(src.fileno(), dst.fileno(), size,
+                                          src_offset + copied,
+                                          dst_offset + copied)
+                if not done:
+                    return copied
+                copied += done
+            return copied
+        except OSError as e:
+            # Across filesystems, or into a file opened for appending, for
+            # instance: copy what is left through user space.
+            if e.errno not in (errno.EXDEV, errno.EINVAL, errno.EBADF,
+                               errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+    while length is None or copied < length:
+        size = COPY_SIZE if length is None else min(COPY_SIZE, length - copied)
+        data = src.pread(size, src_offset + copied)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            written = dst.pwrite(view, dst_offset + copied)
+            view = view[written:]
+            copied += written
+    return copied
+
+
+class LocalFile(object):
+
+    cacheable = True
+
+    def __init__(self, fd):
+        self.fd = fd
+        self._lock = threading.Lock()
+
+    def pread(self, length, offset):
+        if hasattr(os, "pread"):
+            return os.pread(self.fd, length, offset)
+        with self._lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, length)
+
+    def pwrite(self, data, offset):
+        if hasattr(os, "pwrite"):
+            return os.pwrite(self.fd, data, offset)
+        with self._lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.write(self.fd, data)
+
+    def stat(self):
+        return os.fstat(self.fd)
+
+    def statvfs(self):
+        return os.fstatvfs(self.fd)
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd >= 0:
+            fd, self.fd = self.fd, -1
+            os.close(fd)
+
+
+class LocalFilesystem(Filesystem):
+    """Serves the host's own filesystem."""
+
+    process_shared = True
+
+    def normalize(self, path):
+        # Relative paths are opened from the current directory.
+        return os.path.abspath(path).replace(os.sep, "/")
+
+    def open(self, path, flags, mode=0o777):
+        return LocalFile(os.open(path, flags, mode))
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def lstat(self, path):
+        return os.lstat(path)
+
+    def symlink(self, target, path):
+        os.symlink(target, path)
+
+    def readlink(self, path):
+        return os.readlink(path)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def mkdir(self, path, mode=0o777):
+        os.mkdir(path, mode)
+
+    def rmdir(self, path):
+        os.rmdir(path)
+
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
+
+    def chown(self, path, uid, gid):
+        os.chown(path, uid, gid)
+
+    def utime(self, path, times):
+        os.utime(path, times)
+
+    def rename(self, src, dst):
+        os.rename(src, dst)
+
+    def scandir(self, path):
+        return self._scan(os.scandir(path))
+
+    def statvfs(self, path):
+        return os.statvfs(path)
+
+    @staticmethod
+    def _scan(entries):
+        with entries:
+            for entry in entries:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    # Removed since the directory was read, for instance.
+                    continue
+                yield entry.name, st
+
+
+class _Node(object):
+
+    def __init__(self, mode, ino):
+        self.mode = mode
+        self.ino = ino
+        self.uid = os.getuid() if hasattr(os, "getuid") else 0
+        self.gid = os.getgid() if hasattr(os, "getgid") else 0
+        self.atime = self.mtime = self.ctime = time.time()
+
+    @property
+    def size(self):
+        return 0
+
+    def stat(self):
+        return os.stat_result((self.mode, self.ino, 0, 1, self.uid, self.gid,
+                               self.size, int(self.atime), int(self.mtime),
+                               int(self.ctime)))
+
+    def touch(self):
+        self.mtime = self.ctime = time.time()
+
+
+class _File(_Node):
+
+    def __init__(self, mode, ino, data=b""):
+        super(_File, self).__init__(stat.S_IFREG | mode, ino)
+        self.data = bytearray(data)
+
+    @property
+    def size(self):
+        return len(self.data)
+
+
+class _Dir(_Node):
+
+    def __init__(self, mode, ino):
+        super(_Dir, self).__init__(stat.S_IFDIR | mode, ino)
+        self.children = {}
+
+
+class _Link(_Node):
+
+    def __init__(self, target, ino):
+        super(_Link, self).__init__(stat.S_IFLNK | 0o777, ino)
+        self.target = target
+
+    @property
+    def size(self):
+        return len(self.target)
+
+
+class MemoryFile(object):
+
+    cacheable = False
+
+    def __init__(self, fs, node, flags):
+        self.fs = fs
+        self.node = node
+        self.flags = flags
+
+    def pread(self, length, offset):
+        if self.flags & _ACCMODE == os.O_WRONLY:
+            raise _error(errno.EBADF)
+        with self.fs._lock:
+            return bytes(self.node.data[offset:offset + length])
+
+    def pwrite(self, data, offset):
+        if self.flags & _ACCMODE == os.O_RDONLY:
+            raise _error(errno.EBADF)
+        with self.fs._lock:
+            buf = self.node.data
+            if self.flags & os.O_APPEND:
+                offset = len(buf)
+            elif offset > len(buf):
+                buf.extend(bytes(offset - len(buf)))
+            buf[offset:offset + len(data)] = data
+            self.node.touch()
+        return len(data)
+
+    def stat(self):
+        with self.fs._lock:
+            return self.node.stat()
+
+    def statvfs(self):
+        return self.fs.statvfs("/")
+
+    def close(self):
+        pass
+
+
+class MemoryFilesystem(Filesystem):
+    """Keeps a whole filesystem tree in memory.
+
+    Relative paths are resolved from the root. There is no access control:
+    permission bits are recorded, but not enforced.
+    """
+
+    # Symbolic links followed while resolving a path before giving up.
+    MAX_SYMLINKS = 40
+
+    # What `statvfs` reports as the size of the filesystem, and the number of
+    # entries it can hold.
+    BLOCK_SIZE = 4096
+    CAPACITY = 1024 * 1024 * 1024
+    MAX_FILES = 1024 * 1024
+
+    def __init__(self) -> None:
+        self._lock = threading.RLock()
+        self._inodes = itertools.count(1)
+        self.root = _Dir(0o755, next(self._inodes))
+
+    def open(self, path, flags, mode=0o777):
+        with self._lock:
+            try:
+                node = self._lookup(path)
+                if flags & os.O_CREAT and flags & os.O_EXCL:
+                    raise _error(errno.EEXIST, path)
+            except FileNotFoundError:
+                if not flags & os.O_CREAT:
+                    raise
+                parent, name = self._parent(path)
+                node = parent.children[name] = _File(
+                    mode & 0o7777 & ~0o022, next(self._inodes))
+                parent.touch()
+            if isinstance(node, _Dir):
+                raise _error(errno.EISDIR, path)
+            if flags & os.O_TRUNC and flags & _ACCMODE != os.O_RDONLY:
+                del node.data[:]
+                node.touch()
+            return MemoryFile(self, node, flags)
+
+    def stat(self, path):
+        with self._lock:
+            return self._lookup(path).stat()
+
+    def lstat(self, path):
+        with self._lock:
+            return self._lookup(path, follow=False).stat()
+
+    def symlink(self, target, path):
+        with self._lock:
+            parent, name = self._parent(path, exists=False)
+            parent.children[name] = _Link(target, next(self._inodes))
+            parent.touch()
+
+    def readlink(self, path):
+        with self._lock:
+            node = self._lookup(path, follow=False)
+            if not isinstance(node, _Link):
+                raise _error(errno.EINVAL, path)
+            return node.target
+
+    def remove(self, path):
+        with self._lock:
+            parent, name = self._parent(path, exists=True)
+            if isinstance(parent.children[name], _Dir):
+                raise _error(errno.EISDIR, path)
+            del parent.children[name]
+            parent.touch()
+
+    def mkdir(self, path, mode=0o777):
+        with self._lock:
+            parent, name = self._parent(path, exists=False)
+            parent.children[name] = _Dir(mode & 0o7777 & ~0o022,
+                                         next(self._inodes))
+            parent.touch()
+
+    def rmdir(self, path):
+        with self._lock:
+            parent, name = self._parent(path, exists=True)
+            node = parent.children[name]
+            if not isinstance(node, _Dir):
+                raise _error(errno.ENOTDIR, path)
+            if node.children:
+                raise _error(errno.ENOTEMPTY, path)
+            del parent.children[name]
+            parent.touch()
+
+    def chmod(self, path, mode):
+        with self._lock:
+            node = self._lookup(path)
+            node.mode = stat.S_IFMT(node.mode) | (mode & 0o7777)
+            node.ctime = time.time()
+
+    def chown(self, path, uid, gid):
+        with self._lock:
+            node = self._lookup(path)
+            node.uid = uid
+            node.gid = gid
+            node.ctime = time.time()
+
+    def utime(self, path, times):
+        with self._lock:
+            node = self._lookup(path)
+            node.atime, node.mtime = times
+            node.ctime = time.time()
+
+    def rename(self, src, dst):
+        with self._lock:
+            src_parent, src_name = self._parent(src, exists=True)
+            dst_parent, dst_name = self._parent(dst)
+            node = src_parent.children[src_name]
+            target = dst_parent.children.get(dst_name)
+            if target is node:
+                return
+            if isinstance(node, _Dir):
+                if node in self._ancestors(dst):
+                    raise _error(errno.EINVAL, dst)
+                if target is not None and not isinstance(target, _Dir):
+                    raise _error(errno.ENOTDIR, dst)
+                if target is not None and target.children:
+                    raise _error(errno.ENOTEMPTY, dst)
+            elif isinstance(target, _Dir):
+                raise _error(errno.EISDIR, dst)
+            del src_parent.children[src_name]
+            dst_parent.children[dst_name] = node
+            src_parent.touch()
+            dst_parent.touch()
+
+    def scandir(self, path):
+        with self._lock:
+            node = self._lookup(path)
+            if not isinstance(node, _Dir):
+                raise _error(errno.ENOTDIR, path)
+            entries = list(node.children.items())
+        return self._scan(entries)
+
+    def _scan(self, entries):
+        for name, node in entries:
+            with self._lock:
+                st = node.stat()
+            yield name, st
+
+    def statvfs(self, path):
+        with self._lock:
+            self._lookup(path)
+            files = 0
+            used = 0
+            pending = [self.root]
+            while pending:
+                node = pending.pop()
+                files += 1
+                used += -(-node.size // self.BLOCK_SIZE)
+                if isinstance(node, _Dir):
+                    pending.extend(node.children.values())
+        blocks = self.CAPACITY // self.BLOCK_SIZE
+        free = max(blocks - used, 0)
+        free_files = max(self.MAX_FILES - files, 0)
+        return os.statvfs_result((self.BLOCK_SIZE, self.BLOCK_SIZE, blocks,
+                                  free, free, self.MAX_FILES, free_files,
+                                  free_files, 0, 255))
+
+    def makedirs(self, path: str) -> None:
+        """Creates `path` and any missing parent directories."""
+        with self._lock:
+            current = ""
+            for name in self._split(path):
+                current += "/" + name
+                try:
+                    self.mkdir(current, 0o755)
+                except FileExistsError:
+                    pass
+
+    def write_bytes(self, path: str, data: bytes) -> None:
+        with self._lock:
+            f = self.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            f.pwrite(data, 0)
+
+    def read_bytes(self, path: str) -> bytes:
+        with self._lock:
+            f = self.open(path, os.O_RDONLY)
+            return bytes(f.node.data)
+
+    @staticmethod
+    def _split(path):
+        return [p for p in path.split("/") if p and p != "."]
+
+    def _resolve(self, path, follow=True, depth=0) -> List[Tuple[str, _Node]]:
+        # Returns the `(name, node)` pairs leading from the root to `path`.
+        chain = []
+        parts = self._split(path)
+        for i, name in enumerate(parts):
+            if name == "..":
+                if chain:
+                    chain.pop()
+                continue
+            parent = chain[-1][1] if chain else self.root
+            if not isinstance(parent, _Dir):
+                raise _error(errno.ENOTDIR, path)
+            node = parent.children.get(name)
+            if node is None:
+                raise _error(errno.ENOENT, path)
+            if isinstance(node, _Link) and (follow or i < len(parts) - 1):
+                if depth >= self.MAX_SYMLINKS:
+                    raise _error(errno.ELOOP, path)
+                target = node.target
+                if not target.startswith("/"):
+                    target = "/".join([""] + [n for n, _ in chain] + [target])
+                chain = self._resolve(target, True, depth + 1)
+                continue
+            chain.append((name, node))
+        return chain
+
+    def _lookup(self, path, follow=True):
+        chain = self._resolve(path, follow)
+        return chain[-1][1] if chain else self.root
+
+    def _ancestors(self, path):
+        parts = self._split(path)
+        return [node for _, node in self._resolve("/".join(parts[:-1]))]
+
+    def _parent(self, path, exists=None):
+        # Returns the directory `path` is in, and its name in there. With
+        # `exists` set, checks whether that name is (or is not) taken.
+        parts = self._split(path)
+        if not parts or parts[-1] == "..":
+            raise _error(errno.EINVAL, path)
+        parent = self._lookup("/".join(parts[:-1]))
+        if not isinstance(parent, _Dir):
+            raise _error(errno.ENOTDIR, path)
+        name = parts[-1]
+        if exists is True and name not in parent.children:
+            raise _error(errno.ENOENT, path)
+        if exists is False and name in parent.children:
+            raise _error(errno.EEXIST, path)
+        return parent, name
+
+
+class OverlayFilesystem(Filesystem):
+    """Serves the directory `base` without ever modifying it.
+
+    Client paths are resolved from `base`, which is only read from. Files
+    are copied to an in-memory upper layer when first modified, and
+    removals are recorded as whiteouts hiding the `base` entries, so the
+    cost of isolating a session is proportional to what it changes.
+    `reset` discards all changes.
+
+    Symbolic links made through the overlay are followed into `base` when
+    they are the last component of a path; those in `base` are followed by
+    the host. Writing through a link in `base` copies up the file it points
+    to.
+    """
+
+    MAX_SYMLINKS = 40
+
+    def __init__(self, base: str) -> None:
+        self.base = base
+        self.lower = LocalFilesystem()
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Discards all changes made on top of `base`."""
+        with self._lock:
+            self.upper = MemoryFilesystem()
+            self._whiteouts = set()
+
+    def open(self, path, flags, mode=0o777):
+        with self._lock:
+            path = self._follow(path)
+            writing = (flags & _ACCMODE != os.O_RDONLY or
+                       flags & os.O_TRUNC)
+            layer = self._layer(path)
+            if layer is self.lower and writing:
+                if flags & os.O_CREAT and flags & os.O_EXCL:
+                    raise _error(errno.EEXIST, path)
+                # Truncated files are not worth copying.
+                self._copy_up(path, follow=True,
+                              empty=bool(flags & os.O_TRUNC))
+                layer = self.upper
+            elif layer is None:
+                if not flags & os.O_CREAT:
+                    raise _error(errno.ENOENT, path)
+                self._copy_up_parents(path)
+                layer = self.upper
+            if layer is self.lower:
+                return self.lower.open(self._lower_path(path), flags, mode)
+            return self.upper.open(path, flags, mode)
+
+    def stat(self, path):
+        with self._lock:
+            path = self._follow(path)
+            if self._layer(path) is self.lower:
+                return self.lower.stat(self._lower_path(path))
+            return self.upper.stat(path)
+
+    def lstat(self, path):
+        with self._lock:
+            path = self._normalize(path)
+            if self._layer(path) is self.lower:
+                return self.lower.lstat(self._lower_path(path))
+            return self.upper.lstat(path)
+
+    def readlink(self, path):
+        with self._lock:
+            path = self._normalize(path)
+            if self._layer(path) is self.lower:
+                return self.lower.readlink(self._lower_path(path))
+            return self.upper.readlink(path)
+
+    def symlink(self, target, path):
+        with self._lock:
+            path = self._create(path)
+            self.upper.symlink(target, path)
+
+    def remove(self, path):
+        with self._lock:
+            path = self._normalize(path)
+            if stat.S_ISDIR(self.lstat(path).st_mode):
+                raise _error(errno.EISDIR, path)
+            self._delete(path)
+
+    def mkdir(self, path, mode=0o777):
+        with self._lock:
+            path = self._create(path)
+            self.upper.mkdir(path, mode)
+
+    def rmdir(self, path):
+        with self._lock:
+            path = self._normalize(path)
+            if not stat.S_ISDIR(self.lstat(path).st_mode):
+                raise _error(errno.ENOTDIR, path)
+            if any(True for _ in self.scandir(path)):
+                raise _error(errno.ENOTEMPTY, path)
+            self._delete(path)
+
+    def chmod(self, path, mode):
+        with self._lock:
+            path = self._follow(path)
+            self._copy_up(path, follow=True)
+            self.upper.chmod(path, mode)
+
+    def chown(self, path, uid, gid):
+        with self._lock:
+            path = self._follow(path)
+            self._copy_up(path, follow=True)
+            self.upper.chown(path, uid, gid)
+
+    def utime(self, path, times):
+        with self._lock:
+            path = self._follow(path)
+            self._copy_up(path, follow=True)
+            self.upper.utime(path, times)
+
+    def rename(self, src, dst):
+        with self._lock:
+            src = self._normalize(src)
+            dst = self._normalize(dst)
+            src_st = self.lstat(src)
+            self._check_parent(dst)
+            if src == dst:
+                return
+            try:
+                dst_st = self.lstat(dst)
+            except FileNotFoundError:
+                dst_st = None
+            if stat.S_ISDIR(src_st.st_mode):
+                if dst.startswith(src + "/"):
+                    raise _error(errno.EINVAL, dst)
+                if dst_st is not None:
+                    if not stat.S_ISDIR(dst_st.st_mode):
+                        raise _error(errno.ENOTDIR, dst)
+                    if any(True for _ in self.scandir(dst)):
+                        raise _error(errno.ENOTEMPTY, dst)
+            elif dst_st is not None and stat.S_ISDIR(dst_st.st_mode):
+                raise _error(errno.EISDIR, dst)
+            # Renaming a directory from `base` copies its whole tree up.
+            self._copy_up_tree(src)
+            self._copy_up_parents(dst)
+            self.upper.rename(src, dst)
+            if self._in_lower(src):
+                self._whiteouts.add(src)
+
+    def scandir(self, path):
+        with self._lock:
+            path = self._follow(path)
+            layer = self._layer(path)
+            if layer is None:
+                raise _error(errno.ENOENT, path)
+            if not stat.S_ISDIR(self.stat(path).st_mode):
+                raise _error(errno.ENOTDIR, path)
+            entries = []
+            if self._in_upper(path):
+                entries.extend(self.upper.scandir(path))
+            if self._in_lower(path):
+                seen = set(name for name, _ in entries)
+                prefix = path.rstrip("/") + "/"
+                entries.extend(
+                    (name, st)
+                    for name, st in self.lower.scandir(self._lower_path(path))
+                    if name not in seen and
+                    prefix + name not in self._whiteouts)
+        return iter(entries)
+
+    def statvfs(self, path):
+        with self._lock:
+            self.stat(path)
+            return self.lower.statvfs(self.base)
+
+    @staticmethod
+    def _normalize(path):
+        return posixpath.normpath("/" + path).replace("//", "/")
+
+    def _lower_path(self, path):
+        return os.path.join(self.base, path.lstrip("/"))
+
+    def _in_upper(self, path):
+        try:
+            self.upper.lstat(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _in_lower(self, path):
+        # Whiteouts hide the entry they were made for, and all below it.
+        current = ""
+        for name in path.split("/")[1:]:
+            current += "/" + name
+            if current in self._whiteouts:
+                return False
+        try:
+            self.lower.lstat(self._lower_path(path))
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        return True
+
+    def _layer(self, path):
+        # Returns the layer `path` is served from, if any.
+        if self._in_upper(path):
+            return self.upper
+        if self._in_lower(path):
+            return self.lower
+        return None
+
+    def _follow(self, path):
+        # Resolves symbolic links in the upper layer, which may point to
+        # either layer.
+        path = self._normalize(path)
+        for _ in range(self.MAX_SYMLINKS):
+            if not self._in_upper(path):
+                return path
+            if not stat.S_ISLNK(self.upper.lstat(path).st_mode):
+                return path
+            target = self.upper.readlink(path)
+            path = self._normalize(
+                posixpath.join(posixpath.dirname(path), target))
+        raise _error(errno.ELOOP, path)
+
+    def _check_parent(self, path):
+        parent = posixpath.dirname(path)
+        if not stat.S_ISDIR(self.stat(parent).st_mode):
+            raise _error(errno.ENOTDIR, path)
+
+    def _create(self, path):
+        # Prepares the upper layer for a new entry at `path`.
+        path = self._normalize(path)
+        if self._layer(path) is not None:
+            raise _error(errno.EEXIST, path)
+        self._copy_up_parents(path)
+        return path
+
+    def _delete(self, path):
+        if self._in_upper(path):
+            if stat.S_ISDIR(self.upper.lstat(path).st_mode):
+                self.upper.rmdir(path)
+            else:
+                self.upper.remove(path)
+        if self._in_lower(path):
+            self._whiteouts.add(path)
+
+    def _copy_up_parents(self, path):
+        self._check_parent(path)
+        current = ""
+        for name in path.split("/")[1:-1]:
+            current += "/" + name
+            self._copy_up(current)
+
+    def _copy_up(self, path, follow=False, empty=False):
+        # Copies `path` to the upper layer, unless it is already there. With
+        # `empty`, a file's contents are left behind.
+        if path == "/" or self._in_upper(path):
+            return
+        if not self._in_lower(path):
+            raise _error(errno.ENOENT, path)
+        self._copy_up_parents(path)
+        lower_path = self._lower_path(path)
+        st = self.lower.stat(lower_path) if follow else \
+            self.lower.lstat(lower_path)
+        mode = stat.S_IMODE(st.st_mode)
+        if stat.S_ISDIR(st.st_mode):
+            self.upper.mkdir(path, mode)
+        elif stat.S_ISLNK(st.st_mode):
+            self.upper.symlink(self.lower.readlink(lower_path), path)
+            return
+        elif empty:
+            self.upper.open(path, os.O_WRONLY | os.O_CREAT, mode).close()
+        else:
+            src = self.lower.open(lower_path, os.O_RDONLY)
+            try:
+                dst = self.upper.open(path, os.O_WRONLY | os.O_CREAT, mode)
+                copy_range(src, 0, dst, 0)
+                dst.close()
+            finally:
+                src.close()
+        self.upper.chmod(path, mode)
+
+    def _copy_up_tree(self, path):
+        self._copy_up(path)
+        if stat.S_ISDIR(self.upper.lstat(path).st_mode):
+            for name, _ in self.scandir(path):
+                self._copy_up_tree(posixpath.join(path, name))
+
+
+class RootedFilesystem(Filesystem):
+    """Serves the directory `root` of `fs`, as if it were the whole tree.
+
+    Client paths are resolved from `root`, and `..` never leads out of it.
+    With `symlinks` set to `"contain"`, symbolic links are followed as
+    under chroot(2): absolute targets are taken from `root` too. With
+    `"refuse"`, following any link fails with `EACCES`.
+
+    Up to `cache_size` resolved paths are kept, least recently used first
+    out. Only existing paths involving no links and no `..` are cached,
+    with the device and inode they led to. Hits are checked against an
+    `lstat` of the cached path, so that changes made elsewhere, such as
+    a directory on the way replaced by a link, are not followed. Paths
+    are also dropped when an entry on their way is renamed, removed, or
+    replaced by a link through this object.
+    """
+
+    MAX_SYMLINKS = 40
+
+    def __init__(self, fs: Filesystem, root: str, symlinks: str = "contain",
+                 cache_size: int = 1024) -> None:
+        if symlinks not in ("contain", "refuse"):
+            raise ValueError("Unknown symlink policy {}".format(symlinks))
+        self.fs = fs
+        self.root = root.rstrip("/")
+        self.symlinks = symlinks
+        self.cache_size = cache_size
+        self.stats = collections.Counter()
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+
+    @property
+    def process_shared(self):
+        return self.fs.process_shared
+
+    def open(self, path, flags, mode=0o777):
+        return self.fs.open(self._resolve(path), flags, mode)
+
+    def stat(self, path):
+        return self.fs.stat(self._resolve(path))
+
+    def lstat(self, path):
+        return self.fs.lstat(self._resolve(path, follow=False))
+
+    def readlink(self, path):
+        return self.fs.readlink(self._resolve(path, follow=False))
+
+    def symlink(self, target, path):
+        self.fs.symlink(target, self._resolve(path, follow=False))
+        self.invalidate(path)
+
+    def remove(self, path):
+        self.fs.remove(self._resolve(path, follow=False))
+        self.invalidate(path)
+
+    def mkdir(self, path, mode=0o777):
+        self.fs.mkdir(self._resolve(path, follow=False), mode)
+
+    def rmdir(self, path):
+        self.fs.rmdir(self._resolve(path, follow=False))
+        self.invalidate(path)
+
+    def chmod(self, path, mode):
+        self.fs.chmod(self._resolve(path), mode)
+
+    def chown(self, path, uid, gid):
+        self.fs.chown(self._resolve(path), uid, gid)
+
+    def utime(self, path, times):
+        self.fs.utime(self._resolve(path), times)
+
+    def rename(self, src, dst):
+        self.fs.rename(self._resolve(src, follow=False),
+                       self._resolve(dst, follow=False))
+        self.invalidate(src)
+        self.invalidate(dst)
+
+    def scandir(self, path):
+        return self.fs.scandir(self._resolve(path))
+
+    def statvfs(self, path):
+        return self.fs.statvfs(self._resolve(path))
+
+    def invalidate(self, path: str) -> None:
+        """Forgets the cached paths at and below `path`."""
+        path = self._normalize(path)
+        prefix = path.rstrip("/") + "/"
+        with self._lock:
+            stale = [key for key in self._cache
+                     if key[0] == path or key[0].startswith(prefix)]
+            for key in stale:
+                del self._cache[key]
+
+    @staticmethod
+    def _normalize(path):
+        return "/" + "/".join(p for p in path.split("/") if p not in ("", "."))
+
+    def _resolve(self, path, follow=True):
+        # Returns the path in `fs` the client `path` stands for.
+        key = (self._normalize(path), follow)
+        with self._lock:
+            cached = self._cache.get(key)
+        if cached is not None and self._identity(cached[0]) == cached[1]:
+            with self._lock:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                self.stats["hits"] += 1
+            return cached[0]
+        with self._lock:
+            self.stats["misses"] += 1
+        resolved, cacheable = self._walk(key[0], follow)
+        identity = self._identity(resolved) if cacheable else None
+        if identity is not None and self.cache_size:
+            with self._lock:
+                self._cache[key] = (resolved, identity)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return resolved
+
+    def _identity(self, resolved):
+        # What a cached path must still lead to, or None if nothing.
+        try:
+            st = self.fs.lstat(resolved)
+        except OSError:
+            return None
+        return st.st_dev, st.st_ino
+
+    def _walk(self, path, follow):
+        parts = collections.deque(path.split("/"))
+        current = []
+        links = 0
+        cacheable = True
+        missing = False
+        while parts:
+            name = parts.popleft()
+            if name in ("", "."):
+                continue
+            if name == "..":
+                cacheable = False
+                if current:
+                    current.pop()
+                continue
+            current.append(name)
+            if missing:
+                continue
+            try:
+                st = self.fs.lstat(self._real(current))
+            except (FileNotFoundError, NotADirectoryError):
+                # Left for the operation itself to report.
+                missing = True
+                continue
+            if not stat.S_ISLNK(st.st_mode) or not (parts or follow):
+                continue
+            if self.symlinks == "refuse":
+                raise _error(errno.EACCES, path)
+            links += 1
+            if links > self.MAX_SYMLINKS:
+                raise _error(errno.ELOOP, path)
+            cacheable = False
+            target = self.fs.readlink(self._real(current))
+            current.pop()
+            if target.startswith("/"):
+                del current[:]
+            parts.extendleft(reversed(target.split("/")))
+        return self._real(current), cacheable
+
+    def _real(self, parts):
+        return self.root + "/" + "/".join(parts)
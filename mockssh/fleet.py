@@ -0,0 +1,73 @@
+import logging
+import selectors
+import threading
+
+from mockssh.server import Server
+from typing import Dict, Iterator, List, Tuple
+
+__all__ = [
+    "ServerFleet",
+]
+
+
+class ServerFleet(object):
+    """A context manager running `size` servers, as if they were many hosts.
+
+    All servers share the same users, user keys, host key and emulated
+    commands, and a single thread accepts connections for all of them.
+    Keyword arguments are passed on to each `Server`.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, users: Dict[str, str], size: int, **kwargs) -> None:
+        if kwargs.get("engine", "threading") != "threading":
+            raise ValueError("ServerFleet only supports the threading engine")
+        if kwargs.get("processes", 1) != 1:
+            raise ValueError("ServerFleet only runs in a single process")
+        first = Server(users, **kwargs)
+        self.servers = [first]
+        for _ in range(size - 1):
+            self.servers.append(Server({}, peer=first, **kwargs))
+        self._thread = None
+        self._running = False
+
+    def __enter__(self) -> "ServerFleet":
+        for s in self.servers:
+            s._listen()
+        self._running = True
+        self._thread = t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+        return self
+
+    def _run(self):
+        with selectors.DefaultSelector() as selector:
+            for s in self.servers:
+                selector.register(s._socket, selectors.EVENT_READ, data=s)
+            while self._running:
+                self.log.debug("Waiting for incoming connections ...")
+                for key, _ in selector.select(timeout=1.0):
+                    if not self._running:
+                        break
+                    if not key.data._accept(key.fileobj):
+                        selector.unregister(key.fileobj)
+
+    def __exit__(self, *exc_info) -> None:
+        self._running = False
+        for s in self.servers:
+            s.__exit__(*exc_info)
+        self._thread = None
+
+    def __len__(self) -> int:
+        return len(self.servers)
+
+    def __iter__(self) -> Iterator[Server]:
+        return iter(self.servers)
+
+    def __getitem__(self, index: int) -> Server:
+        return self.servers[index]
+
+    @property
+    def addresses(self) -> List[Tuple[str, int]]:
+        return [(s.host, s.port) for s in self.servers]
@@ -0,0 +1,404 @@
+import collections
+import errno
+import logging
+import os
+import selectors
+import socket
+import threading
+import time
+
+from mockssh.metrics import Metrics
+from typing import Optional, Tuple
+
+__all__ = [
+    "ForwardingRelay",
+]
+
+# What `connect_ex` returns for a connection under way, or made at once.
+_CONNECTING = {0, errno.EINPROGRESS, errno.EWOULDBLOCK,
+               getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK)}
+
+
+class _Tunnel(object):
+
+    def __init__(self, channel, destination):
+        self.channel = channel
+        self.destination = destination
+        self.name = "{}:{}".format(*destination)
+        self.sock = None
+        # Addresses of the destination left to try, and the last error.
+        self.addresses = collections.deque()
+        self.connecting = True
+        self.deadline = None
+        self.error = None
+        self.created = time.perf_counter()
+        self.started = None
+        # Data read from one side, not yet written to the other.
+        self.to_sock = None
+        self.to_channel = None
+        self.channel_eof = False
+        self.sock_eof = False
+        self.sock_shut = False
+        self.channel_shut = False
+        self.counts = collections.Counter()
+
+
+class ForwardingRelay(object):
+    """Relays data between SSH channels and the sockets they forward to.
+
+    All tunnels are served by a single thread, waiting on one selector for
+    either end of any tunnel to be readable, and the socket end to be
+    writable. A side is only read from once what was read from it before
+    went through, so that a slow reader holds up the sender: through the
+    channel window on one side, and the TCP window on the other. End of
+    file is passed on in either direction, and tunnels are closed once both
+    are done.
+
+    Destinations are connected to without blocking, from the relay thread,
+    and channels only read from once connected. Should the connection
+    fail, the channel is closed.
+
+    Each tunnel is recorded in `metrics` as a `"forward"` event named after
+    its destination, with the bytes it moved each way, or as `failed` if it
+    could not connect.
+    """
+
+    log = logging.getLogger(__name__)
+
+    # Bytes read from either side at a time.
+    BUFFER_SIZE = 256 * 1024
+
+    # Channels have no file descriptor to wait on for their window to open.
+    # Tunnels waiting for one are retried this often.
+    POLL_INTERVAL = 0.005
+
+    # Seconds given to connect to each address of a destination.
+    CONNECT_TIMEOUT = 10.0
+
+    def __init__(self, metrics: Optional[Metrics] = None) -> None:
+        self.metrics = metrics or Metrics()
+        self._lock = threading.Lock()
+        self._added = []
+        self._tunnels = set()
+        self._selector = None
+        self._wakeup = None
+        self._thread = None
+        self._running = False
+
+    def add(self, channel, destination: Tuple[str, int]) -> None:
+        """Connects to `destination`, and relays between it and `channel`.
+
+        Both ends are closed once the tunnel is done. Safe to call from any
+        thread, without blocking: host names are looked up on a thread of
+        their own.
+        """
+        channel.settimeout(0.0)
+        tunnel = _Tunnel(channel, destination)
+        host, port = destination
+        try:
+            addresses = socket.getaddrinfo(host, port,
+                                           type=socket.SOCK_STREAM,
+                                           flags=socket.AI_NUMERICHOST)
+        except socket.gaierror:
+            t = threading.Thread(target=self._resolve, args=(tunnel,),
+                                 name="mockssh-resolve")
+            t.daemon = True
+            t.start()
+            return
+        self._queue(tunnel, addresses)
+
+    def stop(self) -> None:
+        """Closes all tunnels, and stops the relay thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._running = False
+        if thread is None:
+            return
+        self._wake()
+        thread.join()
+
+    def __len__(self) -> int:
+        return len(self._tunnels)
+
+    def _resolve(self, tunnel):
+        try:
+            addresses = socket.getaddrinfo(*tunnel.destination,
+                                           type=socket.SOCK_STREAM)
+        except OSError as ex:
+            tunnel.error = ex
+            self.log.debug("Cannot forward to %s: %s", tunnel.name, ex)
+            self._record(tunnel)
+            try:
+                tunnel.channel.close()
+            except EOFError:
+                pass
+            return
+        self._queue(tunnel, addresses)
+
+    def _queue(self, tunnel, addresses):
+        tunnel.addresses.extend(addresses)
+        with self._lock:
+            self._added.append(tunnel)
+            if self._thread is None:
+                self._start()
+        self._wake()
+
+    def _start(self):
+        self._selector = selectors.DefaultSelector()
+        self._wakeup = socket.socketpair()
+        for s in self._wakeup:
+            s.setblocking(False)
+        self._selector.register(self._wakeup[0], selectors.EVENT_READ)
+        self._running = True
+        self._thread = t = threading.Thread(target=self._run,
+                                            name="mockssh-forwarding")
+        t.daemon = True
+        t.start()
+
+    def _wake(self):
+        try:
+            self._wakeup[1].send(b"\0")
+        except (BlockingIOError, OSError):
+            # Already woken up, or stopped.
+            pass
+
+    def _run(self):
+        selector = self._selector
+        try:
+            while self._running:
+                self._add_tunnels(connect=True)
+                blocked = [t for t in self._tunnels if t.to_channel]
+                timeout = self.POLL_INTERVAL if blocked else None
+                connecting = [t for t in self._tunnels if t.connecting]
+                if connecting:
+                    wait = max(min(t.deadline for t in connecting) -
+                               time.perf_counter(), 0.0)
+                    timeout = wait if timeout is None else min(timeout, wait)
+                for key, events in selector.select(timeout):
+                    if key.data is None:
+                        self._drain_wakeup()
+                        continue
+                    tunnel, side = key.data
+                    if tunnel not in self._tunnels:
+                        continue
+                    if side == "channel":
+                        self._read_channel(tunnel)
+                    elif tunnel.connecting:
+                        self._connected(tunnel)
+                    else:
+                        if events & selectors.EVENT_WRITE:
+                            self._write_sock(tunnel)
+                        if (events & selectors.EVENT_READ and
+                                tunnel in self._tunnels):
+                            self._read_sock(tunnel)
+                    self._update(tunnel)
+                for tunnel in blocked:
+                    if tunnel in self._tunnels:
+                        self._write_channel(tunnel)
+                        self._update(tunnel)
+                now = time.perf_counter()
+                for tunnel in connecting:
+                    if (tunnel in self._tunnels and tunnel.connecting and
+                            now >= tunnel.deadline):
+                        self._retry(tunnel, socket.timeout("timed out"))
+        finally:
+            self._add_tunnels(connect=False)
+            for tunnel in list(self._tunnels):
+                self._close(tunnel)
+            selector.close()
+            for s in self._wakeup:
+                s.close()
+
+    def _add_tunnels(self, connect):
+        with self._lock:
+            added, self._added = self._added, []
+        for tunnel in added:
+            self.log.debug("Forwarding %s to %s", tunnel.channel, tunnel.name)
+            self._tunnels.add(tunnel)
+            if connect:
+                self._connect(tunnel)
+
+    def _connect(self, tunnel):
+        # Tries the addresses of the destination in turn.
+        while tunnel.addresses:
+            family, kind, proto, _, address = tunnel.addresses.popleft()
+            try:
+                sock = socket.socket(family, kind, proto)
+            except OSError as ex:
+                tunnel.error = ex
+                continue
+            sock.setblocking(False)
+            error = sock.connect_ex(address)
+            if error in _CONNECTING:
+                tunnel.sock = sock
+                tunnel.deadline = time.perf_counter() + self.CONNECT_TIMEOUT
+                self._update(tunnel)
+                return
+            sock.close()
+            tunnel.error = OSError(error, os.strerror(error))
+        self.log.debug("Cannot forward %s to %s: %s", tunnel.channel,
+                       tunnel.name, tunnel.error)
+        self._close(tunnel)
+
+    def _connected(self, tunnel):
+        error = tunnel.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self._retry(tunnel, OSError(error, os.strerror(error)))
+            return
+        tunnel.connecting = False
+        tunnel.started = time.perf_counter()
+
+    def _retry(self, tunnel, error):
+        tunnel.error = error
+        self._watch(tunnel.sock, 0, None)
+        tunnel.sock.close()
+        tunnel.sock = None
+        self._connect(tunnel)
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup[0].recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _read_channel(self, tunnel):
+        try:
+            data = tunnel.channel.recv(self.BUFFER_SIZE)
+        except socket.timeout:
+            return
+        if not data:
+            tunnel.channel_eof = True
+            if tunnel.channel.closed:
+                self._close(tunnel)
+                return
+        else:
+            tunnel.counts["bytes_in"] += len(data)
+            tunnel.to_sock = memoryview(data)
+        self._write_sock(tunnel)
+
+    def _write_sock(self, tunnel):
+        try:
+            if tunnel.to_sock:
+                sent = tunnel.sock.send(tunnel.to_sock)
+                tunnel.to_sock = tunnel.to_sock[sent:]
+            if (tunnel.channel_eof and not tunnel.to_sock and
+                    not tunnel.sock_shut):
+                tunnel.sock_shut = True
+                tunnel.sock.shutdown(socket.SHUT_WR)
+        except BlockingIOError:
+            pass
+        except OSError as ex:
+            self.log.debug("Error writing to %s: %s", tunnel.name, ex)
+            self._close(tunnel)
+
+    def _read_sock(self, tunnel):
+        try:
+            data = tunnel.sock.recv(self.BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as ex:
+            self.log.debug("Error reading from %s: %s", tunnel.name, ex)
+            self._close(tunnel)
+            return
+        if not data:
+            tunnel.sock_eof = True
+        else:
+            tunnel.counts["bytes_out"] += len(data)
+            tunnel.to_channel = data
+        self._write_channel(tunnel)
+
+    def _write_channel(self, tunnel):
+        channel = tunnel.channel
+        try:
+            # Sends are cut into packets, each copied from a slice.
+            data = tunnel.to_channel
+            offset = 0
+            while data and offset < len(data) and channel.send_ready():
+                sent = channel.send(data[offset:offset + 65536])
+                if not sent:
+                    # The channel is closed.
+                    self._close(tunnel)
+                    return
+                offset += sent
+            if data:
+                tunnel.to_channel = data[offset:] or None
+            if (tunnel.sock_eof and not tunnel.to_channel and
+                    not tunnel.channel_shut):
+                tunnel.channel_shut = True
+                channel.shutdown_write()
+        except socket.timeout:
+            pass
+        except (EOFError, OSError) as ex:
+            self.log.debug("Error writing to %s: %s", channel, ex)
+            self._close(tunnel)
+
+    def _update(self, tunnel):
+        # Watches either side for what the tunnel is waiting for.
+        if tunnel not in self._tunnels:
+            return
+        if tunnel.connecting:
+            # The channel is left unread until there is somewhere to write.
+            self._watch(tunnel.sock, selectors.EVENT_WRITE, (tunnel, "sock"))
+            return
+        if tunnel.channel_shut and tunnel.sock_shut:
+            self._close(tunnel)
+            return
+        channel_events = 0
+        if not tunnel.channel_eof and not tunnel.to_sock:
+            channel_events = selectors.EVENT_READ
+        sock_events = 0
+        if not tunnel.sock_eof and not tunnel.to_channel:
+            sock_events |= selectors.EVENT_READ
+        if tunnel.to_sock:
+            sock_events |= selectors.EVENT_WRITE
+        self._watch(tunnel.channel, channel_events, (tunnel, "channel"))
+        self._watch(tunnel.sock, sock_events, (tunnel, "sock"))
+
+    def _watch(self, fileobj, events, data):
+        selector = self._selector
+        try:
+            key = selector.get_key(fileobj)
+        except KeyError:
+            key = None
+        if not events:
+            if key is not None:
+                selector.unregister(fileobj)
+        elif key is None:
+            selector.register(fileobj, events, data)
+        elif key.events != events:
+            selector.modify(fileobj, events, data)
+
+    def _close(self, tunnel):
+        if tunnel not in self._tunnels:
+            return
+        for fileobj in (tunnel.channel, tunnel.sock):
+            if fileobj is None:
+                continue
+            try:
+                self._selector.unregister(fileobj)
+            except (KeyError, ValueError):
+                pass
+        if tunnel.sock is not None:
+            tunnel.sock.close()
+        try:
+            tunnel.channel.close()
+        except EOFError:
+            pass
+        self.log.debug("Closed tunnel to %s", tunnel.name)
+        # Recorded before the tunnel is gone, for those waiting on `len`.
+        self._record(tunnel)
+        self._tunnels.discard(tunnel)
+
+    def _record(self, tunnel):
+        now = time.perf_counter()
+        if tunnel.connecting:
+            self.metrics.record("forward", tunnel.name,
+                                {"connect": now - tunnel.created}, failed=1)
+            return
+        self.metrics.record(
+            "forward", tunnel.name,
+            {"connect": tunnel.started - tunnel.created,
+             "duration": now - tunnel.started},
+            bytes_in=tunnel.counts["bytes_in"],
+            bytes_out=tunnel.counts["bytes_out"])
@@ -0,0 +1,175 @@
+import collections
+import copy
+import logging
+import math
+import threading
+
+from typing import Callable, Dict, Optional
+
+__all__ = [
+    "Histogram",
+    "Metrics",
+]
+
+
+class Histogram(object):
+    """Distribution of durations, in buckets doubling from a microsecond.
+
+    Percentiles are estimated as the upper bound of the bucket they fall in.
+    """
+
+    def __init__(self) -> None:
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds: float) -> None:
+        # Bucket `i` holds durations below 2**i microseconds.
+        self.buckets[max(math.frexp(seconds * 1e6)[1], 0)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other: "Histogram") -> None:
+        """Adds the durations recorded in `other`."""
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or value > self.max:
+                    self.max = value
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if seen >= rank:
+                return min(2.0 ** i / 1e6, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "buckets": {2.0 ** i / 1e6: n
+                        for i, n in sorted(self.buckets.items())},
+        }
+
+
+class _Entry(object):
+
+    def __init__(self):
+        self.count = 0
+        self.counters = collections.Counter()
+        self.timings = collections.defaultdict(Histogram)
+
+    def summary(self):
+        result = {"count": self.count}
+        result.update(self.counters)
+        for name, histogram in self.timings.items():
+            result[name] = histogram.summary()
+        return result
+
+
+class Metrics(object):
+    """Collects counts, byte volumes and latencies of what a server does.
+
+    Events are recorded per category (`"sftp"`, `"exec"`, `"connection"`)
+    and name within it, such as the SFTP operation or the command line.
+    Hooks added with `add_hook` are called with each event as it is
+    recorded.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._hooks = []
+
+    def record(self, category: str, name: str,
+               timings: Optional[Dict[str, float]] = None,
+               **counters: int) -> None:
+        """Records one event, with durations in seconds in `timings`."""
+        with self._lock:
+            entry = self._entries.get((category, name))
+            if entry is None:
+                entry = self._entries[category, name] = _Entry()
+            entry.count += 1
+            entry.counters.update(counters)
+            if timings:
+                for timing, seconds in timings.items():
+                    entry.timings[timing].add(seconds)
+            hooks = self._hooks
+        for hook in hooks:
+            try:
+                hook(category, name, timings or {}, counters)
+            except Exception:
+                self.log.error("Error in metrics hook %s", hook,
+                               exc_info=True)
+
+    def add_hook(self, hook: Callable) -> None:
+        """Calls `hook(category, name, timings, counters)` on each event."""
+        with self._lock:
+            self._hooks = self._hooks + [hook]
+
+    def remove_hook(self, hook: Callable) -> None:
+        with self._lock:
+            self._hooks = [h for h in self._hooks if h != hook]
+
+    def snapshot(self, reset: bool = False) -> dict:
+        """Returns `{category: {name: summary}}` for all events so far.
+
+        With `reset` set, also starts collecting afresh.
+        """
+        with self._lock:
+            entries = self._entries
+            if reset:
+                self._entries = {}
+            result = {}
+            for (category, name), entry in entries.items():
+                result.setdefault(category, {})[name] = entry.summary()
+        return result
+
+    def reset(self) -> None:
+        with self._lock:
+            self._entries = {}
+
+    def export(self, reset: bool = False) -> dict:
+        """Returns a copy of the events recorded so far, for `merge`."""
+        with self._lock:
+            entries = self._entries
+            if reset:
+                self._entries = {}
+            else:
+                entries = copy.deepcopy(entries)
+        return entries
+
+    def merge(self, entries: dict) -> None:
+        """Adds events exported by another collector."""
+        with self._lock:
+            for key, other in entries.items():
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = self._entries[key] = _Entry()
+                entry.count += other.count
+                entry.counters.update(other.counters)
+                for name, histogram in other.timings.items():
+                    entry.timings[name].merge(histogram)
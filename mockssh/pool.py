@@ -0,0 +1,116 @@
+import collections
+import logging
+import threading
+
+from typing import Callable, Dict, Optional
+
+__all__ = [
+    "WorkerPool",
+]
+
+
+class WorkerPool(object):
+    """Runs jobs on a bounded, reusable set of daemon threads.
+
+    At most `max_workers` jobs run at once (no limit if `None`), and at most
+    `max_queued` jobs wait for a free worker (no limit if 0). When the queue
+    is full, `submit` either rejects the job straight away (`overflow` set to
+    `"reject"`) or waits up to `timeout` seconds for room (`"block"`).
+    Callers which must not block, such as paramiko's transport threads, may
+    have jobs deferred instead: they join the queue as workers make room.
+    """
+
+    log = logging.getLogger(__name__)
+
+    # Seconds an idle worker waits for a new job before exiting.
+    IDLE_TIMEOUT = 60.0
+
+    def __init__(self, max_workers: Optional[int] = None, max_queued: int = 0,
+                 overflow: str = "block",
+                 timeout: Optional[float] = None) -> None:
+        if overflow not in ("block", "reject"):
+            raise ValueError("Unknown overflow policy {}".format(overflow))
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.overflow = overflow
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+        self._space = threading.Condition(self._lock)
+        self._jobs = collections.deque()
+        self._deferred = collections.deque()
+        self._workers = 0
+        self._idle = 0
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+
+    def submit(self, func: Callable, *args, defer: bool = False) -> bool:
+        """Schedules `func(*args)`. Returns `False` if the job was rejected.
+
+        With `defer` set, a job which would wait for room under the `"block"`
+        policy is set aside instead, without blocking the caller.
+        """
+        with self._lock:
+            if self.max_queued and not self._has_room():
+                if self.overflow == "block":
+                    if defer:
+                        self._deferred.append((func, args))
+                        return True
+                    self._space.wait_for(self._has_room, self.timeout)
+                if not self._has_room():
+                    self._rejected += 1
+                    return False
+            self._jobs.append((func, args))
+            if len(self._jobs) <= self._idle:
+                self._work.notify()
+            elif self.max_workers is None or self._workers < self.max_workers:
+                self._workers += 1
+                t = threading.Thread(target=self._worker)
+                t.daemon = True
+                t.start()
+            return True
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "workers": self._workers,
+                "idle": self._idle,
+                "running": self._running,
+                "queued": len(self._jobs),
+                "deferred": len(self._deferred),
+                "completed": self._completed,
+                "rejected": self._rejected,
+            }
+
+    def _has_room(self):
+        return len(self._jobs) < self.max_queued
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+                try:
+                    while not self._jobs:
+                        if (not self._work.wait(self.IDLE_TIMEOUT) and
+                                not self._jobs):
+                            self._workers -= 1
+                            return
+                    func, args = self._jobs.popleft()
+                finally:
+                    self._idle -= 1
+                self._running += 1
+                if self._deferred:
+                    # Deferred jobs take up the room first.
+                    self._jobs.append(self._deferred.popleft())
+                else:
+                    self._space.notify()
+            try:
+                func(*args)
+            except Exception:
+                self.log.error("Error running %s%s", func, args,
+                               exc_info=True)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
@@ -0,0 +1,494 @@
+import errno
+import fnmatch
+import functools
+import getopt
+import logging
+import os
+import posixpath
+import re
+import shlex
+import stat
+
+from mockssh.commands import decode_command
+from mockssh.filesystem import Filesystem
+from typing import Callable, List, Optional, Set, Tuple, Union
+
+__all__ = [
+    "ScpCommand",
+]
+
+
+class ScpError(Exception):
+    """A failed transfer, reported to the client as `message`.
+
+    Fatal errors end the session; others only skip the file at hand.
+    """
+
+    def __init__(self, message, fatal=False):
+        super(ScpError, self).__init__(message)
+        self.message = message
+        self.fatal = fatal
+
+
+def _describe(path, e):
+    return "{}: {}".format(path, e.strerror or e)
+
+
+# Characters making a word a glob pattern.
+_GLOB = re.compile(r"[*?[]")
+
+
+def _unquote(word):
+    if len(word) > 1 and word[0] == word[-1] and word[0] in "'\"":
+        return word[1:-1]
+    return word
+
+
+class _Session(object):
+    """One `scp -t` or `scp -f` run, over `channel`."""
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, channel, fs, chunk_size, recursive, preserve,
+                 directory):
+        self.channel = channel
+        self.fs = fs
+        self.chunk_size = chunk_size
+        self.recursive = recursive
+        self.preserve = preserve
+        self.directory = directory
+        self.buffer = b""
+        self.failed = False
+
+    def path(self, path):
+        return self.fs.normalize(path)
+
+    def expand(self, path):
+        """Returns the paths `path` stands for, once globbed by a shell.
+
+        Patterns matching nothing are kept as they are, as by `sh`.
+        """
+        if not _GLOB.search(path):
+            return [path]
+        parts = self.path(path).split("/")
+        found = [parts[0]]
+        for part in parts[1:]:
+            if not _GLOB.search(part):
+                found = [p + "/" + part for p in found]
+                continue
+            matches = []
+            for parent in found:
+                try:
+                    names = [n for n, _ in self.fs.scandir(parent or "/")]
+                except OSError:
+                    continue
+                matches.extend(
+                    parent + "/" + n for n in names
+                    if fnmatch.fnmatchcase(n, part) and
+                    (part.startswith(".") or not n.startswith(".")))
+            found = matches
+        found = sorted(p for p in found if self.exists(p))
+        return found or [path]
+
+    def exists(self, path):
+        try:
+            self.fs.lstat(path)
+        except OSError:
+            return False
+        return True
+
+    # Reading from the client.
+
+    def recv(self, n):
+        if self.buffer:
+            data, self.buffer = self.buffer[:n], self.buffer[n:]
+            return data
+        return self.channel.recv(n)
+
+    def readline(self):
+        while b"\n" not in self.buffer:
+            data = self.channel.recv(4096)
+            if not data:
+                if self.buffer:
+                    raise ScpError("unexpected end of input", fatal=True)
+                return None
+            self.buffer += data
+        line, _, self.buffer = self.buffer.partition(b"\n")
+        return line
+
+    def ack(self):
+        """Waits for the client to acknowledge what was sent.
+
+        Returns `False` if the client warned of an error instead.
+        """
+        code = self.recv(1)
+        if code == b"\0":
+            return True
+        if not code:
+            raise ScpError("lost connection", fatal=True)
+        message = (self.readline() or b"").decode("utf-8", "replace")
+        if code != b"\1":
+            raise ScpError(message, fatal=True)
+        self.log.debug("scp client: %s", message)
+        self.failed = True
+        return False
+
+    # Writing to the client.
+
+    def send(self, data):
+        # `Channel.sendall` copies what is left of its data after each
+        # packet. Slices of a packet or so are sent instead.
+        offset = 0
+        while offset < len(data):
+            sent = self.channel.send(data[offset:offset + 32768])
+            if not sent:
+                raise ScpError("lost connection", fatal=True)
+            offset += sent
+
+    def ok(self):
+        self.send(b"\0")
+
+    def warn(self, message):
+        self.failed = True
+        self.log.debug("scp: %s", message)
+        self.send(b"\1scp: " + message.encode("utf-8", "surrogateescape") +
+                  b"\n")
+
+    def fatal(self, message):
+        self.failed = True
+        self.log.debug("scp: %s", message)
+        self.send(b"\2scp: " + message.encode("utf-8", "surrogateescape") +
+                  b"\n")
+
+    # Receiving files: `scp -t`.
+
+    def sink(self, target):
+        target = self.path(target)
+        try:
+            is_dir = stat.S_ISDIR(self.fs.stat(target).st_mode)
+        except OSError as e:
+            if self.directory:
+                self.fatal(_describe(target, e))
+                return
+            is_dir = False
+        if self.directory and not is_dir:
+            self.fatal("{}: Not a directory".format(target))
+            return
+        self.ok()
+        # Directories being received, innermost last: (path, is_dir, times)
+        # with `times` those to set once the directory is complete.
+        stack = [(target, is_dir, None)]
+        # (atime, mtime) from the last T record, for the next file or
+        # directory.
+        times = None
+        while True:
+            line = self.readline()
+            if line is None:
+                return
+            if not line:
+                raise ScpError("unexpected empty line", fatal=True)
+            kind, line = line[:1], line[1:].decode("utf-8", "surrogateescape")
+            if kind in (b"\1", b"\2"):
+                # Messages from the client.
+                self.failed = True
+                if kind == b"\2":
+                    return
+                continue
+            if kind == b"T":
+                times = self.times(line)
+                self.ok()
+                continue
+            if kind == b"E":
+                if len(stack) == 1:
+                    raise ScpError("unexpected E record", fatal=True)
+                path, _, dir_times = stack.pop()
+                try:
+                    self.set_times(path, dir_times)
+                except OSError as e:
+                    self.warn(_describe(path, e))
+                    continue
+                self.ok()
+                continue
+            if kind not in (b"C", b"D"):
+                raise ScpError("unexpected record {!r}".format(kind),
+                               fatal=True)
+            mode, size, name = self.header(line)
+            parent, parent_is_dir, _ = stack[-1]
+            path = posixpath.join(parent, name) if parent_is_dir else parent
+            record_times, times = times, None
+            if kind == b"D":
+                if not self.recursive:
+                    raise ScpError("received directory without -r",
+                                   fatal=True)
+                try:
+                    self.make_directory(path, mode)
+                except OSError as e:
+                    # The client then skips the directory.
+                    self.warn(_describe(path, e))
+                    continue
+                # Set last, as receiving entries changes the times.
+                stack.append((path, True, record_times))
+                self.ok()
+                continue
+            self.receive_file(path, mode, size, record_times)
+
+    @staticmethod
+    def header(line):
+        match = re.fullmatch(r"([0-7]{4}) (\d+) (.+)", line, re.S)
+        if match is None:
+            raise ScpError("protocol error: bad record", fatal=True)
+        name = match.group(3)
+        if "/" in name or name in (".", ".."):
+            raise ScpError("protocol error: unexpected filename: {}"
+                           .format(name), fatal=True)
+        return int(match.group(1), 8), int(match.group(2)), name
+
+    @staticmethod
+    def times(line):
+        match = re.fullmatch(r"(\d+) (\d+) (\d+) (\d+)", line)
+        if match is None:
+            raise ScpError("mtime.sec not delimited", fatal=True)
+        mtime, mtime_usec, atime, atime_usec = map(int, match.groups())
+        if mtime_usec >= 1000000 or atime_usec >= 1000000:
+            raise ScpError("protocol error: bad times", fatal=True)
+        return atime + atime_usec / 1e6, mtime + mtime_usec / 1e6
+
+    def set_times(self, path, times):
+        if times is not None:
+            self.fs.utime(path, times)
+
+    def make_directory(self, path, mode):
+        try:
+            st = self.fs.stat(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.fs.mkdir(path, mode | 0o700)
+            if self.preserve:
+                self.fs.chmod(path, mode)
+            return
+        if not stat.S_ISDIR(st.st_mode):
+            raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+        if self.preserve:
+            self.fs.chmod(path, mode)
+
+    def receive_file(self, path, mode, size, times=None):
+        try:
+            f = self.fs.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        except OSError as e:
+            # The client then skips the file.
+            self.warn(_describe(path, e))
+            return
+        self.ok()
+        error = None
+        offset = 0
+        try:
+            while offset < size:
+                data = self.recv(min(self.chunk_size, size - offset))
+                if not data:
+                    raise ScpError("lost connection", fatal=True)
+                if error is None:
+                    try:
+                        view = memoryview(data)
+                        written = offset
+                        while view:
+                            n = f.pwrite(view, written)
+                            view = view[n:]
+                            written += n
+                    except OSError as e:
+                        # The rest of the file is still read, and discarded.
+                        error = e
+                offset += len(data)
+        finally:
+            f.close()
+        if error is None:
+            try:
+                if self.preserve:
+                    self.fs.chmod(path, mode)
+                self.set_times(path, times)
+            except OSError as e:
+                error = e
+        self.ack()
+        if error is not None:
+            self.warn(_describe(path, error))
+        else:
+            self.ok()
+
+    # Sending files: `scp -f`.
+
+    def source(self, paths):
+        self.ack()
+        for path in paths:
+            self.send_path(self.path(path))
+
+    def send_path(self, path):
+        name = posixpath.basename(path.rstrip("/")) or "/"
+        try:
+            st = self.fs.stat(path)
+        except OSError as e:
+            self.warn(_describe(path, e))
+            return
+        if stat.S_ISDIR(st.st_mode):
+            if not self.recursive:
+                self.warn("{}: not a regular file".format(path))
+                return
+            self.send_directory(path, name, st)
+        elif stat.S_ISREG(st.st_mode):
+            self.send_file(path, name, st)
+        else:
+            self.warn("{}: not a regular file".format(path))
+
+    def send_times(self, st):
+        if not self.preserve:
+            return True
+        self.send("T{} 0 {} 0\n".format(int(st.st_mtime),
+                                          int(st.st_atime)).encode())
+        return self.ack()
+
+    def send_directory(self, path, name, st):
+        try:
+            entries = sorted(n for n, _ in self.fs.scandir(path))
+        except OSError as e:
+            self.warn(_describe(path, e))
+            return
+        if not self.send_times(st):
+            return
+        self.send("D{:04o} 0 {}\n".format(stat.S_IMODE(st.st_mode), name)
+                  .encode("utf-8", "surrogateescape"))
+        if not self.ack():
+            return
+        for entry in entries:
+            self.send_path(posixpath.join(path, entry))
+        self.send(b"E\n")
+        self.ack()
+
+    def send_file(self, path, name, st):
+        try:
+            f = self.fs.open(path, os.O_RDONLY)
+        except OSError as e:
+            self.warn(_describe(path, e))
+            return
+        error = None
+        try:
+            if not self.send_times(st):
+                return
+            size = st.st_size
+            self.send("C{:04o} {} {}\n".format(stat.S_IMODE(st.st_mode), size,
+                                               name)
+                      .encode("utf-8", "surrogateescape"))
+            if not self.ack():
+                return
+            offset = 0
+            while offset < size:
+                length = min(self.chunk_size, size - offset)
+                data = b""
+                if error is None:
+                    try:
+                        data = f.pread(length, offset)
+                    except OSError as e:
+                        error = e
+                if len(data) < length:
+                    # The file shrank, or could not be read: pad it to the
+                    # announced size, as the client expects.
+                    if error is None:
+                        error = OSError(errno.EIO, "file changed size", path)
+                    data += bytes(length - len(data))
+                self.send(data)
+                offset += length
+        finally:
+            f.close()
+        if error is not None:
+            self.warn(_describe(path, error))
+        else:
+            self.ok()
+        self.ack()
+
+
+class ScpCommand(object):
+    """Serves `scp -t` and `scp -f` in-process, from users' filesystems.
+
+    The remote end of an `scp` client copying files to (`-t`) or from
+    (`-f`) the server is emulated, with recursive copies (`-r`), modes
+    and times (`-p`) and the `-d` check. Files are streamed in chunks of
+    `CHUNK_SIZE` bytes, with positional reads and writes. Times are set
+    with `Filesystem.utime`.
+    """
+
+    log = logging.getLogger(__name__)
+
+    # Command lines served: any with a -t or -f option. Those relying on
+    # the shell for more than globs are left to the host's scp.
+    PATTERN = re.compile(r"scp(?:\s+-[dprv]+)*\s+-[dprv]*[tf][dfprtv]*"
+                         r"(?:\s+-[dfprtv]+)*\s+\S.*", re.S)
+
+    # Bytes read from, or written to, files at a time.
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, server) -> None:
+        self.server = server
+
+    def filesystem(self, channel) -> Filesystem:
+        uid = channel.get_transport().get_username()
+        return self.server.user_filesystem(uid)
+
+    def lookup(self, command: Union[str, bytes]) -> Optional[Callable]:
+        """Returns a function serving `command` on a channel, if it is an
+        `scp -t` or `scp -f` command.
+
+        The function takes the channel and returns the exit status. Glob
+        patterns are expanded against the user's filesystem. Commands with
+        `~`, `$` or backquotes, which the shell would expand from the
+        host's users and environment, are not served.
+        """
+        command = decode_command(command)
+        if self.PATTERN.fullmatch(command) is None or \
+                re.search(r"[~$`]", command):
+            return None
+        return functools.partial(self.run, command)
+
+    def run(self, command: str, channel) -> int:
+        try:
+            options, paths = self.parse(command)
+        except (getopt.GetoptError, ValueError) as e:
+            channel.sendall(b"\2scp: " + str(e).encode() + b"\n")
+            return 1
+        session = _Session(channel, self.filesystem(channel),
+                           self.CHUNK_SIZE, "-r" in options, "-p" in options,
+                           "-d" in options)
+        paths = [p for path in paths for p in session.expand(path)]
+        try:
+            if "-t" in options:
+                if len(paths) != 1:
+                    session.fatal("ambiguous target")
+                else:
+                    session.sink(paths[0])
+            else:
+                session.source(paths)
+        except ScpError as e:
+            self.log.debug("scp failed: %s", e.message)
+            session.failed = True
+            if e.fatal:
+                try:
+                    session.fatal(e.message)
+                except (EOFError, OSError):
+                    pass
+        return 1 if session.failed else 0
+
+    @staticmethod
+    def parse(command: str, posix: bool = os.name != "nt"
+              ) -> Tuple[Set[str], List[str]]:
+        """Returns the options and paths of an `scp -t` or `-f` command.
+
+        Unless `posix` is set, backslashes are kept, as in Windows paths,
+        rather than taken for escapes; quotes around words are removed.
+        """
+        words = shlex.split(command, posix=posix)
+        if not posix:
+            words = [_unquote(w) for w in words]
+        opts, paths = getopt.getopt(words[1:], "dfprtv")
+        options = {o for o, _ in opts}
+        if ("-t" in options) == ("-f" in options):
+            raise ValueError("expected one of -t or -f")
+        if not paths:
+            raise ValueError("no paths given")
+        return options, paths
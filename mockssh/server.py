@@ -1,18 +1,29 @@
 import errno
+import io
 import logging
 import os
+import pickle
 import selectors
 import socket
 import subprocess
 import threading
-from queue import Queue
+import time
 
 import paramiko
 
-from mockssh import sftp
+from mockssh import aio, sftp
+from mockssh.client import ClientPool, PooledClient
+from mockssh.commands import CommandRegistry, decode_command
+from mockssh.filesystem import Filesystem, LocalFilesystem, RootedFilesystem
+from mockssh.forwarding import ForwardingRelay
+from mockssh.metrics import Metrics
+from mockssh.pool import WorkerPool
+from mockssh.scp import ScpCommand
+from mockssh.shaping import FaultInjector, NetworkProfile, ShapedSocket
+from mockssh.sharding import Shard, fork_supported, reuseport_supported
 from mockssh.streaming import StreamTransfer
 from paramiko.client import SSHClient
-from typing import Dict
+from typing import Callable, Dict, Optional, Union
 
 __all__ = [
     "Server",
@@ -21,16 +32,66 @@ __all__ = [
 SERVER_KEY_PATH = os.path.join(os.path.dirname(__file__), "server-key")
 
 
+def load_key(private_key_path: str, keytype: str = "ssh-rsa") -> paramiko.PKey:
+    if keytype == "ssh-rsa":
+        return paramiko.RSAKey.from_private_key_file(private_key_path)
+    elif keytype == "ssh-dss":
+        return paramiko.DSSKey.from_private_key_file(private_key_path)
+    elif keytype in paramiko.ECDSAKey.supported_key_format_identifiers():
+        return paramiko.ECDSAKey.from_private_key_file(private_key_path)
+    elif keytype == "ssh-ed25519":
+        return paramiko.Ed25519Key.from_private_key_file(private_key_path)
+    else:
+        raise Exception("Unable to handle key of type {}".format(keytype))
+
+
+def generate_ed25519_key() -> paramiko.Ed25519Key:
+    """Returns a new Ed25519 key, generated in memory."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519
+
+    pem = ed25519.Ed25519PrivateKey.generate().private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.OpenSSH,
+        serialization.NoEncryption())
+    return paramiko.Ed25519Key(file_obj=io.StringIO(pem.decode("ascii")))
+
+
+class Transport(paramiko.Transport):
+    """A server transport, handing forwarded channels to the handler.
+
+    `_queue_incoming_channel` is private to paramiko, and has no public
+    counterpart under the asyncio engine, which does not wait on `accept`.
+    It is called for each channel a client opens from paramiko 1.10 on.
+    """
+
+    def _queue_incoming_channel(self, channel):
+        if not self.server_object.forward(channel):
+            super(Transport, self)._queue_incoming_channel(channel)
+
+
 class Handler(paramiko.ServerInterface):
     log = logging.getLogger(__name__)
 
     def __init__(self, server, client_conn):
         self.server = server
         self.thread = None
-        self.command_queues = {}
+        self.forwards = {}
+        # Channels accepted from the transport, which only keeps weak
+        # references to them, by id. Closed ones are dropped as others come.
+        self.channels = {}
+        self._channels_lock = threading.Lock()
+        self.accepted = time.perf_counter()
+        self.auth_started = None
+        self.authenticated = False
         client, _ = client_conn
-        self.transport = t = paramiko.Transport(client)
-        t.add_server_key(paramiko.RSAKey(filename=SERVER_KEY_PATH))
+        # Small packets, such as the replies of request/response protocols
+        # run over channels, are not held back waiting for acknowledgements.
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if server.network is not None or server._user_networks:
+            client = ShapedSocket(client, server.network or NetworkProfile())
+        self.transport = t = Transport(client)
+        t.add_server_key(server._host_key)
         t.set_subsystem_handler("sftp", sftp.SFTPServer)
 
     def run(self):
@@ -39,21 +100,51 @@ class Handler(paramiko.ServerInterface):
             channel = self.transport.accept()
             if channel is None:
                 break
-            if channel.chanid not in self.command_queues:
-                self.command_queues[channel.chanid] = Queue()
-            t = threading.Thread(target=self.handle_client, args=(channel,))
-            t.daemon = True
-            t.start()
+            self._keep(channel)
+
+    def accept_channels(self) -> None:
+        """Takes the channels the client opened off the transport."""
+        while True:
+            channel = self.transport.accept(0)
+            if channel is None:
+                return
+            self._keep(channel)
 
-    def handle_client(self, channel):
+    def _keep(self, channel):
+        with self._channels_lock:
+            for chanid in [i for i, c in self.channels.items() if c.closed]:
+                del self.channels[chanid]
+            self.channels[channel.get_id()] = channel
+
+    def handle_client(self, channel, command):
         try:
-            command = self.command_queues[channel.chanid].get(block=True)
+            name = decode_command(command)
+            started = time.perf_counter()
+            emulated = self.server.emulated_command(command)
+            if emulated is not None:
+                status = emulated(channel)
+                self.server.metrics.record(
+                    "exec", name, {"runtime": time.perf_counter() - started},
+                    emulated=1)
+                channel.send_exit_status(status)
+                return
             self.log.debug("Executing %s", command)
             with subprocess.Popen(command, shell=True,
                                   stdin=subprocess.PIPE,
                                   stdout=subprocess.PIPE,
                                   stderr=subprocess.PIPE) as p:
-                StreamTransfer(channel, p).run()
+                spawned = time.perf_counter()
+                transfer = StreamTransfer(
+                    channel, p, buffer_size=self.server.buffer_size,
+                    flush_interval=self.server.flush_interval)
+                transfer.run()
+                self.server.metrics.record(
+                    "exec", name,
+                    {"spawn": spawned - started,
+                     "runtime": time.perf_counter() - spawned},
+                    stdin_bytes=transfer.counts["stdin"],
+                    stdout_bytes=transfer.counts["stdout"],
+                    stderr_bytes=transfer.counts["stderr"])
                 channel.send_exit_status(p.returncode)
         except Exception:
             self.log.error("Error handling client (channel: %s)", channel,
@@ -65,6 +156,7 @@ class Handler(paramiko.ServerInterface):
                 self.log.debug("Tried to close already closed channel")
 
     def check_auth_publickey(self, username, key):
+        self._auth_started()
         try:
             _, known_public_key = self.server._users[username]
         except KeyError:
@@ -72,22 +164,74 @@ class Handler(paramiko.ServerInterface):
             return paramiko.AUTH_FAILED
         if known_public_key == key:
             self.log.debug("Accepting public key for user '%s'", username)
+            self._auth_succeeded(username, "publickey")
             return paramiko.AUTH_SUCCESSFUL
         self.log.debug("Rejecting public ley for user '%s'", username)
         return paramiko.AUTH_FAILED
 
     def check_channel_exec_request(self, channel, command):
-        self.command_queues.setdefault(channel.get_id(), Queue()).put(command)
-        return True
+        self.accept_channels()
+        if self.server._engine is not None:
+            self.server._engine.exec_command(channel, command)
+            return True
+        # Transport threads must not block: with the "block" policy, commands
+        # beyond the queue wait for a worker without holding up the channels
+        # of the connection.
+        if self.server.workers.submit(self.handle_client, channel, command,
+                                      defer=True):
+            return True
+        self.log.debug("Rejecting %s: too many pending commands", command)
+        return False
+
+    def check_channel_subsystem_request(self, channel, name):
+        self.accept_channels()
+        return super(Handler, self).check_channel_subsystem_request(channel,
+                                                                    name)
 
     def check_channel_request(self, kind, chanid):
         if kind == "session":
             return paramiko.OPEN_SUCCEEDED
         return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
 
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        if not self.server.forwarding:
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        # Channel opens are answered on the transport thread: connecting is
+        # left to the relay, which closes the channel should it fail.
+        self.log.debug("Forwarding %s to %s", origin, destination)
+        self.forwards[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+    def forward(self, channel) -> bool:
+        """Relays `channel` if it forwards a connection. Returns if it does."""
+        destination = self.forwards.pop(channel.get_id(), None)
+        if destination is None:
+            return False
+        self.server.forwarder.add(channel, destination)
+        return True
+
     def get_allowed_auths(self, username):
+        self._auth_started()
         return "publickey"
 
+    def _auth_started(self):
+        # Authentication only starts once the key exchange is over.
+        if self.auth_started is None:
+            self.auth_started = time.perf_counter()
+
+    def _auth_succeeded(self, username, method):
+        # Public keys are checked twice: once when offered, once signed.
+        if self.authenticated:
+            return
+        self.authenticated = True
+        network = self.server._user_networks.get(username)
+        if network is not None:
+            self.transport.sock.set_profile(network)
+        self.server.metrics.record(
+            "connection", method,
+            {"handshake": self.auth_started - self.accepted,
+             "auth": time.perf_counter() - self.auth_started})
+
 
 class Server(object):
     host = "127.0.0.1"
@@ -95,81 +239,335 @@ class Server(object):
 
     log = logging.getLogger(__name__)
 
-    def __init__(self, users: Dict[str, str]) -> None:
+    def __init__(self, users: Dict[str, str],
+                 buffer_size: Optional[int] = StreamTransfer.CHUNK_SIZE,
+                 flush_interval: float = StreamTransfer.FLUSH_INTERVAL,
+                 engine: str = "threading",
+                 max_workers: Optional[int] = None,
+                 max_queued: int = 0,
+                 overflow: str = "block",
+                 host_key: Union[str, paramiko.PKey, None] = None,
+                 host_key_type: str = "ssh-rsa",
+                 filesystem: Optional[Filesystem] = None,
+                 network: Optional[NetworkProfile] = None,
+                 backlog: int = socket.SOMAXCONN,
+                 processes: int = 1,
+                 sftp_workers: int = 0,
+                 forwarding: bool = False,
+                 scp: bool = True,
+                 peer: Optional["Server"] = None) -> None:
+        """Sets up a server for `users`, mapping user names to the paths of
+        their private keys.
+
+        With `peer`, the server shares the users, user keys, host key and
+        emulated commands of that other server: `users` are added to both.
+        """
+        if engine not in ("threading", "asyncio"):
+            raise ValueError("Unknown engine {}".format(engine))
+        if processes > 1 and not fork_supported():
+            raise ValueError("Running in several processes requires fork()")
+        if processes > 1 and filesystem is not None and \
+                not filesystem.process_shared:
+            raise ValueError("Running in several processes requires a "
+                             "filesystem they share")
+        if processes > 1 and peer is not None:
+            raise ValueError("Servers sharing users with a peer run in a "
+                             "single process")
+        self.buffer_size = buffer_size
+        self.backlog = backlog
+        self.processes = processes
+        self.sftp_workers = sftp_workers
+        self.forwarding = forwarding
+        self._shards = []
+        self.flush_interval = flush_interval
+        self.engine = engine
+        self.workers = WorkerPool(max_workers, max_queued, overflow)
+        self._engine = None
+        if host_key is None:
+            host_key = SERVER_KEY_PATH if peer is None else peer._host_key
+        if not isinstance(host_key, paramiko.PKey):
+            host_key = load_key(host_key, host_key_type)
+        self._host_key = host_key
+        self.client_pool = ClientPool(self)
+        self.commands = CommandRegistry() if peer is None else peer.commands
+        # Served in-process, whether or not the host has scp. Kept out of
+        # `commands`, so that clearing them leaves scp alone.
+        self.scp = ScpCommand(self) if scp else None
+        self.metrics = Metrics()
+        self.forwarder = ForwardingRelay(self.metrics)
+        self._network = network
+        self.faults = FaultInjector()
+        self._filesystem = filesystem or LocalFilesystem()
         self._socket = None
         self._thread = None
-        self._users = {}
+        if peer is None:
+            self._users = {}
+            self._user_filesystems = {}
+            self._user_networks = {}
+        else:
+            self._users = peer._users
+            self._user_filesystems = peer._user_filesystems
+            self._user_networks = peer._user_networks
         for uid, private_key_path in users.items():
             self.add_user(uid, private_key_path)
 
-    def add_user(self, uid: str, private_key_path: str, keytype: str="ssh-rsa") -> None:
-        if keytype == "ssh-rsa":
-            key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        elif keytype == "ssh-dss":
-            key = paramiko.DSSKey.from_private_key_file(private_key_path)
-        elif keytype in paramiko.ECDSAKey.supported_key_format_identifiers():
-            key = paramiko.ECDSAKey.from_private_key_file(private_key_path)
-        elif keytype == "ssh-ed25519":
-            key = paramiko.Ed25519Key.from_private_key_file(private_key_path)
-        else:
-            raise Exception("Unable to handle key of type {}".format(keytype))
+    def add_user(self, uid: str, private_key_path: str, keytype: str="ssh-rsa",
+                 root: Optional[str] = None,
+                 network: Optional[NetworkProfile] = None,
+                 symlinks: str = "contain",
+                 cache_size: int = 1024) -> None:
+        """Adds a user, whose SFTP sessions are confined to `root` if set.
 
+        `root` is a directory of `filesystem`, served by a
+        `RootedFilesystem` with the given `symlinks` policy and
+        `cache_size`. Connections of the user are shaped by `network` once
+        authenticated, instead of by the server's `network`.
+        """
+        key = load_key(private_key_path, keytype)
+        rooted = None
+        if root is not None:
+            rooted = RootedFilesystem(self.filesystem, root, symlinks,
+                                      cache_size)
+        # Workers get the user first: it is only added here if they did.
+        args = (uid, private_key_path, keytype, root, network, symlinks,
+                cache_size)
+        if self._shards:
+            self._check_picklable(args, "Users added")
+        for shard in self._shards:
+            shard.call("add_user", *args)
         self._users[uid] = (private_key_path, key)
+        if rooted is not None:
+            self._user_filesystems[uid] = rooted
+        else:
+            self._user_filesystems.pop(uid, None)
+        if network is not None:
+            self._user_networks[uid] = network
+        else:
+            self._user_networks.pop(uid, None)
+
+    @property
+    def network(self) -> Optional[NetworkProfile]:
+        return self._network
+
+    @network.setter
+    def network(self, network: Optional[NetworkProfile]) -> None:
+        self._check_unsharded("network")
+        self._network = network
+
+    @property
+    def filesystem(self) -> Filesystem:
+        return self._filesystem
+
+    @filesystem.setter
+    def filesystem(self, filesystem: Filesystem) -> None:
+        self._check_unsharded("filesystem")
+        self._filesystem = filesystem
+
+    def _check_unsharded(self, what):
+        if self._shards:
+            raise RuntimeError("The {} of a server running in several "
+                               "processes cannot be changed".format(what))
+
+    def emulated_command(self, command: Union[str, bytes]
+                         ) -> Optional[Callable]:
+        """Returns a function serving `command` in-process, if any.
+
+        Commands registered in `commands` come first, then `scp`. The
+        function takes the channel and returns the exit status.
+        """
+        emulated = self.commands.lookup(command)
+        if emulated is None and self.scp is not None:
+            emulated = self.scp.lookup(command)
+        return emulated
+
+    def user_filesystem(self, uid: str) -> Filesystem:
+        """Returns the filesystem SFTP sessions of user `uid` are served."""
+        return self._user_filesystems.get(uid, self.filesystem)
 
     def __enter__(self) -> "Server":
-        self._socket = s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.bind((self.host, 0))
-        s.listen(5)
+        if self.processes > 1:
+            self._start_shards()
+            return self
+        self._listen()
+        self._start()
+        return self
+
+    def _start(self):
+        if self.engine == "asyncio":
+            self._engine = aio.AsyncioEngine(self)
+            self._engine.start()
+            return
         self._thread = t = threading.Thread(target=self._run)
         t.daemon = True
         t.start()
-        return self
+
+    def _start_shards(self):
+        # Connections are served by `processes` forked copies of the server,
+        # each with its own GIL. With SO_REUSEPORT, the socket kept here only
+        # reserves the port the workers listen on.
+        if reuseport_supported():
+            self._socket = s = socket.socket(socket.AF_INET,
+                                             socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            s.bind((self.host, 0))
+        else:
+            self._listen()
+        try:
+            for i in range(self.processes):
+                shard = Shard(self, i)
+                shard.start()
+                self._shards.append(shard)
+        except Exception:
+            self.__exit__()
+            raise
+        # Workers have their own copy of what was set up so far.
+        self.commands.add_hook(self._forward_commands)
+        self.faults.add_hook(self._refuse_faults)
+
+    def _forward_commands(self, method, args):
+        self._check_picklable(args, "Commands emulated")
+        for shard in self._shards:
+            shard.call("change_commands", method, args)
+
+    @staticmethod
+    def _check_picklable(args, what):
+        try:
+            pickle.dumps(args)
+        except Exception as e:
+            raise ValueError("{} once the server runs in several processes "
+                             "must be picklable".format(what)) from e
+
+    def _refuse_faults(self, method, args):
+        raise RuntimeError("The faults of a server running in several "
+                           "processes cannot be changed")
+
+    def _listen(self):
+        self._socket = s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind((self.host, 0))
+        s.listen(self.backlog)
+        # Accepts are drained until they would block.
+        s.setblocking(False)
 
     def _run(self):
         sock = self._socket
         selector = selectors.DefaultSelector()
-        selector.register(sock, selectors.EVENT_READ)
+        try:
+            selector.register(sock, selectors.EVENT_READ)
+        except ValueError:
+            # The server was shut down before we got here.
+            return
         while sock.fileno() > 0:
             self.log.debug("Waiting for incoming connections ...")
             events = selector.select(timeout=1.0)
-            if events:
-                try:
-                    conn, addr = sock.accept()
-                except OSError as ex:
-                    if ex.errno in (errno.EBADF, errno.EINVAL):
-                        break
-                    raise
-                self.log.debug("... got connection %s from %s", conn, addr)
-                handler = self.handler_cls(self, (conn, addr))
-                t = threading.Thread(target=handler.run)
-                t.daemon = True
-                t.start()
+            if events and not self._accept(sock):
+                break
 
-    def __exit__(self, *exc_info) -> None:
+    def _accept(self, sock) -> bool:
+        """Accepts all pending connections on `sock`.
+
+        Returns `False` once `sock` is closed.
+        """
+        while True:
+            try:
+                conn, addr = sock.accept()
+            except BlockingIOError:
+                return True
+            except OSError as ex:
+                if ex.errno in (errno.EBADF, errno.EINVAL):
+                    return False
+                raise
+            self.log.debug("... got connection %s from %s", conn, addr)
+            # Setting up the transport is left to the connection's thread,
+            # so that the next connection is accepted right away.
+            t = threading.Thread(target=self._serve, args=(conn, addr))
+            t.daemon = True
+            t.start()
+
+    def _serve(self, conn, addr):
+        conn.setblocking(True)
         try:
-            self._socket.shutdown(socket.SHUT_RDWR)
-            self._socket.close()
+            handler = self.handler_cls(self, (conn, addr))
         except Exception:
-            pass
+            self.log.error("Error setting up connection from %s", addr,
+                           exc_info=True)
+            conn.close()
+            return
+        try:
+            handler.run()
+        except (EOFError, OSError, paramiko.SSHException) as ex:
+            self.log.debug("Connection from %s failed: %s", addr, ex)
+
+    def __exit__(self, *exc_info) -> None:
+        shards, self._shards = self._shards, []
+        if shards:
+            self.commands.remove_hook(self._forward_commands)
+            self.faults.remove_hook(self._refuse_faults)
+        for shard in shards:
+            shard.stop()
+        if self._engine is not None:
+            self._engine.stop()
+            self._engine = None
+        self.client_pool.close()
+        self.forwarder.stop()
+        if self._socket is not None:
+            # With SO_REUSEPORT, the socket is bound but not listening, and
+            # cannot be shut down.
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            finally:
+                self._socket.close()
         self._socket = None
         self._thread = None
 
     def client(self, uid: str) -> SSHClient:
-        private_key_path, _ = self._users[uid]
+        _, private_key = self._users[uid]
         c = paramiko.SSHClient()
         host_keys = c.get_host_keys()
-        key = paramiko.RSAKey.from_private_key_file(SERVER_KEY_PATH)
-        host_keys.add(self.host, "ssh-rsa", key)
-        host_keys.add("[%s]:%d" % (self.host, self.port), "ssh-rsa", key)
+        key = self._host_key
+        host_keys.add(self.host, key.get_name(), key)
+        host_keys.add("[%s]:%d" % (self.host, self.port), key.get_name(), key)
         c.set_missing_host_key_policy(paramiko.RejectPolicy())
         c.connect(hostname=self.host,
                   port=self.port,
                   username=uid,
-                  key_filename=private_key_path,
+                  pkey=private_key,
                   allow_agent=False,
                   look_for_keys=False)
+        c.get_transport().sock.setsockopt(socket.IPPROTO_TCP,
+                                          socket.TCP_NODELAY, 1)
         return c
 
+    def pooled_client(self, uid: str) -> PooledClient:
+        """Like `client`, but reuses idle connections from `client_pool`.
+
+        Closing the returned client gives its connection back to the pool.
+        """
+        return self.client_pool.acquire(uid)
+
+    def stats(self, reset: bool = False) -> dict:
+        """Returns what the server did so far, as recorded in `metrics`.
+
+        The result maps `"sftp"`, `"exec"`, `"connection"` and `"forward"`
+        to summaries of each SFTP operation, command line, authentication
+        method and forwarding destination: event counts, byte counts and
+        latency histograms. With `reset` set,
+        also starts collecting afresh.
+        """
+        if not self._shards:
+            return self.metrics.snapshot(reset)
+        combined = Metrics()
+        combined.merge(self.metrics.export(reset))
+        for shard in self._shards:
+            combined.merge(shard.call("export_metrics", reset))
+        return combined.snapshot()
+
+    def reset_stats(self) -> None:
+        self.metrics.reset()
+        for shard in self._shards:
+            shard.call("reset_metrics")
+
     @property
     def port(self) -> int:
         return self._socket.getsockname()[1]
@@ -1,36 +1,280 @@
+import collections
+import hashlib
+import itertools
 import logging
 import os
-from errno import EACCES, EDQUOT, ENOENT, ENOTDIR, EPERM, EROFS
+import struct
+import threading
+import time
+from errno import EACCES, EDQUOT, ENOENT, ENOSYS, ENOTDIR, EPERM, EROFS
 
 import paramiko
-from typing import Callable
+from mockssh.filesystem import LocalFilesystem, copy_range
+from mockssh.metrics import Metrics
+from mockssh.pool import WorkerPool
+from mockssh.shaping import FaultInjector
+from paramiko.message import Message
+from paramiko.sftp import (CMD_CLOSE, CMD_DATA, CMD_EXTENDED,
+                           CMD_EXTENDED_REPLY, CMD_FSETSTAT, CMD_FSTAT,
+                           CMD_INIT, CMD_LSTAT, CMD_MKDIR, CMD_NAMES,
+                           CMD_OPEN, CMD_OPENDIR, CMD_READ, CMD_READDIR,
+                           CMD_READLINK, CMD_REALPATH, CMD_REMOVE, CMD_RENAME,
+                           CMD_RMDIR, CMD_SETSTAT, CMD_STAT, CMD_SYMLINK,
+                           CMD_VERSION, CMD_WRITE, SFTPError, _VERSION)
+from typing import Callable, Hashable, Iterable
 
 __all__ = [
     "SFTPServer",
 ]
 
 
+class ReadaheadCache(object):
+    """Reads ahead of sequential reads, in blocks of `block_size` bytes.
+
+    At most `max_blocks` blocks are kept, least recently used first out.
+    Requests served entirely from cached blocks count as hits in `stats`,
+    all others as misses. `invalidate` may be called from any thread: blocks
+    being read meanwhile are dropped rather than cached.
+    """
+
+    def __init__(self, pread, block_size, max_blocks, stats):
+        self.pread = pread
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.stats = stats
+        self.blocks = collections.OrderedDict()
+        self.next_offset = 0
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def read(self, offset, length):
+        sequential = offset == self.next_offset
+        self.next_offset = offset + length
+        first = offset // self.block_size
+        last = (offset + max(length, 1) - 1) // self.block_size
+        needed = range(first, last + 1)
+        with self._lock:
+            cached = all(i in self.blocks for i in needed)
+        if cached:
+            self.stats["hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            if not sequential:
+                return self.pread(offset, length)
+        if sequential and (len(needed) > self.max_blocks or
+                           not all(self._load(i) for i in needed)):
+            return self.pread(offset, length)
+        parts = []
+        with self._lock:
+            for i in needed:
+                if i not in self.blocks:
+                    # Invalidated since it was loaded.
+                    parts = None
+                    break
+                self.blocks.move_to_end(i)
+                start = offset - i * self.block_size
+                parts.append(self.blocks[i][max(start, 0):start + length])
+        if parts is None:
+            return self.pread(offset, length)
+        if sequential:
+            # Keep one block ahead of the reader.
+            self._load(last + 1)
+        return b"".join(parts)
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self.blocks.clear()
+
+    def _load(self, i):
+        with self._lock:
+            if i in self.blocks:
+                self.blocks.move_to_end(i)
+                return True
+            generation = self.generation
+        block = self.pread(i * self.block_size, self.block_size)
+        if len(block) < self.block_size:
+            # Past the end of the file, which may still grow.
+            return False
+        with self._lock:
+            if self.generation != generation:
+                # The file was written to while the block was read.
+                return False
+            self.blocks[i] = block
+            while len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+        return True
+
+
 class SFTPHandle(paramiko.SFTPHandle):
 
     log = logging.getLogger(__name__)
 
-    def __init__(self, file_obj, flags=0):
+    # Size and number of the blocks read ahead of sequential reads. Set
+    # `READAHEAD_BLOCKS` to 0 to disable readahead.
+    READAHEAD_SIZE = 256 * 1024
+    READAHEAD_BLOCKS = 4
+
+    # Readahead caches of all open handles, by (device, inode) of their
+    # file: writes through any handle invalidate those of all others.
+    _caches = collections.defaultdict(set)
+    _caches_lock = threading.Lock()
+
+    def __init__(self, file_obj, flags=0, readahead_stats=None):
         super(SFTPHandle, self).__init__(flags)
         self.file_obj = file_obj
+        self.readahead = None
+        self.file_id = None
+        if self.READAHEAD_BLOCKS and getattr(file_obj, "cacheable", False):
+            if readahead_stats is None:
+                readahead_stats = collections.Counter()
+            self.readahead = ReadaheadCache(self._pread, self.READAHEAD_SIZE,
+                                            self.READAHEAD_BLOCKS,
+                                            readahead_stats)
+            st = file_obj.stat()
+            self.file_id = (st.st_dev, st.st_ino)
+            with self._caches_lock:
+                self._caches[self.file_id].add(self.readahead)
+
+    def close(self):
+        if self.file_id is not None:
+            with self._caches_lock:
+                caches = self._caches[self.file_id]
+                caches.discard(self.readahead)
+                if not caches:
+                    del self._caches[self.file_id]
+        self.file_obj.close()
+
+    def read(self, offset, length):
+        # Positional reads: no seeks, and no copies through a file object's
+        # buffer.
+        try:
+            if self.readahead is not None:
+                return self.readahead.read(offset, length)
+            return self._pread(offset, length)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
 
-    @property
-    def readfile(self):
-        return self.file_obj
+    def _pread(self, offset, length):
+        return self.file_obj.pread(length, offset)
 
-    @property
-    def writefile(self):
-        return self.file_obj
+    def write(self, offset, data):
+        try:
+            view = memoryview(data)
+            while view:
+                written = self.file_obj.pwrite(view, offset)
+                view = view[written:]
+                offset += written
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        finally:
+            self.invalidate_readahead()
+        return paramiko.SFTP_OK
+
+    def invalidate_readahead(self):
+        """Drops what handles on the same file read ahead."""
+        if self.file_id is None:
+            return
+        with self._caches_lock:
+            caches = list(self._caches.get(self.file_id, ()))
+        for cache in caches:
+            cache.invalidate()
 
     def stat(self):
-        st = os.fstat(self.file_obj.fileno())
+        st = self.file_obj.stat()
         return paramiko.SFTPAttributes.from_stat(st)
 
 
+class FolderHandle(paramiko.SFTPHandle):
+    """A directory listing, produced lazily as the client reads it."""
+
+    # Entries sent per READDIR response.
+    BATCH_SIZE = 100
+
+    def __init__(self, entries):
+        super(FolderHandle, self).__init__()
+        self.entries = iter(entries)
+
+    def _get_next_files(self):
+        return list(itertools.islice(self.entries, self.BATCH_SIZE))
+
+    def close(self):
+        close = getattr(self.entries, "close", None)
+        if close is not None:
+            close()
+
+
+class RequestDispatcher(object):
+    """Runs requests on up to `workers` threads, in order where it matters.
+
+    Each request comes with keys, such as the handles or paths it operates
+    on. A request only starts once all earlier requests sharing one of its
+    keys are done, while requests without common keys run concurrently. At
+    most `max_pending` requests are waiting or running: `submit` blocks
+    until there is room.
+    """
+
+    def __init__(self, workers: int, max_pending: int) -> None:
+        self.pool = WorkerPool(workers)
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+        self._last = {}
+        self._pending = 0
+
+    def submit(self, keys: Iterable[Hashable], func: Callable,
+               *args) -> None:
+        request = _Request(set(keys), func, args)
+        with self._lock:
+            self._room.wait_for(lambda: self._pending < self.max_pending)
+            self._pending += 1
+            for key in request.keys:
+                previous = self._last.get(key)
+                if previous is not None and previous not in request.after:
+                    request.after.add(previous)
+                    previous.next.append(request)
+                self._last[key] = request
+            ready = not request.after
+        if ready:
+            self.pool.submit(self._run, request)
+
+    def join(self) -> None:
+        """Waits until all requests submitted so far are done."""
+        with self._lock:
+            self._room.wait_for(lambda: not self._pending)
+
+    def _run(self, request):
+        try:
+            request.func(*request.args)
+        finally:
+            ready = []
+            with self._lock:
+                for key in request.keys:
+                    if self._last.get(key) is request:
+                        del self._last[key]
+                for later in request.next:
+                    later.after.discard(request)
+                    if not later.after:
+                        ready.append(later)
+                self._pending -= 1
+                self._room.notify_all()
+            for later in ready:
+                self.pool.submit(self._run, later)
+
+
+class _Request(object):
+
+    __slots__ = ("keys", "func", "args", "after", "next")
+
+    def __init__(self, keys, func, args):
+        self.keys = keys
+        self.func = func
+        self.args = args
+        # Earlier requests this one waits for, and later ones waiting for it.
+        self.after = set()
+        self.next = []
+
+
 LOG = logging.getLogger(__name__)
 
 
@@ -47,6 +291,8 @@ def returns_sftp_error(func: Callable) -> Callable:
                 return paramiko.SFTP_PERMISSION_DENIED
             if errno in {ENOENT, ENOTDIR}:
                 return paramiko.SFTP_NO_SUCH_FILE
+            if errno == ENOSYS:
+                return paramiko.SFTP_OP_UNSUPPORTED
             return paramiko.SFTP_FAILURE
         except Exception as err:
             LOG.debug("Error calling %s(%s, %s): %s",
@@ -62,50 +308,64 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
 
     def __init__(self, server, *largs, **kwargs):
         super(SFTPServerInterface, self).__init__(server, *largs, **kwargs)
+        # `server` is the `mockssh.server.Handler` of the connection.
+        mock_server = getattr(server, "server", None)
+        if mock_server is not None:
+            uid = server.transport.get_username()
+            self.fs = mock_server.user_filesystem(uid)
+        else:
+            self.fs = LocalFilesystem()
+        self.readahead_stats = collections.Counter()
 
     def session_started(self):
         pass
 
     def session_ended(self):
-        pass
+        hits = self.readahead_stats["hits"]
+        reads = hits + self.readahead_stats["misses"]
+        if reads:
+            self.log.info("Readahead cache: %d hits in %d reads (%.1f%%)",
+                          hits, reads, 100.0 * hits / reads)
+
+    def canonicalize(self, path):
+        return self.fs.normalize(path)
 
     @returns_sftp_error
     def open(self, path, flags, attr):
-        fd = os.open(path, flags)
-        self.log.debug("open(%s): fd: %d", path, fd)
-        if flags & (os.O_WRONLY | os.O_RDWR):
-            mode = "w"
-        elif flags & (os.O_APPEND):
-            mode = "a"
-        else:
-            mode = "r"
-        mode += "b"
-        self.log.debug("open(%s): Mode: %s", path, mode)
-        return SFTPHandle(os.fdopen(fd, mode), flags)
+        mode = getattr(attr, "st_mode", None)
+        if mode is None:
+            mode = 0o777
+        f = self.fs.open(path, flags, mode)
+        self.log.debug("open(%s): %s", path, f)
+        return SFTPHandle(f, flags, self.readahead_stats)
 
     @returns_sftp_error
     def stat(self, path):
-        st = os.stat(path)
+        st = self.fs.stat(path)
         return paramiko.SFTPAttributes.from_stat(st, path)
 
     @returns_sftp_error
     def lstat(self, path):
-        st = os.lstat(path)
+        st = self.fs.lstat(path)
         return paramiko.SFTPAttributes.from_stat(st, path)
 
     @returns_sftp_error
     def symlink(self, src, dest):
         try:
-            os.symlink(src, dest)
+            self.fs.symlink(src, dest)
         except OSError as e:
             return SFTPServer.convert_errno(e.errno)
 
         return paramiko.SFTP_OK
 
+    @returns_sftp_error
+    def readlink(self, path):
+        return self.fs.readlink(path)
+
     @returns_sftp_error
     def remove(self, path):
         try:
-            os.remove(path)
+            self.fs.remove(path)
         except OSError as e:
             return SFTPServer.convert_errno(e.errno)
 
@@ -115,7 +375,7 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
     def mkdir(self, path, attrs):
         mode = getattr(attrs, 'st_mode', 0o777)
         try:
-            os.mkdir(path, mode)
+            self.fs.mkdir(path, mode)
         except OSError as e:
             return SFTPServer.convert_errno(e.errno)
 
@@ -124,7 +384,7 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
     @returns_sftp_error
     def rmdir(self, path):
         try:
-            os.rmdir(path)
+            self.fs.rmdir(path)
         except OSError as e:
             return SFTPServer.convert_errno(e.errno)
 
@@ -134,13 +394,19 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
     def chattr(self, path, attrs):
         if attrs.st_mode is not None:
             try:
-                os.chmod(path, attrs.st_mode)
+                self.fs.chmod(path, attrs.st_mode)
             except OSError as e:
                 return SFTPServer.convert_errno(e.errno)
 
         if attrs.st_uid is not None:
             try:
-                os.chown(path, attrs.st_uid, attrs.st_gid)
+                self.fs.chown(path, attrs.st_uid, attrs.st_gid)
+            except OSError as e:
+                return SFTPServer.convert_errno(e.errno)
+
+        if attrs.st_mtime is not None:
+            try:
+                self.fs.utime(path, (attrs.st_atime, attrs.st_mtime))
             except OSError as e:
                 return SFTPServer.convert_errno(e.errno)
 
@@ -149,31 +415,350 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
     @returns_sftp_error
     def rename(self, src, dst):
         try:
-            os.rename(src, dst)
+            self.fs.rename(src, dst)
         except OSError as e:
             return SFTPServer.convert_errno(e.errno)
 
         return paramiko.SFTP_OK
 
+    @returns_sftp_error
+    def statvfs(self, path):
+        return self.fs.statvfs(path)
+
     @returns_sftp_error
     def list_folder(self, path):
-        """Looks up folder contents of `path.`"""
-        # Inspired by https://github.com/rspivak/sftpserver/blob/0.3/src/sftpserver/stub_sftp.py#L70
-        try:
-            folder_contents = []
-            for f in os.listdir(path):
-                attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, f)))
-                attr.filename = f
-                folder_contents.append(attr)
-            return folder_contents
-        except OSError as e:
-            return SFTPServer.convert_errno(e.errno)
+        """Looks up folder contents of `path.`
+
+        Returns an iterator, which stats entries only as the client reads
+        them. Symbolic links are reported as links, not as their targets.
+        """
+        return self._attributes(self.fs.scandir(path))
+
+    @staticmethod
+    def _attributes(entries):
+        for name, st in entries:
+            yield paramiko.SFTPAttributes.from_stat(st, name)
 
 
 class SFTPServer(paramiko.SFTPServer):
+    """Serves SFTP, with a few protocol extensions.
+
+    Besides the version 3 protocol, it implements `check-file` and
+    `check-file-name` (server-side hashes of file ranges), `copy-data`
+    (server-side copies between open files) and `statvfs@openssh.com` and
+    `fstatvfs@openssh.com`.
+
+    Requests are handled one at a time, in the order they arrive, unless
+    the server has `sftp_workers` set. Requests are then handled by up to
+    that many threads, so that a client pipelining requests on several
+    files has their I/O overlap. Requests on the same handle or path are
+    still handled in the order they were sent.
+    """
+
+    log = logging.getLogger(__name__)
+
+    # Hash algorithms offered for `check-file`, in order of preference.
+    HASH_ALGORITHMS = ("sha256", "sha512", "sha384", "sha224", "sha1", "md5")
+
+    # Bytes read at a time while hashing.
+    HASH_CHUNK_SIZE = 1024 * 1024
+
+    # Requests read ahead of those handled, with `sftp_workers` set.
+    MAX_PENDING = 256
+
+    # Requests naming a handle, or one path, first.
+    HANDLE_REQUESTS = frozenset([CMD_CLOSE, CMD_READ, CMD_WRITE, CMD_FSTAT,
+                                 CMD_FSETSTAT, CMD_READDIR])
+    PATH_REQUESTS = frozenset([CMD_OPEN, CMD_LSTAT, CMD_SETSTAT, CMD_OPENDIR,
+                               CMD_REMOVE, CMD_MKDIR, CMD_RMDIR, CMD_REALPATH,
+                               CMD_STAT, CMD_READLINK])
 
     def __init__(self, channel, name, server, sftp_si=SFTPServerInterface,
                  *largs, **kwargs):
         kwargs["sftp_si"] = SFTPServerInterface
         super(SFTPServer, self).__init__(channel, name, server, *largs,
                                          **kwargs)
+        # `server` is the `mockssh.server.Handler` of the connection.
+        mock_server = getattr(server, "server", None)
+        self.metrics = getattr(mock_server, "metrics", None) or Metrics()
+        self.faults = getattr(mock_server, "faults", None)
+        if self.faults is None:
+            self.faults = FaultInjector()
+        self._local = threading.local()
+        self._handle_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._dispatcher = None
+        workers = getattr(mock_server, "sftp_workers", 0)
+        if workers:
+            self._dispatcher = RequestDispatcher(workers, self.MAX_PENDING)
+
+    @property
+    def _bytes(self):
+        # Bytes of file data moved by the request handled by this thread.
+        return getattr(self._local, "bytes", 0)
+
+    @_bytes.setter
+    def _bytes(self, value):
+        self._local.bytes = value
+
+    def finish_subsystem(self):
+        if self._dispatcher is not None:
+            self._dispatcher.join()
+        super(SFTPServer, self).finish_subsystem()
+
+    def _send_packet(self, t, packet):
+        with self._send_lock:
+            super(SFTPServer, self)._send_packet(t, packet)
+
+    def _send_handle_response(self, request_number, handle, folder=False):
+        with self._handle_lock:
+            super(SFTPServer, self)._send_handle_response(request_number,
+                                                          handle, folder)
+
+    def _open_folder(self, request_number, path):
+        resp = self.server.list_folder(path)
+        if isinstance(resp, int):
+            self._send_status(request_number, resp)
+            return
+        self._send_handle_response(request_number, FolderHandle(resp), True)
+
+    def _send_server_version(self):
+        t, data = self._read_packet()
+        if t != CMD_INIT:
+            raise SFTPError("Incompatible sftp protocol")
+        version = struct.unpack(">I", data[:4])[0]
+        msg = Message()
+        msg.add_int(_VERSION)
+        msg.add("check-file", ",".join(self.HASH_ALGORITHMS),
+                "check-file-name", ",".join(self.HASH_ALGORITHMS),
+                "copy-data", "1",
+                "statvfs@openssh.com", "2",
+                "fstatvfs@openssh.com", "2")
+        self._send_packet(CMD_VERSION, msg)
+        return version
+
+    def _process(self, t, request_number, msg):
+        if self._dispatcher is None:
+            return self._handle(t, request_number, msg)
+        self._dispatcher.submit(self._keys(t, msg), self._dispatch, t,
+                                request_number, msg)
+
+    def _dispatch(self, t, request_number, msg):
+        # Errors are handled as paramiko does for requests it handles itself.
+        try:
+            self._handle(t, request_number, msg)
+        except Exception:
+            self.log.debug("Error handling request %d", request_number,
+                           exc_info=True)
+            try:
+                self._send_status(request_number, paramiko.SFTP_FAILURE)
+            except Exception:
+                pass
+
+    def _keys(self, t, msg):
+        # What the request must stay in order with: the handles and paths it
+        # names.
+        start = msg.packet.tell()
+        try:
+            if t in self.HANDLE_REQUESTS:
+                return [("handle", msg.get_binary())]
+            if t in self.PATH_REQUESTS:
+                return [("path", msg.get_binary())]
+            if t in (CMD_RENAME, CMD_SYMLINK):
+                return [("path", msg.get_binary()), ("path", msg.get_binary())]
+            if t != CMD_EXTENDED:
+                return []
+            name = msg.get_text()
+            if name in ("check-file", "fstatvfs@openssh.com"):
+                return [("handle", msg.get_binary())]
+            if name in ("check-file-name", "statvfs@openssh.com"):
+                return [("path", msg.get_binary())]
+            if name == "posix-rename@openssh.com":
+                return [("path", msg.get_binary()), ("path", msg.get_binary())]
+            if name == "copy-data":
+                src = msg.get_binary()
+                msg.get_int64()
+                msg.get_int64()
+                return [("handle", src), ("handle", msg.get_binary())]
+            return []
+        finally:
+            msg.packet.seek(start)
+
+    def _handle(self, t, request_number, msg):
+        # Operations are recorded in `metrics` by request type, or extension
+        # name, with the bytes of file data they moved.
+        started = time.perf_counter()
+        start = msg.packet.tell()
+        name = CMD_NAMES.get(t, str(t))
+        handler = None
+        self._bytes = 0
+        if t == CMD_EXTENDED:
+            name = msg.get_text()
+            handler = self._extensions.get(name)
+            if handler is None:
+                msg.packet.seek(start)
+        elif t == CMD_WRITE:
+            msg.get_binary()
+            msg.get_int64()
+            self._bytes = len(msg.get_binary())
+            msg.packet.seek(start)
+        try:
+            if self.faults:
+                status = self.faults.apply(name)
+                if status is not None:
+                    self._send_status(request_number, status)
+                    return
+            if handler is not None:
+                return handler(self, request_number, msg)
+            return super(SFTPServer, self)._process(t, request_number, msg)
+        finally:
+            self.metrics.record("sftp", name,
+                                {"latency": time.perf_counter() - started},
+                                bytes=self._bytes)
+
+    def _response(self, request_number, t, *args):
+        if t == CMD_DATA:
+            self._bytes += len(args[0])
+        return super(SFTPServer, self)._response(request_number, t, *args)
+
+    def _file(self, request_number, handle):
+        f = self.file_table.get(handle)
+        if f is None:
+            self._send_status(request_number, paramiko.SFTP_BAD_MESSAGE,
+                              "Invalid handle")
+        return f
+
+    def _check_file(self, request_number, msg):
+        f = self._file(request_number, msg.get_binary())
+        if f is not None:
+            self._hash(request_number, f, msg)
+
+    def _check_file_name(self, request_number, msg):
+        path = msg.get_text()
+        f = self.server.open(path, os.O_RDONLY, paramiko.SFTPAttributes())
+        if isinstance(f, int):
+            self._send_status(request_number, f)
+            return
+        try:
+            self._hash(request_number, f, msg)
+        finally:
+            f.close()
+
+    def _hash(self, request_number, f, msg):
+        algorithms = msg.get_list()
+        start = msg.get_int64()
+        length = msg.get_int64()
+        block_size = msg.get_int()
+        name = next((a for a in algorithms if a in self.HASH_ALGORITHMS),
+                    None)
+        if name is None:
+            self._send_status(request_number, paramiko.SFTP_FAILURE,
+                              "No supported hash types found")
+            return
+        if block_size and block_size < 256:
+            self._send_status(request_number, paramiko.SFTP_FAILURE,
+                              "Block size too small")
+            return
+        try:
+            if length == 0:
+                length = max(f.file_obj.stat().st_size - start, 0)
+            if block_size == 0:
+                block_size = max(length, 1)
+            digests = []
+            end = start + length
+            offset = start
+            while True:
+                # Reads bypass the readahead cache, which would only be
+                # flooded.
+                h = hashlib.new(name)
+                block_end = min(offset + block_size, end)
+                while offset < block_end:
+                    data = f._pread(offset, min(self.HASH_CHUNK_SIZE,
+                                                block_end - offset))
+                    if not data:
+                        # Past the end of the file.
+                        end = offset
+                        break
+                    h.update(data)
+                    offset += len(data)
+                    self._bytes += len(data)
+                digests.append(h.digest())
+                if offset >= end:
+                    break
+        except OSError as e:
+            self._send_status(request_number,
+                              SFTPServer.convert_errno(e.errno))
+            return
+        reply = Message()
+        reply.add_int(request_number)
+        reply.add_string("check-file")
+        reply.add_string(name)
+        reply.add_bytes(b"".join(digests))
+        self._send_packet(CMD_EXTENDED_REPLY, reply)
+
+    def _copy_data(self, request_number, msg):
+        src = self._file(request_number, msg.get_binary())
+        if src is None:
+            return
+        src_offset = msg.get_int64()
+        length = msg.get_int64() or None
+        dst = self._file(request_number, msg.get_binary())
+        if dst is None:
+            return
+        dst_offset = msg.get_int64()
+        if src is dst and (length is None or
+                           src_offset < dst_offset + length and
+                           dst_offset < src_offset + length):
+            self._send_status(request_number, paramiko.SFTP_FAILURE,
+                              "Overlapping ranges")
+            return
+        try:
+            self._bytes = copy_range(src.file_obj, src_offset, dst.file_obj,
+                                     dst_offset, length)
+        except OSError as e:
+            self._send_status(request_number,
+                              SFTPServer.convert_errno(e.errno))
+            return
+        finally:
+            dst.invalidate_readahead()
+        self._send_status(request_number, paramiko.SFTP_OK)
+
+    def _statvfs(self, request_number, msg):
+        self._send_statvfs(request_number,
+                           self.server.statvfs(msg.get_text()))
+
+    def _fstatvfs(self, request_number, msg):
+        f = self._file(request_number, msg.get_binary())
+        if f is None:
+            return
+        try:
+            st = f.file_obj.statvfs()
+        except AttributeError:
+            st = paramiko.SFTP_OP_UNSUPPORTED
+        except OSError as e:
+            st = SFTPServer.convert_errno(e.errno)
+        self._send_statvfs(request_number, st)
+
+    def _send_statvfs(self, request_number, st):
+        if isinstance(st, int):
+            self._send_status(request_number, st)
+            return
+        flag = 0
+        if st.f_flag & getattr(os, "ST_RDONLY", 1):
+            flag |= 1
+        if st.f_flag & getattr(os, "ST_NOSUID", 2):
+            flag |= 2
+        reply = Message()
+        reply.add_int(request_number)
+        for value in (st.f_bsize, st.f_frsize, st.f_blocks, st.f_bfree,
+                      st.f_bavail, st.f_files, st.f_ffree, st.f_favail,
+                      st.f_fsid or 0, flag, st.f_namemax):
+            reply.add_int64(value)
+        self._send_packet(CMD_EXTENDED_REPLY, reply)
+
+    _extensions = {
+        "check-file-name": _check_file_name,
+        "copy-data": _copy_data,
+        "statvfs@openssh.com": _statvfs,
+        "fstatvfs@openssh.com": _fstatvfs,
+    }
@@ -0,0 +1,304 @@
+import collections
+import logging
+import random
+import select
+import socket
+import threading
+import time
+
+from typing import Callable, List, Optional
+
+__all__ = [
+    "Fault",
+    "FaultInjector",
+    "NetworkProfile",
+    "ShapedSocket",
+    "TokenBucket",
+]
+
+
+class TokenBucket(object):
+    """Limits a flow to `rate` bytes per second, in bursts of `burst` bytes.
+
+    Callers reserve the bytes they are about to move and are told how long
+    to wait first. The bucket may go into debt, so concurrent callers queue
+    up behind each other without any per-byte bookkeeping.
+    """
+
+    def __init__(self, rate: float, burst: Optional[int] = None) -> None:
+        self.rate = float(rate)
+        self.burst = burst or max(int(rate / 10), 32768)
+        self.tokens = float(self.burst)
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n: int) -> float:
+        """Takes `n` bytes from the bucket. Returns the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class NetworkProfile(object):
+    """How a slow or lossy network between clients and a server behaves.
+
+    `bandwidth` caps bytes per second in each direction, per connection,
+    or across all connections using the profile if `shared` is set. Data
+    from clients is only handed on `latency` seconds, give or take up to
+    `jitter`, after it came in. Connections are reset once `drop_after`
+    bytes went through them, in either direction.
+    """
+
+    def __init__(self, bandwidth: Optional[float] = None,
+                 latency: float = 0.0, jitter: float = 0.0,
+                 drop_after: Optional[int] = None, shared: bool = False,
+                 burst: Optional[int] = None,
+                 seed: Optional[int] = None) -> None:
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_after = drop_after
+        self.shared = shared
+        self.burst = burst
+        self.random = random.Random(seed)
+        self._buckets = None
+        if bandwidth and shared:
+            self._buckets = self._new_buckets()
+
+    def buckets(self):
+        """Returns the `(upload, download)` buckets of a new connection."""
+        if not self.bandwidth:
+            return None, None
+        if self._buckets is not None:
+            return self._buckets
+        return self._new_buckets()
+
+    def _new_buckets(self):
+        return (TokenBucket(self.bandwidth, self.burst),
+                TokenBucket(self.bandwidth, self.burst))
+
+    def delay(self) -> float:
+        if not self.latency and not self.jitter:
+            return 0.0
+        jitter = self.random.uniform(-self.jitter, self.jitter)
+        return max(self.latency + jitter, 0.0)
+
+
+class ShapedSocket(object):
+    """A socket shaped by a `NetworkProfile`, for a paramiko `Transport`.
+
+    What is read from the socket is held back until its latency elapsed,
+    and handed out in as many calls to `recv` as it takes: latency applies
+    once to each read, however paramiko splits up its packets. While
+    earlier data is held back, up to `MAX_PENDING` bytes more are read,
+    each with its own latency, so that latency does not cap bandwidth.
+
+    The profile may be switched with `set_profile`, once the user of the
+    connection is known, for instance.
+    """
+
+    log = logging.getLogger(__name__)
+
+    # Bytes read from the socket at a time, and at most held back.
+    READ_SIZE = 256 * 1024
+    MAX_PENDING = 16 * 1024 * 1024
+
+    def __init__(self, sock: socket.socket, profile: NetworkProfile) -> None:
+        self._sock = sock
+        self.transferred = 0
+        # Data read, not handed out yet, with the time it is due.
+        self._pending = collections.deque()
+        self._pending_bytes = 0
+        self._due = 0.0
+        # End of input, or the error, read behind pending data.
+        self._eof = False
+        self._error = None
+        self.set_profile(profile)
+
+    def set_profile(self, profile: NetworkProfile) -> None:
+        self.profile = profile
+        self._upload, self._download = profile.buckets()
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+    def recv(self, n):
+        if not self._pending:
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            if self._eof or not self._read():
+                return b""
+        due, data = self._pending[0]
+        while True:
+            wait = due - time.monotonic()
+            if wait <= 0:
+                break
+            if (self._eof or self._error is not None or
+                    self._pending_bytes >= self.MAX_PENDING or
+                    not select.select([self._sock], [], [], wait)[0]):
+                time.sleep(max(due - time.monotonic(), 0))
+                break
+            try:
+                if not self._read():
+                    self._eof = True
+            except OSError as e:
+                # Raised once the data read before is handed out.
+                self._error = e
+        if len(data) > n:
+            self._pending[0] = (due, data[n:])
+            self._pending_bytes -= n
+            return data[:n].tobytes()
+        self._pending.popleft()
+        self._pending_bytes -= len(data)
+        return data.tobytes()
+
+    def _read(self):
+        # Reads from the socket into `_pending`. Returns False at the end.
+        data = self._sock.recv(self._allowance(self.READ_SIZE))
+        if not data:
+            return False
+        self.transferred += len(data)
+        now = time.monotonic()
+        wait = self.profile.delay()
+        if self._upload is not None:
+            wait = max(wait, self._upload.reserve(len(data)))
+        # Data is never handed out ahead of what came in before it.
+        self._due = max(now + wait, self._due)
+        self._pending.append((self._due, memoryview(data)))
+        self._pending_bytes += len(data)
+        return True
+
+    def send(self, data):
+        n = self._allowance(len(data))
+        if self._download is not None:
+            n = min(n, self._download.burst)
+            wait = self._download.reserve(n)
+            if wait:
+                time.sleep(wait)
+        sent = self._sock.send(data[:n])
+        self.transferred += sent
+        return sent
+
+    def _allowance(self, n):
+        # Bytes that may still go through before the connection is dropped.
+        limit = self.profile.drop_after
+        if limit is None:
+            return n
+        if self.transferred >= limit:
+            self.log.debug("Dropping %s after %d bytes", self._sock,
+                           self.transferred)
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            raise ConnectionResetError("Connection dropped by NetworkProfile")
+        return min(n, limit - self.transferred)
+
+
+class Fault(object):
+    """A fault injected into SFTP operations named `op` (`"*"` for all).
+
+    Matching operations are delayed by `delay` seconds, give or take up to
+    `jitter`, then fail with SFTP status `status` if it is set. Faults apply
+    with probability `probability`, at most `times` times if set.
+    """
+
+    def __init__(self, op: str, delay: float = 0.0, jitter: float = 0.0,
+                 status: Optional[int] = None, probability: float = 1.0,
+                 times: Optional[int] = None) -> None:
+        self.op = op
+        self.delay = delay
+        self.jitter = jitter
+        self.status = status
+        self.probability = probability
+        self.times = times
+        self.hits = 0
+
+
+class FaultInjector(object):
+    """The faults SFTP operations of a `Server` are subjected to.
+
+    Hooks added with `add_hook` are told of each change before it is made.
+    """
+
+    def __init__(self, seed: Optional[int] = None) -> None:
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._faults = []
+        self._hooks = []
+
+    def add_hook(self, hook: Callable) -> None:
+        """Calls `hook(method, args)` before each change to the faults.
+
+        `method` names the method making the change, called with `args`.
+        Raising from the hook prevents the change.
+        """
+        with self._lock:
+            self._hooks = self._hooks + [hook]
+
+    def remove_hook(self, hook: Callable) -> None:
+        with self._lock:
+            self._hooks = [h for h in self._hooks if h != hook]
+
+    def _changing(self, method, *args):
+        for hook in self._hooks:
+            hook(method, args)
+
+    def add(self, op: str, delay: float = 0.0, jitter: float = 0.0,
+            status: Optional[int] = None, probability: float = 1.0,
+            times: Optional[int] = None) -> Fault:
+        """Adds and returns a `Fault`. See `Fault` for its arguments."""
+        self._changing("add", op, delay, jitter, status, probability, times)
+        fault = Fault(op, delay, jitter, status, probability, times)
+        with self._lock:
+            self._faults = self._faults + [fault]
+        return fault
+
+    def remove(self, fault: Fault) -> None:
+        self._changing("remove", fault)
+        with self._lock:
+            self._faults = [f for f in self._faults if f is not fault]
+
+    def clear(self) -> None:
+        self._changing("clear")
+        with self._lock:
+            self._faults = []
+
+    def __bool__(self) -> bool:
+        return bool(self._faults)
+
+    def match(self, op: str) -> List[Fault]:
+        """Returns the faults that apply to one `op` operation, in order."""
+        matched = []
+        with self._lock:
+            for fault in self._faults:
+                if fault.op not in ("*", op):
+                    continue
+                if fault.times is not None and fault.hits >= fault.times:
+                    continue
+                if (fault.probability < 1.0 and
+                        self.random.random() >= fault.probability):
+                    continue
+                fault.hits += 1
+                matched.append(fault)
+        return matched
+
+    def apply(self, op: str) -> Optional[int]:
+        """Delays an `op` operation. Returns the status to fail it with."""
+        status = None
+        for fault in self.match(op):
+            delay = fault.delay
+            if fault.jitter:
+                delay += self.random.uniform(-fault.jitter, fault.jitter)
+            if delay > 0:
+                time.sleep(delay)
+            if status is None:
+                status = fault.status
+        return status
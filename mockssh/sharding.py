@@ -0,0 +1,132 @@
+import logging
+import multiprocessing
+import socket
+import threading
+
+__all__ = [
+    "Shard",
+    "fork_supported",
+    "reuseport_supported",
+]
+
+
+def fork_supported() -> bool:
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def reuseport_supported() -> bool:
+    return hasattr(socket, "SO_REUSEPORT")
+
+
+class Shard(object):
+    """A forked copy of a `Server`, serving a share of its connections.
+
+    The worker process listens on its own `SO_REUSEPORT` socket bound to
+    the port of the server, so that the kernel spreads connections among
+    workers, or else accepts on the listening socket it inherited. It is
+    controlled through a pipe: requests are method names of the shard,
+    called in the worker with the given arguments.
+
+    Workers get a copy of the server as it was when forked. Users added
+    and commands emulated afterwards are passed on to them; the server
+    refuses other changes.
+    """
+
+    log = logging.getLogger(__name__)
+
+    # Seconds a worker is given to exit before being killed.
+    STOP_TIMEOUT = 5.0
+
+    def __init__(self, server, index: int) -> None:
+        self.server = server
+        self.index = index
+        self._lock = threading.Lock()
+        context = multiprocessing.get_context("fork")
+        self._conn, child_conn = context.Pipe()
+        self.process = context.Process(target=self._main, args=(child_conn,),
+                                       name="mockssh-shard-%d" % index,
+                                       daemon=True)
+        self._child_conn = child_conn
+
+    def start(self) -> None:
+        """Starts the worker, and waits until it accepts connections."""
+        self.process.start()
+        self._child_conn.close()
+        status, value = self._conn.recv()
+        if status == "error":
+            raise value
+
+    def call(self, method: str, *args):
+        """Calls `method` of the shard in the worker, and returns its result."""
+        with self._lock:
+            self._conn.send((method, args))
+            status, value = self._conn.recv()
+        if status == "error":
+            raise value
+        return value
+
+    def stop(self) -> None:
+        try:
+            with self._lock:
+                self._conn.send(("stop", ()))
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(self.STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.log.warning("Killing unresponsive %s", self.process.name)
+            self.process.kill()
+            self.process.join()
+        self._conn.close()
+
+    def _main(self, conn):
+        # Runs in the worker process. Pipes to the other workers are closed,
+        # so that they see their end of file when the parent exits.
+        self._conn.close()
+        for shard in self.server._shards:
+            shard._conn.close()
+        self.server._shards = []
+        try:
+            self._serve()
+        except Exception as e:
+            conn.send(("error", e))
+            return
+        conn.send(("ok", None))
+        while True:
+            try:
+                method, args = conn.recv()
+            except EOFError:
+                # The parent is gone.
+                break
+            if method == "stop":
+                break
+            try:
+                result = getattr(self, method)(*args)
+            except Exception as e:
+                conn.send(("error", e))
+            else:
+                conn.send(("ok", result))
+
+    def _serve(self):
+        server = self.server
+        if reuseport_supported():
+            port = server.port
+            server._socket.close()
+            server._socket = s = socket.socket(socket.AF_INET,
+                                               socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            s.bind((server.host, port))
+            s.listen(server.backlog)
+            s.setblocking(False)
+        server._start()
+
+    def add_user(self, *args):
+        self.server.add_user(*args)
+
+    def change_commands(self, method, args):
+        getattr(self.server.commands, method)(*args)
+
+    def export_metrics(self, reset):
+        return self.server.metrics.export(reset)
+
+    def reset_metrics(self):
+        self.server.metrics.reset()
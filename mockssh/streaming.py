@@ -1,17 +1,22 @@
+import collections
+import os
 import selectors
+import time
 
 
 class Stream:
-    def __init__(self, fd, read, write, flush):
+    def __init__(self, fd, read, write, flush, close=lambda: None):
         self.fd = fd
         self.read = read
         self.write = write
         self.flush = flush
+        self.close = close
 
     def transfer(self):
         data = self.read()
-        self.write(data)
-        self.flush()
+        if data:
+            self.write(data)
+            self.flush()
         return data
 
     def drain(self):
@@ -20,24 +25,148 @@ class Stream:
                 return
 
 
+class CoalescingWriter:
+    """Coalesces writes to an SSH channel into fewer, larger packets.
+
+    Written data is held back until `size` bytes are pending or the oldest
+    pending byte is `delay` seconds old. Full buffers are only sent while the
+    channel window is open, unless the client falls so far behind that
+    twice `size` bytes are pending.
+    """
+
+    def __init__(self, channel, stderr, size, delay):
+        if stderr:
+            self.send, self.sendall = channel.send_stderr, channel.sendall_stderr
+        else:
+            self.send, self.sendall = channel.send, channel.sendall
+        self.channel = channel
+        self.size = size
+        self.delay = delay
+        self.chunks = []
+        self.pending = 0
+        self.deadline = None
+
+    def write(self, data):
+        if not self.pending:
+            self.deadline = time.monotonic() + self.delay
+        self.chunks.append(data)
+        self.pending += len(data)
+        if not self.delay:
+            self.flush()
+        elif self.pending >= self.size:
+            self.flush(block=self.pending >= 2 * self.size)
+
+    def tick(self, now):
+        if self.pending and now >= self.deadline:
+            self.flush()
+
+    def flush(self, block=True):
+        if not self.pending:
+            return
+        data = b"".join(self.chunks)
+        if block:
+            self.sendall(data)
+            data = b""
+        else:
+            while data and self.channel.send_ready():
+                sent = self.send(data)
+                if not sent:
+                    break
+                data = data[sent:]
+        self.chunks = [data] if data else []
+        self.pending = len(data)
+
+
 class StreamTransfer:
     BUFFER_SIZE = 1024
 
-    def __init__(self, ssh_channel, process):
+    # Default chunk size for the chunked relay: the default pipe capacity on
+    # Linux, so a single read empties a full pipe.
+    CHUNK_SIZE = 65536
+
+    # Default time small chunks of output are held back for, waiting for
+    # more output to send along with them.
+    FLUSH_INTERVAL = 0.005
+
+    # How often process exit is polled for where pidfds are not available.
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, ssh_channel, process, buffer_size=None,
+                 flush_interval=0.0):
+        """Relays data between `ssh_channel` and `process`.
+
+        With the default `buffer_size` of `None` process output is relayed
+        one line at a time. Otherwise output is read from the process pipes
+        in chunks of up to `buffer_size` bytes, as soon as it is available,
+        and small chunks are coalesced for up to `flush_interval` seconds
+        before being sent.
+        """
         self.process = process
-        self.streams = [
-            self.ssh_to_process(ssh_channel, self.process.stdin),
-            self.process_to_ssh(self.process.stdout, ssh_channel.sendall),
-            self.process_to_ssh(self.process.stderr, ssh_channel.sendall_stderr),
-        ]
+        self.buffer_size = buffer_size
+        self.writers = []
+        # Bytes relayed so far, per stream.
+        self.counts = collections.Counter()
+        if buffer_size is None:
+            stdout = self.counted("stdout", ssh_channel.sendall)
+            stderr = self.counted("stderr", ssh_channel.sendall_stderr)
+            self.streams = [
+                self.ssh_to_process(ssh_channel, self.process.stdin),
+                self.process_to_ssh(self.process.stdout, stdout),
+                self.process_to_ssh(self.process.stderr, stderr),
+            ]
+        else:
+            self.writers = [
+                CoalescingWriter(ssh_channel, False, buffer_size, flush_interval),
+                CoalescingWriter(ssh_channel, True, buffer_size, flush_interval),
+            ]
+            stdout = self.counted("stdout", self.writers[0].write)
+            stderr = self.counted("stderr", self.writers[1].write)
+            self.streams = [
+                self.ssh_to_process(ssh_channel, self.process.stdin),
+                self.process_to_ssh_chunked(self.process.stdout, stdout),
+                self.process_to_ssh_chunked(self.process.stderr, stderr),
+            ]
+
+    def counted(self, name, write_func):
+        def write(data):
+            self.counts[name] += len(data)
+            write_func(data)
+
+        return write
 
     def ssh_to_process(self, channel, process_stream):
-        return Stream(channel, lambda: channel.recv(self.BUFFER_SIZE), process_stream.write, process_stream.flush)
+        size = self.buffer_size or self.BUFFER_SIZE
+
+        def close():
+            try:
+                process_stream.close()
+            except BrokenPipeError:
+                pass
+
+        return Stream(channel, lambda: channel.recv(size),
+                      self.counted("stdin", process_stream.write),
+                      process_stream.flush, close)
 
     @staticmethod
     def process_to_ssh(process_stream, write_func):
         return Stream(process_stream, process_stream.readline, write_func, lambda: None)
 
+    def process_to_ssh_chunked(self, process_stream, write_func):
+        # Read straight from the pipe, bypassing the buffered file object.
+        # The pipe is non-blocking so that draining it after the process has
+        # exited never blocks on descendants still holding it open.
+        fd = process_stream.fileno()
+        os.set_blocking(fd, False)
+        size = self.buffer_size
+
+        def read():
+            try:
+                return os.read(fd, size)
+            except BlockingIOError:
+                return None
+
+        return Stream(process_stream, read, write_func, lambda: None)
+
     def run(self):
         with selectors.DefaultSelector() as selector:
             for stream in self.streams:
@@ -45,16 +174,60 @@ class StreamTransfer:
 
             self.transfer(selector)
             self.drain(selector)
+        for writer in self.writers:
+            writer.flush()
 
-    @staticmethod
-    def ready_streams(selector):
-        return (key.data for key, _ in selector.select(timeout=-1))
+    def exit_fd(self):
+        """Returns a pidfd that becomes readable once the process exits.
+
+        Returns `None` where pidfds are not available, in which case process
+        exit is polled for every `POLL_INTERVAL` seconds.
+        """
+        try:
+            return os.pidfd_open(self.process.pid)
+        except (AttributeError, OSError):
+            return None
+
+    def timeout(self, pidfd):
+        deadlines = [w.deadline for w in self.writers if w.pending]
+        if deadlines:
+            timeout = max(min(deadlines) - time.monotonic(), 0)
+        else:
+            timeout = None
+        if pidfd is None and (timeout is None or timeout > self.POLL_INTERVAL):
+            timeout = self.POLL_INTERVAL
+        return timeout
 
     def transfer(self, selector):
-        while self.process.poll() is None:
-            for stream in self.ready_streams(selector):
-                stream.transfer()
+        pidfd = self.exit_fd()
+        if pidfd is not None:
+            selector.register(pidfd, selectors.EVENT_READ)
+        try:
+            while self.process.poll() is None:
+                for key, _ in selector.select(self.timeout(pidfd)):
+                    if key.data is not None:
+                        self.transfer_stream(selector, key.data)
+                now = time.monotonic()
+                for writer in self.writers:
+                    writer.tick(now)
+        finally:
+            if pidfd is not None:
+                selector.unregister(pidfd)
+                os.close(pidfd)
+
+    def transfer_stream(self, selector, stream):
+        try:
+            data = stream.transfer()
+        except BrokenPipeError:
+            # The process closed its stdin: discard any further input.
+            data = b""
+        if data == b"":
+            selector.unregister(stream.fd)
+            stream.close()
 
     def drain(self, selector):
-        for stream in self.ready_streams(selector):
-            stream.drain()
+        # The process is gone, so only its output is still of interest.
+        outputs = self.streams[1:]
+        for key, _ in selector.select(timeout=0):
+            if key.data in outputs:
+                key.data.drain()
@@ -0,0 +1,95 @@
+import codecs
+
+import paramiko
+from pytest import fixture, mark, raises
+
+from mockssh.server import Handler, Server
+from mockssh.test_streaming import streaming_test
+from typing import Iterator
+
+
+@fixture
+def aio_server(user_key_path: str) -> Iterator[Server]:
+    with Server({"sample-user": user_key_path}, engine="asyncio") as s:
+        yield s
+
+
+@mark.fails_on_windows
+def test_exec_command(aio_server: Server):
+    with aio_server.client("sample-user") as c:
+        _, stdout, stderr = c.exec_command("echo 42; echo oops 1>&2; exit 3")
+        assert codecs.decode(stdout.read().strip(), "utf8") == "42"
+        assert codecs.decode(stderr.read().strip(), "utf8") == "oops"
+        assert stdout.channel.recv_exit_status() == 3
+
+
+@mark.fails_on_windows
+def test_streaming(aio_server: Server):
+    streaming_test(aio_server, "cat", 1, 10)
+
+
+@mark.fails_on_windows
+def test_stdin_eof(aio_server: Server):
+    with aio_server.client("sample-user") as c:
+        stdin, stdout, _ = c.exec_command("wc -c")
+        stdin.write("x" * 100000)
+        stdin.channel.shutdown_write()
+        assert stdout.read().strip() == b"100000"
+
+
+@mark.fails_on_windows
+def test_large_output(aio_server: Server):
+    size = 8 * 1024 * 1024
+    with aio_server.client("sample-user") as c:
+        _, stdout, _ = c.exec_command("head -c %d /dev/zero" % size)
+        assert stdout.read() == b"\0" * size
+
+
+@mark.fails_on_windows
+def test_concurrent_sessions(aio_server: Server):
+    with aio_server.client("sample-user") as c:
+        channels = [c.exec_command("sleep 0.5; echo %d" % i)[1]
+                    for i in range(20)]
+        for i, stdout in enumerate(channels):
+            assert codecs.decode(stdout.read().strip(), "utf8") == str(i)
+
+
+def test_handler_error(aio_server: Server):
+    failures = []
+
+    class FailingOnce(Handler):
+        def __init__(self, server, client_conn):
+            if not failures:
+                failures.append(client_conn)
+                raise RuntimeError("Cannot set up the connection")
+            super(FailingOnce, self).__init__(server, client_conn)
+
+    aio_server.handler_cls = FailingOnce
+    with raises((EOFError, OSError, paramiko.SSHException)):
+        aio_server.client("sample-user")
+    # Later connections are still served.
+    with aio_server.client("sample-user") as c:
+        assert c.get_transport().is_authenticated()
+    assert len(failures) == 1
+
+
+@mark.fails_on_windows
+def test_channels_released(user_key_path: str):
+    handlers = []
+
+    class Recording(Handler):
+        def __init__(self, server, client_conn):
+            super(Recording, self).__init__(server, client_conn)
+            handlers.append(self)
+
+    with Server({"sample-user": user_key_path}, engine="asyncio") as s:
+        s.handler_cls = Recording
+        with s.client("sample-user") as c:
+            for i in range(10):
+                _, stdout, _ = c.exec_command("echo %d" % i)
+                assert stdout.read() == b"%d\n" % i
+                stdout.channel.recv_exit_status()
+            handler, = handlers
+            assert handler.transport.accept(0) is None
+            # Closed channels are dropped as others are opened.
+            assert len(handler.channels) <= 2
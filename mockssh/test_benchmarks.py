@@ -0,0 +1,66 @@
+import json
+import os
+
+from pytest import mark, param, raises
+
+from mockssh.benchmarks import SCENARIOS, run_scenario
+from mockssh.benchmarks import __main__ as cli
+from mockssh.benchmarks.__main__ import main
+
+TINY = {
+    "connect": {"count": 2},
+    "connection_storm": {"connections": 4},
+    "exec_small": {"concurrency": 2, "commands": 3},
+    "exec_large": {"concurrency": 2, "commands": 2, "size_mb": 1},
+    "forward": {"concurrency": 2, "size_mb": 1},
+    "sftp_put": {"size_mb": 1},
+    "sftp_get": {"size_mb": 1},
+    "sftp_parallel_get": {"files": 2, "size_mb": 1},
+    "sftp_listdir": {"files": 10},
+}
+
+
+# Scenarios running commands through a shell, or many connections at once.
+FAILS_ON_WINDOWS = {"connect", "connection_storm", "exec_small", "exec_large"}
+
+
+@mark.parametrize("name", [
+    param(name, marks=mark.fails_on_windows) if name in FAILS_ON_WINDOWS
+    else name for name in sorted(SCENARIOS)])
+def test_scenario(name: str):
+    result = run_scenario(name, **TINY[name])
+    assert result
+    assert all(isinstance(v, (int, float)) and v >= 0
+               for v in result.values())
+
+
+def test_unknown_parameter():
+    with raises(ValueError):
+        run_scenario("connect", size_mb=1)
+
+
+def test_median_of_uneven_runs(monkeypatch):
+    runs = iter([{"connections_per_s": 1.0, "latency_p50": 2.0},
+                 {"connections_per_s": 3.0},
+                 {"connections_per_s": 2.0, "latency_p50": 4.0}])
+    monkeypatch.setattr(cli, "run_scenario", lambda *args, **kw: next(runs))
+    result = cli.run("connection_storm", 3, {}, {})
+    assert result["median"] == {"connections_per_s": 2.0, "latency_p50": 3.0}
+
+
+def test_main(tmp_dir: str):
+    first = os.path.join(tmp_dir, "first.json")
+    second = os.path.join(tmp_dir, "second.json")
+    argv = ["connect", "sftp_get", "--repeat", "2", "--set", "count=2",
+            "--set", "size_mb=1"]
+    assert main(argv + ["--output", first]) == 0
+    assert main(argv + ["--output", second, "--baseline", first]) == 0
+
+    with open(second) as f:
+        report = json.load(f)
+    assert sorted(report["results"]) == ["connect", "sftp_get"]
+    connect = report["results"]["connect"]
+    assert connect["params"] == {"count": 2}
+    assert len(connect["runs"]) == 2
+    assert connect["median"]["connections_per_s"] > 0
+    assert report["comparison"]["sftp_get"]["mb_per_s"] > 0
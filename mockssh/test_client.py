@@ -0,0 +1,67 @@
+import codecs
+
+from pytest import mark, raises
+
+from mockssh.server import Server
+
+
+@mark.fails_on_windows
+def test_reuses_transport(server: Server):
+    with server.pooled_client("sample-user") as c:
+        transport = c.get_transport()
+        _, stdout, _ = c.exec_command("echo 1")
+        assert codecs.decode(stdout.read().strip(), "utf8") == "1"
+    with server.pooled_client("sample-user") as c:
+        assert c.get_transport() is transport
+        _, stdout, _ = c.exec_command("echo 2")
+        assert codecs.decode(stdout.read().strip(), "utf8") == "2"
+
+
+def test_channels_closed(server: Server):
+    with server.pooled_client("sample-user") as c:
+        transport = c.get_transport()
+        channel = transport.open_session()
+        sftp = c.open_sftp()
+    assert channel.closed
+    assert sftp.sock.closed
+    with server.pooled_client("sample-user") as c:
+        assert c.get_transport() is transport
+        assert c.open_sftp().listdir("/") is not None
+
+
+def test_concurrent_clients(server: Server):
+    with server.pooled_client("sample-user") as c1:
+        with server.pooled_client("sample-user") as c2:
+            assert c1.get_transport() is not c2.get_transport()
+
+
+def test_max_lifetime(server: Server):
+    server.client_pool.max_lifetime = 0
+    with server.pooled_client("sample-user") as c:
+        transport = c.get_transport()
+    assert not transport.is_active()
+    with server.pooled_client("sample-user") as c:
+        assert c.get_transport() is not transport
+
+
+def test_max_idle(server: Server):
+    server.client_pool.max_idle = 1
+    c1 = server.pooled_client("sample-user")
+    c2 = server.pooled_client("sample-user")
+    t1, t2 = c1.get_transport(), c2.get_transport()
+    c1.close()
+    c2.close()
+    assert t1.is_active()
+    assert not t2.is_active()
+
+
+def test_close_idle_on_exit(user_key_path: str):
+    with Server({"sample-user": user_key_path}) as s:
+        with s.pooled_client("sample-user") as c:
+            transport = c.get_transport()
+    assert not transport.is_active()
+
+
+def test_unknown_user(server: Server):
+    with raises(KeyError):
+        server.pooled_client("unknown-user")
@@ -0,0 +1,70 @@
+import codecs
+import re
+import time
+
+from pytest import fixture, mark
+
+from mockssh.server import Server
+from typing import Iterator
+
+
+@fixture(params=["threading", "asyncio"])
+def engine_server(request, user_key_path: str) -> Iterator[Server]:
+    with Server({"sample-user": user_key_path}, engine=request.param) as s:
+        yield s
+
+
+def run(server: Server, command: str, stdin: bytes = b""):
+    with server.client("sample-user") as c:
+        i, o, e = c.exec_command(command)
+        if stdin:
+            i.write(stdin)
+            i.channel.shutdown_write()
+        return o.read(), e.read(), o.channel.recv_exit_status()
+
+
+def test_static_response(engine_server: Server):
+    engine_server.commands.register("uname", stdout="Linux\n",
+                                    stderr=b"warning\n", status=3)
+    assert run(engine_server, "uname") == (b"Linux\n", b"warning\n", 3)
+
+
+def test_delay(engine_server: Server):
+    engine_server.commands.register("slow", delay=0.2)
+    started = time.monotonic()
+    assert run(engine_server, "slow") == (b"", b"", 0)
+    assert time.monotonic() - started >= 0.2
+
+
+def test_regex(engine_server: Server):
+    def echo(command):
+        command.stdout.write(command.match.group(1))
+        return int(command.match.group(1))
+
+    engine_server.commands.register(re.compile(r"exit (\d+)"), echo)
+    assert run(engine_server, "exit 7") == (b"7", b"", 7)
+
+
+def test_stdin(engine_server: Server):
+    def upper(command):
+        command.stdout.write(command.stdin.read().upper())
+
+    engine_server.commands.register("upper", upper)
+    assert run(engine_server, "upper", b"hello") == (b"HELLO", b"", 0)
+
+
+def test_exact_match_first(server: Server):
+    server.commands.register(re.compile(".*"), stdout="regex")
+    server.commands.register("cmd", stdout="exact")
+    assert run(server, "cmd")[0] == b"exact"
+    assert run(server, "other")[0] == b"regex"
+
+
+@mark.fails_on_windows
+def test_fallback_to_subprocess(server: Server):
+    server.commands.register("true", status=1)
+    stdout, _, status = run(server, "echo 42")
+    assert codecs.decode(stdout.strip(), "utf8") == "42"
+    assert status == 0
+    server.commands.clear()
+    assert run(server, "true")[2] == 0
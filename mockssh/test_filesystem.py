@@ -0,0 +1,395 @@
+import errno
+import hashlib
+import os
+import stat
+
+from pytest import fixture, raises
+from paramiko.sftp_client import SFTPClient
+
+from mockssh.filesystem import (LocalFilesystem, MemoryFilesystem,
+                                OverlayFilesystem, RootedFilesystem,
+                                copy_range)
+from mockssh.server import Server
+from typing import Iterator
+
+
+@fixture
+def memory_fs() -> MemoryFilesystem:
+    return MemoryFilesystem()
+
+
+@fixture
+def memory_sftp(memory_fs: MemoryFilesystem,
+                user_key_path: str) -> Iterator[SFTPClient]:
+    users = {"sample-user": user_key_path}
+    with Server(users, filesystem=memory_fs) as s:
+        with s.client("sample-user") as c:
+            yield c.open_sftp()
+
+
+def test_files(memory_fs: MemoryFilesystem):
+    memory_fs.makedirs("/a/b")
+    memory_fs.write_bytes("/a/b/foo", b"foo")
+    f = memory_fs.open("/a/b/foo", os.O_RDWR | os.O_APPEND)
+    f.pwrite(b"bar", 0)
+    assert f.pread(10, 1) == b"oobar"
+    assert memory_fs.stat("/a/b/foo").st_size == 6
+    with raises(FileExistsError):
+        memory_fs.open("/a/b/foo", os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    with raises(IsADirectoryError):
+        memory_fs.open("/a", os.O_RDONLY)
+    with raises(OSError) as exc:
+        memory_fs.open("/a/b/foo", os.O_RDONLY).pwrite(b"x", 0)
+    assert exc.value.errno == errno.EBADF
+
+
+def test_paths(memory_fs: MemoryFilesystem):
+    memory_fs.makedirs("/a/b")
+    memory_fs.write_bytes("/a/b/foo", b"foo")
+    assert memory_fs.read_bytes("a/./b/../b/foo") == b"foo"
+    with raises(FileNotFoundError):
+        memory_fs.stat("/a/missing")
+    with raises(NotADirectoryError):
+        memory_fs.stat("/a/b/foo/bar")
+
+
+def test_normalize(memory_fs: MemoryFilesystem, tmp_dir: str):
+    for path in ("a/./b/../c", "/a/c", "//a/c", "../a/c/"):
+        assert memory_fs.normalize(path) == "/a/c"
+    assert memory_fs.normalize(".") == "/"
+    # Local paths are relative to the current directory.
+    local = LocalFilesystem()
+    assert local.normalize(os.path.join(tmp_dir, "a", "..", "b")) == \
+        os.path.join(tmp_dir, "b").replace(os.sep, "/")
+    assert local.normalize("a") == \
+        os.path.join(os.getcwd(), "a").replace(os.sep, "/")
+
+
+def test_symlinks(memory_fs: MemoryFilesystem):
+    memory_fs.makedirs("/a/b")
+    memory_fs.write_bytes("/a/b/foo", b"foo")
+    memory_fs.symlink("b/foo", "/a/link")
+    memory_fs.symlink("/a/b", "/dir")
+    memory_fs.symlink("/loop", "/loop")
+    assert memory_fs.read_bytes("/a/link") == b"foo"
+    assert memory_fs.read_bytes("/dir/foo") == b"foo"
+    assert stat.S_ISLNK(memory_fs.lstat("/a/link").st_mode)
+    assert stat.S_ISREG(memory_fs.stat("/a/link").st_mode)
+    with raises(OSError) as exc:
+        memory_fs.stat("/loop")
+    assert exc.value.errno == errno.ELOOP
+
+
+def test_directories(memory_fs: MemoryFilesystem):
+    memory_fs.makedirs("/a/b")
+    with raises(FileExistsError):
+        memory_fs.mkdir("/a")
+    with raises(OSError) as exc:
+        memory_fs.rmdir("/a")
+    assert exc.value.errno == errno.ENOTEMPTY
+    with raises(IsADirectoryError):
+        memory_fs.remove("/a/b")
+    memory_fs.rmdir("/a/b")
+    assert list(memory_fs.scandir("/a")) == []
+
+
+def test_rename(memory_fs: MemoryFilesystem):
+    memory_fs.makedirs("/a/b")
+    memory_fs.write_bytes("/a/foo", b"foo")
+    memory_fs.write_bytes("/a/bar", b"bar")
+    memory_fs.rename("/a/foo", "/a/bar")
+    assert memory_fs.read_bytes("/a/bar") == b"foo"
+    with raises(IsADirectoryError):
+        memory_fs.rename("/a/bar", "/a/b")
+    with raises(OSError) as exc:
+        memory_fs.rename("/a", "/a/b/c")
+    assert exc.value.errno == errno.EINVAL
+    memory_fs.rename("/a/b", "/c")
+    assert sorted(name for name, _ in memory_fs.scandir("/")) == ["a", "c"]
+
+
+def test_sftp(memory_sftp: SFTPClient, memory_fs: MemoryFilesystem,
+              tmp_dir: str):
+    memory_sftp.mkdir("/data")
+    memory_sftp.put(__file__, "/data/foo", confirm=True)
+    with open(__file__, "rb") as f:
+        assert memory_fs.read_bytes("/data/foo") == f.read()
+
+    target = os.path.join(tmp_dir, "foo")
+    memory_sftp.get("/data/foo", target)
+    with open(__file__, "rb") as f1, open(target, "rb") as f2:
+        assert f1.read() == f2.read()
+
+    memory_sftp.rename("/data/foo", "/data/bar")
+    memory_sftp.symlink("/data/bar", "/data/link")
+    memory_sftp.chmod("/data/bar", 0o600)
+    memory_sftp.utime("/data/bar", (1400000000, 1500000000))
+    assert sorted(memory_sftp.listdir("/data")) == ["bar", "link"]
+    assert memory_sftp.readlink("/data/link") == "/data/bar"
+    assert stat.S_IMODE(memory_sftp.stat("/data/link").st_mode) == 0o600
+    assert memory_sftp.stat("/data/link").st_mtime == 1500000000
+    with memory_sftp.open("/data/bar") as f:
+        assert f.check("sha256") == hashlib.sha256(
+            memory_fs.read_bytes("/data/bar")).digest()
+    memory_sftp.remove("/data/bar")
+    memory_sftp.remove("/data/link")
+    memory_sftp.rmdir("/data")
+    assert memory_sftp.listdir("/") == []
+
+
+def test_sftp_errors(memory_sftp: SFTPClient):
+    with raises(FileNotFoundError):
+        memory_sftp.stat("/missing")
+    with raises(FileNotFoundError):
+        memory_sftp.listdir("/missing")
+    with raises(IOError):
+        memory_sftp.rmdir("/")
+
+
+@fixture
+def base_dir(tmp_dir: str) -> str:
+    os.makedirs(os.path.join(tmp_dir, "a", "b"))
+    for name in ("a/foo", "a/b/bar"):
+        with open(os.path.join(tmp_dir, name), "wb") as f:
+            f.write(name.encode("ascii"))
+    return tmp_dir
+
+
+def tree(path: str) -> dict:
+    found = {}
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            p = os.path.join(root, name)
+            with open(p, "rb") as f:
+                found[os.path.relpath(p, path)] = f.read()
+        for name in dirs:
+            found[os.path.relpath(os.path.join(root, name), path)] = None
+    return found
+
+
+def overlay_names(fs: OverlayFilesystem, path: str) -> list:
+    return sorted(name for name, _ in fs.scandir(path))
+
+
+def test_overlay_writes(base_dir: str):
+    before = tree(base_dir)
+    fs = OverlayFilesystem(base_dir)
+    f = fs.open("/a/foo", os.O_WRONLY | os.O_APPEND)
+    f.pwrite(b"+", 0)
+    fs.open("/a/b/new", os.O_WRONLY | os.O_CREAT).pwrite(b"new", 0)
+    fs.chmod("/a/b/bar", 0o600)
+    fs.utime("/a/foo", (1400000000, 1500000000))
+    assert fs.upper.read_bytes("/a/foo") == b"a/foo+"
+    assert fs.open("/a/b/new", os.O_RDONLY).pread(10, 0) == b"new"
+    assert stat.S_IMODE(fs.stat("/a/b/bar").st_mode) == 0o600
+    assert fs.stat("/a/foo").st_mtime == 1500000000
+    assert fs.open("/a/b/bar", os.O_RDONLY).pread(10, 0) == b"a/b/bar"
+    assert overlay_names(fs, "/a/b") == ["bar", "new"]
+    assert tree(base_dir) == before
+
+    fs.reset()
+    assert fs.open("/a/foo", os.O_RDONLY).pread(10, 0) == b"a/foo"
+    with raises(FileNotFoundError):
+        fs.stat("/a/b/new")
+
+
+def test_overlay_truncate(base_dir: str):
+    before = tree(base_dir)
+    os.chmod(os.path.join(base_dir, "a", "foo"), 0o640)
+    fs = OverlayFilesystem(base_dir)
+    opened = []
+    lower_open = fs.lower.open
+    fs.lower.open = lambda *args: opened.append(args) or lower_open(*args)
+    fs.open("/a/foo", os.O_WRONLY | os.O_TRUNC).pwrite(b"new", 0)
+    # Nothing was read from the base file but its mode.
+    assert opened == []
+    assert fs.upper.read_bytes("/a/foo") == b"new"
+    assert stat.S_IMODE(fs.stat("/a/foo").st_mode) == 0o640
+    assert tree(base_dir) == before
+
+
+def test_overlay_removes(base_dir: str):
+    before = tree(base_dir)
+    fs = OverlayFilesystem(base_dir)
+    with raises(OSError) as exc:
+        fs.rmdir("/a/b")
+    assert exc.value.errno == errno.ENOTEMPTY
+    fs.remove("/a/b/bar")
+    fs.rmdir("/a/b")
+    assert overlay_names(fs, "/a") == ["foo"]
+    with raises(FileNotFoundError):
+        fs.stat("/a/b/bar")
+
+    # A directory made in place of a removed one starts out empty.
+    fs.mkdir("/a/b")
+    assert overlay_names(fs, "/a/b") == []
+    assert tree(base_dir) == before
+
+
+def test_overlay_rename(base_dir: str):
+    before = tree(base_dir)
+    fs = OverlayFilesystem(base_dir)
+    fs.rename("/a/b", "/c")
+    fs.rename("/a/foo", "/c/foo")
+    assert overlay_names(fs, "/") == ["a", "c"]
+    assert overlay_names(fs, "/a") == []
+    assert overlay_names(fs, "/c") == ["bar", "foo"]
+    assert fs.open("/c/bar", os.O_RDONLY).pread(10, 0) == b"a/b/bar"
+    with raises(OSError) as exc:
+        fs.rename("/c", "/c/d")
+    assert exc.value.errno == errno.EINVAL
+    assert tree(base_dir) == before
+
+
+def test_overlay_symlinks(base_dir: str):
+    fs = OverlayFilesystem(base_dir)
+    fs.symlink("/a/b/bar", "/link")
+    assert fs.readlink("/link") == "/a/b/bar"
+    assert fs.open("/link", os.O_RDONLY).pread(10, 0) == b"a/b/bar"
+    assert stat.S_ISREG(fs.stat("/link").st_mode)
+    assert stat.S_ISLNK(fs.lstat("/link").st_mode)
+
+
+def test_overlay_sftp(base_dir: str, user_key_path: str):
+    before = tree(base_dir)
+    fs = OverlayFilesystem(base_dir)
+    users = {"sample-user": user_key_path}
+    with Server(users, filesystem=fs) as s:
+        with s.client("sample-user") as c:
+            sftp = c.open_sftp()
+            assert sorted(sftp.listdir("/a")) == ["b", "foo"]
+            with sftp.open("/a/foo", "a") as f:
+                f.write(b"+")
+            sftp.put(__file__, "/a/b/new")
+            sftp.remove("/a/b/bar")
+            with sftp.open("/a/foo") as f:
+                assert f.read() == b"a/foo+"
+            assert sorted(sftp.listdir("/a/b")) == ["new"]
+    assert tree(base_dir) == before
+
+
+@fixture
+def rooted_fs(memory_fs: MemoryFilesystem) -> RootedFilesystem:
+    memory_fs.makedirs("/home/user/a")
+    memory_fs.mkdir("/etc")
+    memory_fs.write_bytes("/home/user/a/foo", b"foo")
+    memory_fs.write_bytes("/etc/passwd", b"root")
+    return RootedFilesystem(memory_fs, "/home/user")
+
+
+def read(fs, path: str) -> bytes:
+    return fs.open(path, os.O_RDONLY).pread(100, 0)
+
+
+def test_rooted_paths(rooted_fs: RootedFilesystem):
+    assert read(rooted_fs, "/a/foo") == b"foo"
+    assert read(rooted_fs, "a/./foo") == b"foo"
+    assert read(rooted_fs, "/../../a/foo") == b"foo"
+    with raises(FileNotFoundError):
+        rooted_fs.stat("/../../etc/passwd")
+    rooted_fs.mkdir("/b")
+    assert rooted_fs.fs.stat("/home/user/b")
+    assert overlay_names(rooted_fs, "/") == ["a", "b"]
+
+
+def test_rooted_symlinks(rooted_fs: RootedFilesystem):
+    rooted_fs.symlink("/a", "/abs")
+    rooted_fs.symlink("../../..", "/a/up")
+    rooted_fs.symlink("/loop", "/loop")
+    assert read(rooted_fs, "/abs/foo") == b"foo"
+    assert read(rooted_fs, "/a/up/a/foo") == b"foo"
+    assert rooted_fs.readlink("/abs") == "/a"
+    assert stat.S_ISLNK(rooted_fs.lstat("/abs").st_mode)
+    with raises(OSError) as exc:
+        rooted_fs.stat("/loop")
+    assert exc.value.errno == errno.ELOOP
+
+    refusing = RootedFilesystem(rooted_fs.fs, "/home/user", symlinks="refuse")
+    assert stat.S_ISLNK(refusing.lstat("/abs").st_mode)
+    with raises(PermissionError):
+        refusing.stat("/abs")
+    with raises(PermissionError):
+        refusing.stat("/abs/foo")
+
+
+def test_rooted_cache(rooted_fs: RootedFilesystem):
+    for _ in range(3):
+        read(rooted_fs, "/a/foo")
+    assert rooted_fs.stats["hits"] == 2
+
+    rooted_fs.rename("/a", "/b")
+    rooted_fs.symlink("/b", "/a")
+    assert read(rooted_fs, "/a/foo") == b"foo"
+    rooted_fs.remove("/a")
+    rooted_fs.mkdir("/a")
+    with raises(FileNotFoundError):
+        read(rooted_fs, "/a/foo")
+
+    small = RootedFilesystem(rooted_fs.fs, "/home/user", cache_size=1)
+    small.stat("/a")
+    small.stat("/b")
+    small.stat("/a")
+    assert small.stats["hits"] == 0
+
+
+def test_rooted_cache_changed_elsewhere(tmp_dir: str):
+    root = os.path.join(tmp_dir, "root")
+    outside = os.path.join(tmp_dir, "outside")
+    os.makedirs(os.path.join(root, "d"))
+    os.mkdir(outside)
+    for path, data in ((os.path.join(root, "d", "secret"), b"inside"),
+                       (os.path.join(outside, "secret"), b"outside")):
+        with open(path, "wb") as f:
+            f.write(data)
+    fs = RootedFilesystem(LocalFilesystem(), root, symlinks="refuse")
+    assert read(fs, "/d/secret") == b"inside"
+
+    # Another user, or the host, swaps a directory for a link.
+    other = RootedFilesystem(LocalFilesystem(), root)
+    other.remove("/d/secret")
+    other.rmdir("/d")
+    os.symlink(outside, os.path.join(root, "d"))
+    with raises(PermissionError):
+        read(fs, "/d/secret")
+
+
+def test_user_root(user_key_path: str, tmp_dir: str):
+    root = os.path.join(tmp_dir, "root")
+    os.mkdir(root)
+    with Server({}) as s:
+        s.add_user("sample-user", user_key_path, root=root)
+        with s.client("sample-user") as c:
+            sftp = c.open_sftp()
+            assert sftp.normalize(".") == "/"
+            sftp.put(__file__, "/foo")
+            sftp.put(__file__, "../../bar")
+            assert sorted(sftp.listdir("/")) == ["bar", "foo"]
+            assert sorted(sftp.listdir("/..")) == ["bar", "foo"]
+    assert sorted(os.listdir(root)) == ["bar", "foo"]
+    assert sorted(os.listdir(tmp_dir)) == ["root"]
+
+
+def test_user_symlink_policy(user_key_path: str, tmp_dir: str):
+    os.symlink(tmp_dir, os.path.join(tmp_dir, "link"))
+    with Server({}) as s:
+        s.add_user("sample-user", user_key_path, root=tmp_dir,
+                   symlinks="refuse", cache_size=0)
+        fs = s.user_filesystem("sample-user")
+        assert (fs.symlinks, fs.cache_size) == ("refuse", 0)
+        with s.client("sample-user") as c:
+            with raises(PermissionError):
+                c.open_sftp().listdir("/link")
+        with raises(ValueError):
+            s.add_user("other-user", user_key_path, root=tmp_dir,
+                       symlinks="follow")
+        assert "other-user" not in s.users
+
+
+def test_copy_range(memory_fs: MemoryFilesystem, base_dir: str):
+    src = LocalFilesystem().open(os.path.join(base_dir, "a", "foo"),
+                                 os.O_RDONLY)
+    dst = memory_fs.open("/foo", os.O_WRONLY | os.O_CREAT)
+    assert copy_range(src, 2, dst, 1) == 3
+    assert copy_range(src, 0, dst, 0, 1) == 1
+    assert memory_fs.read_bytes("/foo") == b"afoo"
+    assert memory_fs.statvfs("/").f_bfree < memory_fs.statvfs("/").f_blocks
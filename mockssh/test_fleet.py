@@ -0,0 +1,33 @@
+import codecs
+
+from pytest import mark, raises
+
+from mockssh.fleet import ServerFleet
+
+
+@mark.fails_on_windows
+def test_fleet(fleet: ServerFleet):
+    assert len(fleet) == 8
+    assert len(set(fleet.addresses)) == 8
+    for server in fleet:
+        with server.client("sample-user") as c:
+            _, stdout, _ = c.exec_command("echo %d" % server.port)
+            assert codecs.decode(stdout.read().strip(), "utf8") == str(server.port)
+
+
+@mark.parametrize("fleet", [200], indirect=True)
+def test_large_fleet(fleet: ServerFleet):
+    assert len(set(port for _, port in fleet.addresses)) == 200
+    with fleet[-1].client("sample-user") as c:
+        assert c.get_transport().is_authenticated()
+
+
+def test_shared_users(fleet: ServerFleet, user_key_path: str):
+    fleet[0].add_user("new-user", user_key_path)
+    with fleet[1].client("new-user") as c:
+        assert c.get_transport().is_authenticated()
+
+
+def test_asyncio_engine_unsupported(user_key_path: str):
+    with raises(ValueError):
+        ServerFleet({"sample-user": user_key_path}, 2, engine="asyncio")
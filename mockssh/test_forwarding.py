@@ -0,0 +1,199 @@
+import os
+import socket
+import threading
+import time
+
+import paramiko
+from pytest import fixture, raises
+
+from mockssh import Server
+from typing import Iterator, Tuple
+
+
+@fixture
+def server(user_key_path: str) -> Iterator[Server]:
+    with Server({"sample-user": user_key_path}, forwarding=True) as s:
+        yield s
+
+
+@fixture
+def echo_server() -> Iterator[Tuple[str, int]]:
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(8)
+
+    def echo(conn):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                conn.sendall(data)
+
+    def run():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=run, daemon=True).start()
+    yield listener.getsockname()
+    listener.close()
+
+
+def open_tunnel(server: Server, destination: Tuple[str, int]):
+    c = server.client("sample-user")
+    return c, c.get_transport().open_channel("direct-tcpip", destination,
+                                             ("127.0.0.1", 0))
+
+
+def recv_all(channel) -> bytes:
+    chunks = []
+    while True:
+        data = channel.recv(65536)
+        if not data:
+            return b"".join(chunks)
+        chunks.append(data)
+
+
+def wait_for_tunnels(server: Server):
+    deadline = time.monotonic() + 5
+    while len(server.forwarder) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not len(server.forwarder)
+
+
+def test_forward(server: Server, echo_server: Tuple[str, int]):
+    c, channel = open_tunnel(server, echo_server)
+    with c:
+        channel.sendall(b"hello")
+        assert channel.recv(5) == b"hello"
+        channel.shutdown_write()
+        assert recv_all(channel) == b""
+        channel.close()
+
+    wait_for_tunnels(server)
+    summary = server.stats()["forward"]["{}:{}".format(*echo_server)]
+    assert summary["count"] == 1
+    assert summary["bytes_in"] == summary["bytes_out"] == 5
+
+
+def test_forward_large(server: Server, echo_server: Tuple[str, int]):
+    data = os.urandom(8 * 1024 * 1024)
+    c, channel = open_tunnel(server, echo_server)
+    with c:
+        def send():
+            channel.sendall(data)
+            channel.shutdown_write()
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        received = recv_all(channel)
+        sender.join()
+    assert received == data
+
+
+def test_forward_many(server: Server, echo_server: Tuple[str, int]):
+    with server.client("sample-user") as c:
+        channels = [c.get_transport().open_channel(
+            "direct-tcpip", echo_server, ("127.0.0.1", 0)) for _ in range(10)]
+        for i, channel in enumerate(channels):
+            channel.sendall(b"%d" % i)
+            channel.shutdown_write()
+        for i, channel in enumerate(channels):
+            assert recv_all(channel) == b"%d" % i
+
+
+def test_forward_host_name(server: Server, echo_server: Tuple[str, int]):
+    # Looked up away from the relay, then tried address by address.
+    c, channel = open_tunnel(server, ("localhost", echo_server[1]))
+    with c:
+        channel.sendall(b"hello")
+        channel.shutdown_write()
+        assert recv_all(channel) == b"hello"
+
+
+def test_forward_target_closes(server: Server):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+
+    def greet():
+        conn, _ = listener.accept()
+        with conn:
+            conn.sendall(b"bye")
+
+    t = threading.Thread(target=greet)
+    t.start()
+    c, channel = open_tunnel(server, listener.getsockname())
+    with c, listener:
+        assert recv_all(channel) == b"bye"
+        assert channel.eof_received
+    t.join()
+
+
+def test_forward_connect_failed(server: Server):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    destination = s.getsockname()
+    s.close()
+    c, channel = open_tunnel(server, destination)
+    with c:
+        # The channel is opened before connecting, and closed once that
+        # failed.
+        assert recv_all(channel) == b""
+        wait_for_tunnels(server)
+    summary = server.stats()["forward"]["{}:{}".format(*destination)]
+    assert summary["failed"] == 1
+    assert "duration" not in summary
+
+
+def test_forward_slow_destination(server: Server,
+                                  echo_server: Tuple[str, int]):
+    # A destination taking its time to accept, as the listen backlog is
+    # full, holds up neither the connection nor its other channels.
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(0)
+    filler = [socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+              for _ in range(8)]
+    for sock in filler:
+        sock.setblocking(False)
+        sock.connect_ex(listener.getsockname())
+    c, slow = open_tunnel(server, listener.getsockname())
+    with c, listener:
+        started = time.monotonic()
+        channel = c.get_transport().open_channel("direct-tcpip", echo_server,
+                                                 ("127.0.0.1", 0))
+        channel.sendall(b"hello")
+        channel.shutdown_write()
+        assert recv_all(channel) == b"hello"
+        assert time.monotonic() - started < 1
+        slow.close()
+    for sock in filler:
+        sock.close()
+
+
+def test_forwarding_disabled(user_key_path: str,
+                             echo_server: Tuple[str, int]):
+    # Unless enabled, the test host connects nowhere for clients.
+    with Server({"sample-user": user_key_path}) as s:
+        with s.client("sample-user") as c:
+            with raises(paramiko.ChannelException) as e:
+                c.get_transport().open_channel("direct-tcpip", echo_server,
+                                               ("127.0.0.1", 0))
+            assert (e.value.code ==
+                    paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED)
+
+
+def test_forward_asyncio_engine(user_key_path: str,
+                                echo_server: Tuple[str, int]):
+    with Server({"sample-user": user_key_path}, engine="asyncio",
+                forwarding=True) as s:
+        c, channel = open_tunnel(s, echo_server)
+        with c:
+            channel.sendall(b"hello")
+            channel.shutdown_write()
+            assert recv_all(channel) == b"hello"
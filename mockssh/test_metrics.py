@@ -0,0 +1,77 @@
+import os
+
+from pytest import mark
+
+from mockssh.metrics import Histogram, Metrics
+from mockssh.server import Server
+
+
+def test_histogram():
+    h = Histogram()
+    assert h.percentile(50) is None
+    for ms in range(1, 101):
+        h.add(ms / 1000.0)
+    summary = h.summary()
+    assert summary["count"] == 100
+    assert summary["min"] == 0.001
+    assert summary["max"] == 0.1
+    assert abs(summary["mean"] - 0.0505) < 1e-9
+    # Estimates are within a factor of two, and never above the maximum.
+    assert 0.05 <= summary["p50"] < 0.1
+    assert summary["p99"] == 0.1
+    assert sum(summary["buckets"].values()) == 100
+
+
+def test_metrics():
+    events = []
+    m = Metrics()
+    m.add_hook(lambda *event: events.append(event))
+    m.record("sftp", "read", {"latency": 0.5}, bytes=10)
+    m.record("sftp", "read", {"latency": 1.5}, bytes=5)
+    m.record("exec", "ls")
+    assert events[0] == ("sftp", "read", {"latency": 0.5}, {"bytes": 10})
+
+    stats = m.snapshot(reset=True)
+    assert stats["sftp"]["read"]["count"] == 2
+    assert stats["sftp"]["read"]["bytes"] == 15
+    assert stats["sftp"]["read"]["latency"]["total"] == 2.0
+    assert stats["exec"]["ls"] == {"count": 1}
+    assert m.snapshot() == {}
+
+
+@mark.fails_on_windows
+@mark.parametrize("engine", ["threading", "asyncio"])
+def test_server_stats(engine: str, user_key_path: str, tmp_dir: str):
+    users = {"sample-user": user_key_path}
+    with Server(users, engine=engine) as s:
+        s.commands.register("hello", stdout="hello\n")
+        with s.client("sample-user") as c:
+            for command in ("echo foo", "hello"):
+                _, stdout, _ = c.exec_command(command)
+                stdout.read()
+            sftp = c.open_sftp()
+            target = os.path.join(tmp_dir, "foo")
+            sftp.put(__file__, target)
+            sftp.get(target, os.path.join(tmp_dir, "bar"))
+            sftp.close()
+
+        stats = s.stats()
+        size = os.path.getsize(__file__)
+        assert stats["connection"]["publickey"]["count"] == 1
+        assert stats["connection"]["publickey"]["handshake"]["count"] == 1
+        assert stats["connection"]["publickey"]["auth"]["count"] == 1
+
+        echo = stats["exec"]["echo foo"]
+        assert echo["count"] == 1
+        assert echo["stdout_bytes"] == 4
+        assert echo["stderr_bytes"] == 0
+        assert echo["spawn"]["count"] == echo["runtime"]["count"] == 1
+        assert stats["exec"]["hello"]["emulated"] == 1
+
+        assert stats["sftp"]["open"]["count"] == 2
+        assert stats["sftp"]["write"]["bytes"] == size
+        assert stats["sftp"]["read"]["bytes"] == size
+        assert stats["sftp"]["read"]["latency"]["count"] >= 2
+
+        s.reset_stats()
+        assert s.stats() == {}
@@ -0,0 +1,98 @@
+import threading
+
+import paramiko
+from pytest import mark, raises
+
+from mockssh.pool import WorkerPool
+from mockssh.server import Server
+
+
+def test_bounded_workers():
+    pool = WorkerPool(max_workers=2)
+    release = threading.Event()
+    for _ in range(5):
+        assert pool.submit(release.wait)
+    stats = pool.stats()
+    assert stats["workers"] == 2
+    assert stats["running"] + stats["queued"] == 5
+    release.set()
+
+
+def test_reject_when_queue_is_full():
+    pool = WorkerPool(max_workers=1, max_queued=1, overflow="reject")
+    started = threading.Event()
+    release = threading.Event()
+
+    def job():
+        started.set()
+        release.wait()
+
+    assert pool.submit(job)
+    started.wait()
+    assert pool.submit(job)
+    assert not pool.submit(job)
+    assert pool.stats()["rejected"] == 1
+    release.set()
+
+
+def test_block_until_timeout():
+    pool = WorkerPool(max_workers=1, max_queued=1, timeout=0.1)
+    release = threading.Event()
+    assert pool.submit(release.wait)
+    assert pool.submit(release.wait)
+    assert not pool.submit(release.wait)
+    release.set()
+
+
+def test_defer_when_queue_is_full():
+    pool = WorkerPool(max_workers=1, max_queued=1)
+    release = threading.Event()
+    done = threading.Semaphore(0)
+    assert pool.submit(release.wait)
+    assert pool.submit(done.release)
+    assert pool.submit(done.release, defer=True)
+    assert pool.stats()["deferred"] == 1
+    release.set()
+    for _ in range(2):
+        assert done.acquire(timeout=5)
+    assert pool.stats()["deferred"] == 0
+
+
+def test_reuses_idle_workers():
+    pool = WorkerPool()
+    done = threading.Semaphore(0)
+    for _ in range(10):
+        pool.submit(done.release)
+        done.acquire()
+    assert pool.stats()["workers"] == 1
+
+
+def test_invalid_overflow_policy():
+    with raises(ValueError):
+        WorkerPool(overflow="drop")
+
+
+@mark.fails_on_windows
+def test_server_rejects_commands(user_key_path: str):
+    users = {"sample-user": user_key_path}
+    with Server(users, max_workers=1, max_queued=1, overflow="reject") as s:
+        with s.client("sample-user") as c:
+            c.exec_command("sleep 1")
+            c.exec_command("sleep 1")
+            with raises(paramiko.SSHException):
+                c.exec_command("sleep 1")
+            assert s.workers.stats()["rejected"] == 1
+
+
+@mark.fails_on_windows
+def test_server_defers_commands(user_key_path: str):
+    users = {"sample-user": user_key_path}
+    with Server(users, max_workers=1, max_queued=1) as s:
+        with s.client("sample-user") as c:
+            _, stdout, _ = c.exec_command("head -c 20000000 /dev/zero")
+            # Waiting for room would stall the transport, and the output of
+            # the running command with it.
+            queued = [c.exec_command("echo %d" % i)[1] for i in range(2)]
+            assert len(stdout.read()) == 20000000
+            assert [out.read() for out in queued] == [b"0\n", b"1\n"]
+            assert s.workers.stats()["rejected"] == 0
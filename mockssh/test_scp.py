@@ -0,0 +1,280 @@
+import os
+import shutil
+import stat
+import subprocess
+
+from pytest import fixture, mark, raises
+
+from mockssh import Server
+from mockssh.filesystem import MemoryFilesystem
+from mockssh.scp import ScpCommand
+from typing import Iterator
+
+
+class ScpChannel(object):
+    """The client end of an `scp -t` or `scp -f` command."""
+
+    def __init__(self, server: Server, command: str) -> None:
+        self.client = server.client("sample-user")
+        self.channel = self.client.get_transport().open_session()
+        self.channel.exec_command(command)
+        self.buffer = b""
+
+    def read(self, n):
+        while len(self.buffer) < n:
+            data = self.channel.recv(65536)
+            if not data:
+                break
+            self.buffer += data
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    def readline(self):
+        line = b""
+        while not line.endswith(b"\n"):
+            c = self.read(1)
+            if not c:
+                break
+            line += c
+        return line
+
+    def send(self, data):
+        self.channel.sendall(data)
+
+    def close(self):
+        self.channel.shutdown_write()
+        status = self.channel.recv_exit_status()
+        self.client.close()
+        return status
+
+
+def upload(server: Server, target: str, records, options="") -> int:
+    scp = ScpChannel(server, "scp {} -t {}".format(options, target).strip())
+    assert scp.read(1) == b"\0"
+    for record in records:
+        scp.send(record)
+        if record.startswith(b"C"):
+            assert scp.read(1) == b"\0"
+            size = int(record.split()[1])
+            scp.send(b"x" * size + b"\0")
+        assert scp.read(1) == b"\0"
+    return scp.close()
+
+
+@fixture
+def memory_server(user_key_path: str) -> Iterator[Server]:
+    fs = MemoryFilesystem()
+    with Server({"sample-user": user_key_path}, filesystem=fs) as s:
+        yield s
+
+
+def test_pattern():
+    for command in ("scp -t /tmp", "scp -r -t -- /tmp", "scp -pf a b",
+                    "scp -v -d -t 'a b'"):
+        assert ScpCommand.PATTERN.fullmatch(command)
+    for command in ("scp a b", "scp -r a host:b", "scpx -t a", "scp -t"):
+        assert not ScpCommand.PATTERN.fullmatch(command)
+
+
+def test_parse():
+    assert ScpCommand.parse("scp -r -t 'a b'", posix=True) == \
+        ({"-r", "-t"}, ["a b"])
+    assert ScpCommand.parse(r'scp -f C:\tmp\a "C:\tmp\b c"',
+                            posix=False) == \
+        ({"-f"}, [r"C:\tmp\a", r"C:\tmp\b c"])
+
+
+@mark.fails_on_windows
+def test_upload(server: Server, tmp_dir: str):
+    target = os.path.join(tmp_dir, "foo")
+    assert upload(server, target, [b"C0640 5 ignored\n"]) == 0
+    assert open(target, "rb").read() == b"xxxxx"
+
+    assert upload(server, tmp_dir, [b"C0600 3 bar\n"]) == 0
+    assert open(os.path.join(tmp_dir, "bar"), "rb").read() == b"xxx"
+
+
+@mark.fails_on_windows
+def test_upload_recursive(server: Server, tmp_dir: str):
+    records = [b"D0755 0 top\n", b"C0644 1 a\n",
+               b"T1400000000 0 1400000000 0\n", b"D0700 0 sub\n",
+               b"T1500000000 500000 1500000000 0\n", b"C0600 2 b\n",
+               b"E\n", b"E\n"]
+    assert upload(server, tmp_dir, records, "-r -p") == 0
+    top = os.path.join(tmp_dir, "top")
+    assert open(os.path.join(top, "a"), "rb").read() == b"x"
+    assert open(os.path.join(top, "sub", "b"), "rb").read() == b"xx"
+    assert stat.S_IMODE(os.stat(os.path.join(top, "sub")).st_mode) == 0o700
+    assert stat.S_IMODE(os.stat(os.path.join(top, "sub", "b")).st_mode) == \
+        0o600
+    assert os.stat(os.path.join(top, "sub")).st_mtime == 1400000000
+    assert os.stat(os.path.join(top, "sub", "b")).st_mtime == 1500000000.5
+    assert os.stat(os.path.join(top, "a")).st_mtime > 1500000000
+
+
+@mark.fails_on_windows
+def test_upload_errors(server: Server, tmp_dir: str):
+    scp = ScpChannel(server, "scp -t {}".format(tmp_dir))
+    assert scp.read(1) == b"\0"
+    scp.send(b"C0644 1 missing/../x\n")
+    assert scp.readline().startswith(b"\2scp: protocol error")
+    assert scp.close() == 1
+
+    scp = ScpChannel(server, "scp -t {}".format(tmp_dir))
+    assert scp.read(1) == b"\0"
+    scp.send(b"D0755 0 dir\n")
+    assert scp.readline() == b"\2scp: received directory without -r\n"
+    assert scp.close() == 1
+
+    scp = ScpChannel(server, "scp -d -t {}".format(
+        os.path.join(tmp_dir, "missing")))
+    assert scp.readline().startswith(b"\2scp: ")
+    assert scp.close() == 1
+
+
+@mark.fails_on_windows
+def test_download(server: Server, tmp_dir: str):
+    path = os.path.join(tmp_dir, "foo")
+    data = os.urandom(3 * 1024 * 1024 + 1)
+    with open(path, "wb") as f:
+        f.write(data)
+    os.chmod(path, 0o640)
+
+    scp = ScpChannel(server, "scp -f {}".format(path))
+    scp.send(b"\0")
+    assert scp.readline() == b"C0640 %d foo\n" % len(data)
+    scp.send(b"\0")
+    assert scp.read(len(data)) == data
+    assert scp.read(1) == b"\0"
+    scp.send(b"\0")
+    assert scp.close() == 0
+
+
+@mark.fails_on_windows
+def test_download_recursive(server: Server, tmp_dir: str):
+    os.makedirs(os.path.join(tmp_dir, "top", "sub"))
+    with open(os.path.join(tmp_dir, "top", "sub", "a"), "wb") as f:
+        f.write(b"abc")
+
+    scp = ScpChannel(server, "scp -r -f {}".format(
+        os.path.join(tmp_dir, "top")))
+    scp.send(b"\0")
+    assert scp.readline().endswith(b" 0 top\n")
+    scp.send(b"\0")
+    assert scp.readline().endswith(b" 0 sub\n")
+    scp.send(b"\0")
+    assert scp.readline().endswith(b" 3 a\n")
+    scp.send(b"\0")
+    assert scp.read(4) == b"abc\0"
+    scp.send(b"\0")
+    for _ in range(2):
+        assert scp.readline() == b"E\n"
+        scp.send(b"\0")
+    assert scp.close() == 0
+
+
+@mark.fails_on_windows
+def test_download_glob(server: Server, tmp_dir: str):
+    for name in ("b.txt", "a.txt", "c.log", ".d.txt"):
+        with open(os.path.join(tmp_dir, name), "wb") as f:
+            f.write(b"x")
+
+    scp = ScpChannel(server, "scp -f {}/*.txt {}/none*".format(tmp_dir,
+                                                               tmp_dir))
+    scp.send(b"\0")
+    for name in (b"a.txt", b"b.txt"):
+        assert scp.readline().endswith(b" 1 %s\n" % name)
+        scp.send(b"\0")
+        assert scp.read(2) == b"x\0"
+        scp.send(b"\0")
+    assert scp.readline() == b"\1scp: %s/none*: No such file or directory\n" \
+        % tmp_dir.encode()
+    assert scp.close() == 1
+
+
+def test_shell_expansions(server: Server):
+    # Left to the host's scp, and its shell.
+    for command in ("scp -f ~/a", "scp -t $HOME", "scp -f `pwd`/a"):
+        assert server.scp.lookup(command) is None
+    assert server.scp.lookup("scp -f /tmp/*.txt") is not None
+
+
+@mark.fails_on_windows
+def test_download_errors(server: Server, tmp_dir: str):
+    scp = ScpChannel(server, "scp -f {} {}".format(
+        os.path.join(tmp_dir, "missing"), tmp_dir))
+    scp.send(b"\0")
+    assert scp.readline() == b"\1scp: %s: No such file or directory\n" % \
+        os.path.join(tmp_dir, "missing").encode()
+    assert scp.readline() == b"\1scp: %s: not a regular file\n" % \
+        tmp_dir.encode()
+    assert scp.close() == 1
+
+
+@mark.fails_on_windows
+def test_memory_filesystem(memory_server: Server):
+    fs = memory_server.filesystem
+    fs.makedirs("/srv")
+    assert upload(memory_server, "srv", [b"D0755 0 app\n",
+                                         b"T1500000000 0 1400000000 0\n",
+                                         b"C0644 4 run\n", b"E\n"],
+                  "-r -p") == 0
+    assert fs.read_bytes("/srv/app/run") == b"xxxx"
+    st = fs.stat("/srv/app/run")
+    assert (st.st_atime, st.st_mtime) == (1400000000, 1500000000)
+
+    scp = ScpChannel(memory_server, "scp -f /s*/[a]pp/r?n")
+    scp.send(b"\0")
+    assert scp.readline() == b"C0644 4 run\n"
+    scp.send(b"\0")
+    assert scp.read(5) == b"xxxx\0"
+    scp.send(b"\0")
+    assert scp.close() == 0
+
+
+@mark.fails_on_windows
+def test_commands_cleared(server: Server, tmp_dir: str):
+    # scp is not one of the registered commands.
+    server.commands.clear()
+    target = os.path.join(tmp_dir, "foo")
+    assert upload(server, target, [b"C0640 5 foo\n"]) == 0
+    assert open(target, "rb").read() == b"xxxxx"
+
+
+def test_disabled(user_key_path: str):
+    with Server({"sample-user": user_key_path}, scp=False) as s:
+        assert s.scp is None
+        assert s.emulated_command("scp -t /tmp") is None
+
+
+@mark.skipif(shutil.which("scp") is None, reason="requires OpenSSH's scp")
+@mark.fails_on_windows
+def test_openssh_client(server: Server, tmp_dir: str, user_key_path: str):
+    key = os.path.join(tmp_dir, "key")
+    shutil.copy(user_key_path, key)
+    os.chmod(key, 0o600)
+    source = os.path.join(tmp_dir, "source")
+    os.makedirs(os.path.join(source, "sub"))
+    data = os.urandom(1024 * 1024)
+    with open(os.path.join(source, "sub", "data"), "wb") as f:
+        f.write(data)
+
+    def scp(*args):
+        subprocess.check_call(
+            ["scp", "-O", "-q", "-r", "-P", str(server.port), "-i", key,
+             "-o", "BatchMode=yes", "-o", "IdentitiesOnly=yes",
+             "-o", "StrictHostKeyChecking=no",
+             "-o", "UserKnownHostsFile=/dev/null"] + list(args),
+            stderr=subprocess.DEVNULL)
+
+    remote = "sample-user@{}:".format(server.host)
+    scp(source, remote + os.path.join(tmp_dir, "uploaded"))
+    scp(remote + os.path.join(tmp_dir, "uploaded"),
+        os.path.join(tmp_dir, "downloaded"))
+    with open(os.path.join(tmp_dir, "downloaded", "sub", "data"), "rb") as f:
+        assert f.read() == data
+    with raises(subprocess.CalledProcessError):
+        scp(remote + os.path.join(tmp_dir, "missing"), tmp_dir)
+    # Served in-process rather than by the host's scp.
+    assert all(summary.get("emulated")
+               for summary in server.stats()["exec"].values())
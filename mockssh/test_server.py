@@ -1,7 +1,10 @@
 import codecs
+import os
 import platform
+import socket
 import subprocess
 import tempfile
+import threading
 
 import paramiko
 from pytest import mark, raises
@@ -107,3 +110,91 @@ def test_overwrite_handler(server: Server, monkeypatch: MonkeyPatch):
         assert client.connect(server.host, server.port, "foo", "bar") is None
         with raises(paramiko.ssh_exception.AuthenticationException):
             client.connect(server.host, server.port, "fooooo", "barrrr")
+
+
+def _host_key_name(server: Server) -> str:
+    with server.client("sample-user") as c:
+        return c.get_transport().get_remote_server_key().get_name()
+
+
+def test_ephemeral_host_key(user_key_path: str):
+    host_key = mockssh.server.generate_ed25519_key()
+    with Server({"sample-user": user_key_path}, host_key=host_key) as s:
+        assert _host_key_name(s) == "ssh-ed25519"
+
+
+def test_host_key_path(user_key_path: str, tmp_dir: str):
+    path = os.path.join(tmp_dir, "host-key")
+    paramiko.ECDSAKey.generate().write_private_key_file(path)
+    with Server({"sample-user": user_key_path}, host_key=path,
+                host_key_type="ecdsa-sha2-nistp256") as s:
+        assert _host_key_name(s) == "ecdsa-sha2-nistp256"
+
+
+def test_backlog(user_key_path: str):
+    # More connections than the backlog holds, opened at once, are all
+    # accepted and authenticated.
+    with Server({"sample-user": user_key_path}, backlog=2) as s:
+        assert s.backlog == 2
+        barrier = threading.Barrier(12)
+        clients = []
+        errors = []
+
+        def connect():
+            barrier.wait()
+            try:
+                clients.append(s.client("sample-user"))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=connect) for _ in range(12)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        try:
+            assert errors == []
+            assert len(clients) == 12
+            assert all(c.get_transport().is_authenticated() for c in clients)
+        finally:
+            for c in clients:
+                c.close()
+
+
+def test_peer(server: Server, user_key_path: str):
+    with Server({"other-user": user_key_path}, peer=server) as s:
+        assert s.commands is server.commands
+        assert _host_key_name(s) == _host_key_name(server)
+        for uid in ("sample-user", "other-user"):
+            with server.client(uid) as c1, s.client(uid) as c2:
+                assert c1.get_transport().is_authenticated()
+                assert c2.get_transport().is_authenticated()
+
+
+def test_connection_burst(server: Server):
+    # Connections pending at once are all accepted in one wakeup.
+    socks = [socket.create_connection((server.host, server.port), timeout=5)
+             for _ in range(50)]
+    try:
+        for sock in socks:
+            assert sock.recv(4).startswith(b"SSH-")
+    finally:
+        for sock in socks:
+            sock.close()
+
+    clients = []
+    lock = threading.Lock()
+
+    def connect():
+        c = server.client("sample-user")
+        with lock:
+            clients.append(c)
+
+    threads = [threading.Thread(target=connect) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(clients) == 10
+    for c in clients:
+        c.close()
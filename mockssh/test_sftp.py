@@ -1,8 +1,17 @@
+import collections
+import hashlib
 import os
 import stat
+import time
 
 from pytest import fixture, mark, raises
+from paramiko.sftp import (CMD_CLOSE, CMD_EXTENDED, CMD_EXTENDED_REPLY,
+                           CMD_STAT, CMD_WRITE, int64)
 from paramiko.sftp_client import SFTPClient
+from typing import Iterator
+
+from mockssh import Server
+from mockssh.sftp import ReadaheadCache
 
 
 def files_equal(fname1: str, fname2: str) -> bool:
@@ -140,3 +149,208 @@ def _test_sftp_unsupported_calls(server, unsupported_call):
             with raises(IOError) as exc:
                 getattr(sftp, meth)(*args)
             assert str(exc.value) == "Operation unsupported"
+
+
+def test_random_access(sftp_client: SFTPClient, tmp_dir: str):
+    test_file = os.path.join(tmp_dir, "foo")
+    open(test_file, "wb").write(b"0123456789")
+
+    with sftp_client.open(test_file, "r+") as f:
+        f.seek(5)
+        assert f.read(3) == b"567"
+        f.seek(2)
+        f.write(b"ab")
+        f.seek(12)
+        f.write(b"z")
+    assert open(test_file, "rb").read() == b"01ab456789\0\0z"
+
+
+def test_append(sftp_client: SFTPClient, tmp_dir: str):
+    test_file = os.path.join(tmp_dir, "foo")
+    open(test_file, "wb").write(b"foo")
+
+    with sftp_client.open(test_file, "a") as f:
+        f.write(b"bar")
+    assert open(test_file, "rb").read() == b"foobar"
+
+
+def test_large_put_get(sftp_client: SFTPClient, tmp_dir: str):
+    source = os.path.join(tmp_dir, "source")
+    with open(source, "wb") as f:
+        f.write(os.urandom(4 * 1024 * 1024))
+    uploaded = os.path.join(tmp_dir, "uploaded")
+    downloaded = os.path.join(tmp_dir, "downloaded")
+    sftp_client.put(source, uploaded, confirm=True)
+    sftp_client.get(uploaded, downloaded)
+    assert files_equal(source, uploaded)
+    assert files_equal(source, downloaded)
+
+
+def test_readahead_cache():
+    data = bytes(range(256)) * 64
+    preads = []
+
+    def pread(offset, length):
+        preads.append((offset, length))
+        return data[offset:offset + length]
+
+    stats = collections.Counter()
+    cache = ReadaheadCache(pread, 1024, 2, stats)
+    chunks = [cache.read(offset, 100) for offset in range(0, len(data), 100)]
+    assert b"".join(chunks) == data
+    assert stats["hits"] > 0.9 * len(chunks)
+    assert all(length == 1024 for _, length in preads[:-2])
+    assert len(cache.blocks) <= 2
+
+
+def test_readahead_random_access():
+    data = os.urandom(10000)
+    stats = collections.Counter()
+    cache = ReadaheadCache(lambda o, n: data[o:o + n], 1024, 4, stats)
+    assert cache.read(5000, 10) == data[5000:5010]
+    assert not cache.blocks
+    assert cache.read(5010, 3000) == data[5010:8010]
+    assert cache.read(8010, 5000) == data[8010:]
+    cache.invalidate()
+    assert not cache.blocks
+
+
+def test_readahead_other_handle_writes(sftp_client: SFTPClient, tmp_dir: str):
+    target = os.path.join(tmp_dir, "foo")
+    with open(target, "wb") as f:
+        f.write(b"a" * 1024 * 1024)
+    with sftp_client.open(target, "rb") as a, \
+            sftp_client.open(target, "r+b") as b:
+        assert a.read(4) == b"aaaa"
+        b.seek(64 * 1024)
+        b.write(b"BBBB")
+        b.flush()
+        a.seek(64 * 1024)
+        assert a.read(4) == b"BBBB"
+
+
+def test_listdir_large(sftp_client: SFTPClient, tmp_dir: str):
+    names = ["f%05d" % i for i in range(1000)]
+    for name in names:
+        open(os.path.join(tmp_dir, name), "w").close()
+    assert sorted(sftp_client.listdir(tmp_dir)) == names
+
+
+@mark.fails_on_windows
+def test_listdir_symlinks(sftp_client: SFTPClient, tmp_dir: str):
+    open(os.path.join(tmp_dir, "foo"), "w").write("foo")
+    os.symlink(os.path.join(tmp_dir, "foo"), os.path.join(tmp_dir, "link"))
+    os.symlink(os.path.join(tmp_dir, "missing"), os.path.join(tmp_dir, "dangling"))
+
+    attrs = {a.filename: a for a in sftp_client.listdir_attr(tmp_dir)}
+    assert sorted(attrs) == ["dangling", "foo", "link"]
+    assert stat.S_ISLNK(attrs["link"].st_mode)
+    assert stat.S_ISREG(attrs["foo"].st_mode)
+
+
+def test_check_file(sftp_client: SFTPClient, tmp_dir: str):
+    test_file = os.path.join(tmp_dir, "foo")
+    data = os.urandom(3000)
+    open(test_file, "wb").write(data)
+
+    with sftp_client.open(test_file) as f:
+        assert f.check("sha256") == hashlib.sha256(data).digest()
+        assert f.check("md5", 1000, 1000) == \
+            hashlib.md5(data[1000:2000]).digest()
+        assert f.check("sha1", 0, 0, 1024) == b"".join(
+            hashlib.sha1(data[i:i + 1024]).digest()
+            for i in range(0, 3000, 1024))
+        with raises(IOError):
+            f.check("crc32")
+
+    t, msg = sftp_client._request(CMD_EXTENDED, "check-file-name", test_file,
+                                  "sha512", int64(0), int64(0), 0)
+    assert t == CMD_EXTENDED_REPLY
+    assert msg.get_text() == "check-file"
+    assert msg.get_text() == "sha512"
+    assert msg.get_remainder() == hashlib.sha512(data).digest()
+
+
+def test_copy_data(sftp_client: SFTPClient, tmp_dir: str):
+    src_file = os.path.join(tmp_dir, "foo")
+    dst_file = os.path.join(tmp_dir, "bar")
+    data = os.urandom(3 * 1024 * 1024)
+    open(src_file, "wb").write(data)
+
+    with sftp_client.open(src_file) as src, \
+            sftp_client.open(dst_file, "w") as dst:
+        sftp_client._request(CMD_EXTENDED, "copy-data", src.handle, int64(0),
+                             int64(0), dst.handle, int64(0))
+        sftp_client._request(CMD_EXTENDED, "copy-data", src.handle, int64(10),
+                             int64(5), dst.handle, int64(len(data)))
+    assert open(dst_file, "rb").read() == data + data[10:15]
+
+    with sftp_client.open(src_file, "r+") as f:
+        with raises(IOError):
+            sftp_client._request(CMD_EXTENDED, "copy-data", f.handle,
+                                 int64(0), int64(10), f.handle, int64(5))
+
+
+def test_statvfs(sftp_client: SFTPClient, tmp_dir: str):
+    t, msg = sftp_client._request(CMD_EXTENDED, "statvfs@openssh.com",
+                                  tmp_dir)
+    assert t == CMD_EXTENDED_REPLY
+    st = os.statvfs(tmp_dir)
+    assert msg.get_int64() == st.f_bsize
+    assert msg.get_int64() == st.f_frsize
+    assert msg.get_int64() == st.f_blocks
+
+    with raises(IOError):
+        sftp_client._request(CMD_EXTENDED, "statvfs@openssh.com",
+                             os.path.join(tmp_dir, "missing"))
+
+
+@fixture
+def concurrent_server(user_key_path: str) -> Iterator[Server]:
+    with Server({"sample-user": user_key_path}, sftp_workers=4) as s:
+        yield s
+
+
+class Responses(object):
+
+    def __init__(self):
+        self.received = []
+
+    def _async_response(self, t, msg, num):
+        self.received.append(num)
+
+    def wait(self, sftp_client, count):
+        while len(self.received) < count:
+            sftp_client._read_response()
+
+
+def test_concurrent_requests(concurrent_server: Server, tmp_dir: str):
+    sftp_client = concurrent_server.client("sample-user").open_sftp()
+    concurrent_server.faults.add("stat", delay=0.5)
+    responses = Responses()
+    started = time.perf_counter()
+    for i in range(4):
+        sftp_client._async_request(responses, CMD_STAT,
+                                   os.path.join(tmp_dir, str(i)))
+    responses.wait(sftp_client, 4)
+    assert time.perf_counter() - started < 1.5
+
+
+def test_concurrent_requests_per_handle_order(concurrent_server: Server,
+                                              tmp_dir: str):
+    test_file = os.path.join(tmp_dir, "foo")
+    sftp_client = concurrent_server.client("sample-user").open_sftp()
+    concurrent_server.faults.add("write", delay=0.01, jitter=0.01)
+    responses = Responses()
+    with sftp_client.open(test_file, "w") as f:
+        sent = [sftp_client._async_request(responses, CMD_WRITE, f.handle,
+                                           int64(0), b"%02d" % i)
+                for i in range(20)]
+        responses.wait(sftp_client, 20)
+    assert responses.received == sent
+    assert open(test_file, "rb").read() == b"19"
+
+    sftp_client.put(__file__, test_file)
+    assert files_equal(test_file, __file__)
+    with raises(IOError):
+        sftp_client._request(CMD_CLOSE, f.handle)
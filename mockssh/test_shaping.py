@@ -0,0 +1,127 @@
+import os
+import time
+
+import paramiko
+from pytest import mark, raises
+
+from mockssh.server import Server
+from mockssh.shaping import FaultInjector, NetworkProfile, TokenBucket
+
+
+def test_token_bucket():
+    bucket = TokenBucket(1000, burst=100)
+    assert bucket.reserve(100) == 0
+    # Callers queue up behind each other's debt.
+    assert abs(bucket.reserve(100) - 0.1) < 0.01
+    assert abs(bucket.reserve(100) - 0.2) < 0.01
+
+
+def test_network_profile():
+    assert NetworkProfile().buckets() == (None, None)
+    private = NetworkProfile(bandwidth=1000)
+    assert private.buckets() != private.buckets()
+    shared = NetworkProfile(bandwidth=1000, shared=True)
+    assert shared.buckets() == shared.buckets()
+    jittery = NetworkProfile(latency=0.1, jitter=0.05, seed=1)
+    assert all(0.05 <= jittery.delay() <= 0.15 for _ in range(100))
+
+
+def test_fault_injector():
+    faults = FaultInjector(seed=1)
+    assert not faults
+    fault = faults.add("open", status=paramiko.SFTP_FAILURE, times=2)
+    faults.add("*", probability=0.5)
+    assert faults.apply("stat") is None
+    assert faults.apply("open") == paramiko.SFTP_FAILURE
+    assert faults.apply("open") == paramiko.SFTP_FAILURE
+    assert faults.apply("open") is None
+    assert fault.hits == 2
+    faults.clear()
+    assert not faults
+
+
+def test_bandwidth(user_key_path: str, tmp_dir: str):
+    users = {"sample-user": user_key_path}
+    network = NetworkProfile(bandwidth=1024 * 1024)
+    target = os.path.join(tmp_dir, "foo")
+    with open(target, "wb") as f:
+        f.write(os.urandom(1024 * 1024))
+    with Server(users, network=network) as s:
+        with s.client("sample-user") as c:
+            sftp = c.open_sftp()
+            started = time.monotonic()
+            sftp.get(target, os.path.join(tmp_dir, "bar"))
+            elapsed = time.monotonic() - started
+    # The initial burst is 100 kB: the rest takes 0.9 s at least.
+    assert elapsed > 0.8
+
+
+def test_latency_pipelined(user_key_path: str, tmp_dir: str):
+    # Data sent while earlier data is held back is not delayed behind it:
+    # latency does not cap bandwidth at a read per latency.
+    source = os.path.join(tmp_dir, "foo")
+    with open(source, "wb") as f:
+        f.write(os.urandom(8 * 1024 * 1024))
+    users = {"sample-user": user_key_path}
+    with Server(users, network=NetworkProfile(latency=0.1)) as s:
+        with s.client("sample-user") as c:
+            sftp = c.open_sftp()
+            started = time.monotonic()
+            sftp.put(source, os.path.join(tmp_dir, "bar"))
+            elapsed = time.monotonic() - started
+    # At 256 KiB per latency, this took 3.2 s at least.
+    assert elapsed < 2
+
+
+@mark.fails_on_windows
+def test_user_latency(user_key_path: str):
+    with Server({}) as s:
+        s.add_user("sample-user", user_key_path,
+                   network=NetworkProfile(latency=0.2))
+        with s.client("sample-user") as c:
+            started = time.monotonic()
+            _, stdout, _ = c.exec_command("echo foo")
+            assert stdout.read() == b"foo\n"
+            assert time.monotonic() - started > 0.2
+
+
+@mark.fails_on_windows
+def test_drop_after(user_key_path: str):
+    users = {"sample-user": user_key_path}
+    with Server(users, network=NetworkProfile(drop_after=64 * 1024)) as s:
+        with s.client("sample-user") as c:
+            with raises((EOFError, OSError, paramiko.SSHException)):
+                for _ in range(100):
+                    _, stdout, _ = c.exec_command("head -c 4096 /dev/zero")
+                    stdout.read()
+            assert not c.get_transport().is_active()
+
+
+def test_latency_per_request(user_key_path: str, tmp_dir: str):
+    with Server({}) as s:
+        s.add_user("sample-user", user_key_path,
+                   network=NetworkProfile(latency=0.2))
+        with s.client("sample-user") as c:
+            sftp = c.open_sftp()
+            started = time.monotonic()
+            for _ in range(3):
+                sftp.stat(tmp_dir)
+            elapsed = time.monotonic() - started
+    # paramiko reads each request in several calls: it is delayed once.
+    assert 0.6 <= elapsed < 1.0
+
+
+def test_sftp_faults(server: Server, tmp_dir: str):
+    target = os.path.join(tmp_dir, "foo")
+    with server.client("sample-user") as c:
+        sftp = c.open_sftp()
+        server.faults.add("stat", delay=0.2, times=1)
+        server.faults.add("open", status=paramiko.SFTP_FAILURE, times=1)
+        started = time.monotonic()
+        with raises(FileNotFoundError):
+            sftp.stat(target)
+        assert time.monotonic() - started > 0.2
+        with raises(IOError):
+            sftp.put(__file__, target)
+        sftp.put(__file__, target)
+        assert os.path.exists(target)
@@ -0,0 +1,104 @@
+import os
+import sys
+
+from pytest import fixture, mark, raises
+
+from mockssh.filesystem import MemoryFilesystem
+from mockssh.fleet import ServerFleet
+from mockssh.server import Server
+from mockssh.shaping import NetworkProfile
+from mockssh.sharding import fork_supported, reuseport_supported
+from typing import Iterator
+
+pytestmark = mark.skipif(not fork_supported(), reason="requires fork()")
+
+
+@fixture
+def sharded_server(user_key_path: str) -> Iterator[Server]:
+    users = {"sample-user": user_key_path}
+    s = Server(users, processes=2)
+    s.commands.register("pid", lambda c: c.stdout.write(
+        str(os.getpid()).encode("ascii")))
+    with s:
+        yield s
+
+
+def run(server: Server, uid: str, command: str) -> bytes:
+    with server.client(uid) as c:
+        _, stdout, _ = c.exec_command(command)
+        return stdout.read()
+
+
+def test_sharded_exec(sharded_server: Server):
+    pids = set()
+    for _ in range(20):
+        pids.add(int(run(sharded_server, "sample-user", "pid")))
+    assert os.getpid() not in pids
+    # Elsewhere, SO_REUSEPORT does not spread connections among sockets.
+    if reuseport_supported() and sys.platform.startswith("linux"):
+        assert len(pids) == 2
+    assert run(sharded_server, "sample-user", "echo foo") == b"foo\n"
+
+
+def test_sharded_add_user(sharded_server: Server, user_key_path: str):
+    sharded_server.add_user("other-user", user_key_path)
+    for _ in range(4):
+        assert run(sharded_server, "other-user", "echo foo") == b"foo\n"
+
+    # Refused as a whole when workers cannot be given the user.
+    network = NetworkProfile(bandwidth=1000, shared=True)
+    with raises(ValueError):
+        sharded_server.add_user("third-user", user_key_path, network=network)
+    assert "third-user" not in sharded_server.users
+
+
+def test_sharded_commands(sharded_server: Server):
+    sharded_server.commands.register("hello", stdout="hello\n")
+    for _ in range(4):
+        assert run(sharded_server, "sample-user", "hello") == b"hello\n"
+    with raises(ValueError):
+        sharded_server.commands.register("bye", lambda c: None)
+    assert sharded_server.commands.lookup("bye") is None
+    sharded_server.commands.clear()
+    assert run(sharded_server, "sample-user", "pid") == b""
+
+
+def test_sharded_changes_refused(sharded_server: Server):
+    with raises(RuntimeError):
+        sharded_server.faults.add("open", delay=1)
+    assert not sharded_server.faults
+    with raises(RuntimeError):
+        sharded_server.network = NetworkProfile(latency=1)
+    with raises(RuntimeError):
+        sharded_server.filesystem = MemoryFilesystem()
+
+
+def test_sharded_memory_filesystem(user_key_path: str):
+    with raises(ValueError):
+        Server({"sample-user": user_key_path}, processes=2,
+               filesystem=MemoryFilesystem())
+
+
+def test_sharded_stats(sharded_server: Server):
+    for _ in range(6):
+        run(sharded_server, "sample-user", "echo foo")
+    stats = sharded_server.stats(reset=True)
+    assert stats["exec"]["echo foo"]["count"] == 6
+    assert stats["exec"]["echo foo"]["stdout_bytes"] == 24
+    assert stats["connection"]["publickey"]["count"] == 6
+    assert sharded_server.stats() == {}
+
+
+def test_sharded_shutdown(user_key_path: str):
+    with Server({"sample-user": user_key_path}, processes=2) as s:
+        processes = [shard.process for shard in s._shards]
+        sock = s._socket
+        assert all(p.is_alive() for p in processes)
+    assert not any(p.is_alive() for p in processes)
+    # Closed even when only bound, for SO_REUSEPORT.
+    assert sock.fileno() == -1
+
+
+def test_fleet_processes(user_key_path: str):
+    with raises(ValueError):
+        ServerFleet({"sample-user": user_key_path}, 2, processes=2)
@@ -1,8 +1,11 @@
+import codecs
 import random
 import string
+import time
 
 from pytest import mark
 from mockssh.server import Server
+from mockssh.streaming import CoalescingWriter
 
 
 def first_user(server: Server) -> str:
@@ -38,3 +41,110 @@ def test_stdin_to_stderr(server: Server):
 @mark.fails_on_windows
 def test_streaming_output(server: Server):
     streaming_test(server, "cat", 1, 100)
+
+
+@mark.fails_on_windows
+def test_large_binary_output(server: Server):
+    size = 8 * 1024 * 1024
+    with server.client(first_user(server)) as c:
+        _, stdout, _ = c.exec_command("head -c %d /dev/zero" % size)
+        assert stdout.read() == b"\0" * size
+        assert stdout.channel.recv_exit_status() == 0
+
+
+@mark.fails_on_windows
+def test_line_relay(user_key_path: str):
+    with Server({"sample-user": user_key_path}, buffer_size=None) as server:
+        streaming_test(server, "cat", 1, 10)
+
+
+class FakeChannel:
+    def __init__(self, window: int = 1 << 30):
+        self.window = window
+        self.packets = []
+
+    def send_ready(self) -> bool:
+        return self.window > 0
+
+    def send(self, data: bytes) -> int:
+        sent = min(len(data), self.window)
+        self.window -= sent
+        self.packets.append(data[:sent])
+        return sent
+
+    def sendall(self, data: bytes) -> None:
+        self.packets.append(data)
+
+    send_stderr = send
+    sendall_stderr = sendall
+
+
+def test_coalescing_writer():
+    channel = FakeChannel()
+    writer = CoalescingWriter(channel, False, 10, 60.0)
+    for _ in range(3):
+        writer.write(b"abc")
+    assert channel.packets == []
+    writer.write(b"abc")
+    assert channel.packets == [b"abcabcabcabc"]
+    writer.write(b"x")
+    writer.tick(writer.deadline)
+    assert channel.packets[-1] == b"x"
+
+
+def test_coalescing_writer_respects_window():
+    channel = FakeChannel(window=4)
+    writer = CoalescingWriter(channel, False, 10, 60.0)
+    writer.write(b"0123456789")
+    assert channel.packets == [b"0123"]
+    assert writer.pending == 6
+    writer.write(b"0123456789")
+    assert writer.pending == 16
+    writer.write(b"0123456789")
+    assert writer.pending == 0
+    assert b"".join(channel.packets) == b"0123456789" * 3
+
+
+def test_coalescing_disabled():
+    channel = FakeChannel()
+    writer = CoalescingWriter(channel, False, 10, 0.0)
+    writer.write(b"a")
+    writer.write(b"b")
+    assert channel.packets == [b"a", b"b"]
+
+
+@mark.fails_on_windows
+def test_many_short_lines(server: Server):
+    with server.client(first_user(server)) as c:
+        _, stdout, _ = c.exec_command("seq 100000")
+        expected = "".join("%d\n" % i for i in range(1, 100001))
+        assert codecs.decode(stdout.read(), "utf8") == expected
+
+
+@mark.fails_on_windows
+def test_stdin_eof(server: Server):
+    with server.client(first_user(server)) as c:
+        stdin, stdout, _ = c.exec_command("wc -c")
+        stdin.write("x" * 100000)
+        stdin.channel.shutdown_write()
+        assert stdout.read().strip() == b"100000"
+
+
+@mark.fails_on_windows
+def test_quiet_command_cpu_usage(server: Server):
+    with server.client(first_user(server)) as c:
+        _, stdout, _ = c.exec_command("exec >&- 2>&-; sleep 2")
+        started = time.process_time()
+        assert stdout.channel.recv_exit_status() == 0
+        # Both the client and the server live in this process: waiting for
+        # the command should be close to free, not spin a core.
+        assert time.process_time() - started < 0.5
+
+
+@mark.fails_on_windows
+def test_background_process_holding_output(server: Server):
+    with server.client(first_user(server)) as c:
+        _, stdout, _ = c.exec_command("echo done; sleep 5 &")
+        started = time.monotonic()
+        assert stdout.read() == b"done\n"
+        assert time.monotonic() - started < 4